@@ -16,4 +16,4 @@
 # You should have received a copy of the GNU General Public License
 # along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
 
-from .classify import classify
+from .classify import (classify, split_features)
@@ -45,6 +45,15 @@ def classify(event_time, channel_name,
         **kwargs:
             timeseries
             source
+            save_images : set to False to classify the spectrograms
+            directly without writing PNGs to `plot_directory`, the
+            Filename1 to Filename4 columns are then left empty
+            path_to_semantic_model : also extract the features of the
+            event with this similarity model, reading each image once,
+            they are added to the `Events` as the columns '0', '1', ...
+            inference_server : score the event on the
+            `gravityspy.ml.inference_server.InferenceServer` listening
+            at this address, or in process if there is none
 
     Returns:
 
@@ -67,6 +76,11 @@ def classify(event_time, channel_name,
     config = kwargs.pop('config', utils.GravitySpyConfigFile())
     plot_directory = kwargs.pop('plot_directory', 'plots')
     id_string = kwargs.pop('id_string', '{0:.9f}'.format(event_time))
+    save_images = kwargs.pop('save_images', True)
+    path_to_semantic_model = kwargs.pop('path_to_semantic_model', None)
+
+    if path_to_semantic_model is not None and not save_images:
+        raise ValueError('Extracting features requires save_images')
 
     # Parse Ini File
     plot_time_ranges = config.plot_time_ranges
@@ -80,26 +94,69 @@ def classify(event_time, channel_name,
                                              config=config,
                                              **kwargs)
 
-    utils.save_q_scans(plot_directory, specsgrams,
-                       plot_normalized_energy_range, plot_time_ranges,
-                       detector_name, event_time, frange=frange,
-                       id_string=id_string,
-                       **kwargs)
-
-    results = utils.label_q_scans(plot_directory=plot_directory,
-                                  path_to_cnn=path_to_cnn,
-                                  **kwargs)
+    if save_images:
+        utils.save_q_scans(plot_directory, specsgrams,
+                           plot_normalized_energy_range, plot_time_ranges,
+                           detector_name, event_time, frange=frange,
+                           id_string=id_string,
+                           **kwargs)
+
+        if path_to_semantic_model is not None:
+            results, features = utils.label_and_get_features(
+                                    plot_directory=plot_directory,
+                                    path_to_cnn=path_to_cnn,
+                                    path_to_semantic_model=path_to_semantic_model,
+                                    **kwargs)
+        else:
+            results = utils.label_q_scans(plot_directory=plot_directory,
+                                          path_to_cnn=path_to_cnn,
+                                          **kwargs)
+    else:
+        results = utils.label_spectrograms(specsgrams,
+                                           plot_normalized_energy_range,
+                                           plot_time_ranges, detector_name,
+                                           event_time, path_to_cnn,
+                                           frange=frange,
+                                           id_string=id_string,
+                                           **kwargs)
 
     results['q_value'] = q_value
 
     results = results.to_pandas()
-    results['Filename1'] = results['Filename1'].apply(lambda x, y : os.path.join(y, x),
-                                                      args=(plot_directory,))
-    results['Filename2'] = results['Filename2'].apply(lambda x, y : os.path.join(y, x),
-                                                      args=(plot_directory,))
-    results['Filename3'] = results['Filename3'].apply(lambda x, y : os.path.join(y, x),
-                                                      args=(plot_directory,))
-    results['Filename4'] = results['Filename4'].apply(lambda x, y : os.path.join(y, x),
-                                                      args=(plot_directory,))
+    # without images the Filename columns are left empty
+    if save_images:
+        for column in ['Filename1', 'Filename2', 'Filename3', 'Filename4']:
+            results[column] = results[column].apply(
+                                  lambda x, y : os.path.join(y, x),
+                                  args=(plot_directory,))
+
+    if path_to_semantic_model is not None:
+        results = results.merge(features.to_pandas(), on='gravityspy_id')
 
     return Events.from_pandas(results)
+
+def split_features(events):
+    """Split the features `classify` adds to its `Events` from the scores
+
+    Parameters:
+
+        events (`Events`):
+            returned by `classify` with a `path_to_semantic_model`
+
+    Returns:
+
+        scores (`Events`):
+            the table `classify` returns without a semantic model
+
+        features (`Events`):
+            the ``gravityspy_id`` and the columns '0', '1', ...
+            holding the features
+    """
+    feature_names = sorted((name for name in events.colnames
+                            if name.isdigit()), key=int)
+    if not feature_names:
+        raise ValueError("This table does not hold any features")
+    features = events[['gravityspy_id'] + feature_names]
+    scores = events.copy()
+    scores.remove_columns(feature_names)
+    return scores, features
@@ -5,20 +5,25 @@ processing the outputs into a more understandable way.
 For example ``tile_raster_images`` helps in generating a easy to grasp
 image from a set of samples or weights.
 """
-from keras import backend as K
-from keras.regularizers import l2
-from keras.models import Sequential
-from keras.layers import Dense, Dropout, Activation, Flatten
-from keras.layers import MaxPooling2D, Conv2D
-
+import itertools
 import numpy as np
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 #4/2/2018
 def concatenate_views(image_set1, image_set2, image_set3,
                       image_set4, image_size, rgb_flag,
-                      order_of_channels):
+                      order_of_channels, dtype=np.float64):
     """Create a merged view from a set of 4 views of one sample image
 
+    The views are tiled as a 2 by 2 mosaic, ``image_set1`` over
+    ``image_set2`` on the left and ``image_set3`` over ``image_set4`` on
+    the right, written straight into a single preallocated array.
+
     Parameters:
         image_set1 (array):
             The grayscale downsamples pixels for one duration of one
@@ -44,6 +49,12 @@ def concatenate_views(image_set1, image_set2, image_set3,
             Are you trying to create a merged view of grayscale
             or RGB image renders
 
+        order_of_channels (str):
+            channels_last or channels_first
+
+        dtype (`numpy.dtype`, optional):
+            Default `numpy.float64`, the type of the merged views
+
     Returns:
         concated_view (array):
             A single merged view of the sample, in the case
@@ -57,28 +68,30 @@ def concatenate_views(image_set1, image_set2, image_set3,
     else:
         ch = 1
 
+    assert len(image_set1) == len(image_set2)
+    assert len(image_set3) == len(image_set4)
+    assert len(image_set1) == len(image_set3)
+    nb_samples = len(image_set1)
+
     if order_of_channels == 'channels_last':
-        concat_images_set = np.zeros((len(image_set1), img_rows * 2, img_cols, ch))
-        concat_images_set2 = np.zeros((len(image_set3), img_rows * 2, img_cols, ch))
-        concat_row_axis = 0
-        concat_col_axis = 2
+        out = np.empty((nb_samples, img_rows * 2, img_cols * 2, ch),
+                       dtype=dtype)
+        view_shape = (nb_samples, img_rows, img_cols, ch)
+        out[:, :img_rows, :img_cols, :] = np.reshape(image_set1, view_shape)
+        out[:, img_rows:, :img_cols, :] = np.reshape(image_set2, view_shape)
+        out[:, :img_rows, img_cols:, :] = np.reshape(image_set3, view_shape)
+        out[:, img_rows:, img_cols:, :] = np.reshape(image_set4, view_shape)
     elif order_of_channels == 'channels_first':
-        concat_images_set = np.zeros((len(image_set1), ch, img_rows * 2, img_cols))
-        concat_images_set2 = np.zeros((len(image_set3), ch, img_rows * 2, img_cols))
-        concat_row_axis = 1
-        concat_col_axis = 3
+        out = np.empty((nb_samples, ch, img_rows * 2, img_cols * 2),
+                       dtype=dtype)
+        view_shape = (nb_samples, ch, img_rows, img_cols)
+        out[:, :, :img_rows, :img_cols] = np.reshape(image_set1, view_shape)
+        out[:, :, img_rows:, :img_cols] = np.reshape(image_set2, view_shape)
+        out[:, :, :img_rows, img_cols:] = np.reshape(image_set3, view_shape)
+        out[:, :, img_rows:, img_cols:] = np.reshape(image_set4, view_shape)
     else:
         raise ValueError("Do not understand supplied channel order")
 
-    assert len(image_set1) == len(image_set2)
-    for i in range(0, len(image_set1)):
-        concat_images_set[i, :, :, :] = np.append(image_set1[i, :, :, :], image_set2[i, :, :, :], axis=concat_row_axis)
-
-    assert len(image_set3) == len(image_set4)
-    for i in range(0, len(image_set3)):
-        concat_images_set2[i, :, :, :] = np.append(image_set3[i, :, :, :], image_set4[i, :, :, :], axis=concat_row_axis)
-
-    out = np.append(concat_images_set,concat_images_set2, axis=concat_col_axis)
     return out
 
 #4/2/2018
@@ -108,6 +121,11 @@ def build_cnn(img_rows, img_cols, order_of_channels):
         model (`object`):
             a CNN
     """
+    from keras.regularizers import l2
+    from keras.models import Sequential
+    from keras.layers import Dense, Dropout, Activation, Flatten
+    from keras.layers import MaxPooling2D, Conv2D
+
     W_reg = 1e-4
     print('regularization parameter: ', W_reg)
     if order_of_channels == 'channels_last':
@@ -156,6 +174,8 @@ def cosine_distance(vects):
 
         vect (array):
     """
+    from keras import backend as K
+
     x, y = vects
     x = K.maximum(x, K.epsilon())
     y = K.maximum(y, K.epsilon())
@@ -170,6 +190,8 @@ def siamese_acc(thred):
         thred (float):
             It is something
     """
+    from keras import backend as K
+
     def inner_siamese_acc(y_true, y_pred):
         pred_res = y_pred < thred
         acc = K.mean(K.cast(K.equal(K.cast(pred_res, dtype='int32'), K.cast(y_true, dtype='int32')), dtype='float32'))
@@ -182,54 +204,137 @@ def eucl_dist_output_shape(shapes):
     return (shape1[0], 1)
 
 def contrastive_loss(y_true, y_pred):
+    from keras import backend as K
+
     margin = 1
     return K.mean(y_true * K.square(y_pred) + (1 - y_true) * K.square(K.maximum(margin - y_pred, 0)))
 
-def create_pairs3_gen(data, class_indices, batch_size):
-    """ Create the pairs
+def create_pairs3_gen(data, class_indices, batch_size, random_state=None,
+                      prefetch=0, steps_per_epoch=None, initial_epoch=0):
+    """Generate batches of positive and negative pairs of samples
+
+    Every batch draws its anchors, their partners from the same class
+    and from another class at once, then gathers the samples of each
+    side of the pairs with one fancy indexing into a float32 array.
+    The anchors are drawn uniformly over the samples, so each class
+    anchors pairs in proportion to its size.
 
     Parameters:
-        data (float):
-            It is something
+        data (`numpy.ndarray`):
+            the samples, images or embeddings, along the first axis
+
         class_indices (list):
-            It is something
+            for each class, the indices into ``data`` of its samples
+
         batch_size (int):
-            It is something
+            number of anchors per batch, each giving a positive and a
+            negative pair, so batches hold ``2 * batch_size`` pairs
+
+        random_state (int, optional):
+            Default None, seed of the sampling
+
+        prefetch (int, optional):
+            Default 0, number of batches made ahead of time by a
+            background thread, if 0 batches are made on demand
+
+        steps_per_epoch (int, optional):
+            Default None, if given the batches of every epoch are drawn
+            from ``random_state`` and the number of the epoch, so the
+            batches of an epoch do not depend on how far earlier epochs
+            or a prefetching thread have gone
+
+        initial_epoch (int, optional):
+            Default 0, the epoch the first batches are drawn for
+
+    Returns:
+        an endless iterator of ``[pairs1, pairs2], labels``
     """
-    pairs1 = []
-    pairs2 = []
-    labels = []
+    # cast once, so each batch is gathered straight into its buffers
+    data = np.asarray(data, dtype=np.float32)
+    if steps_per_epoch is None:
+        batches = _pair_batches(data, class_indices, batch_size,
+                                np.random.RandomState(random_state))
+    else:
+        batches = _epoch_pair_batches(data, class_indices, batch_size,
+                                      random_state, steps_per_epoch,
+                                      initial_epoch)
+    if prefetch:
+        return _prefetch(batches, prefetch)
+    return batches
+
+
+def _pair_batches(data, class_indices, batch_size, rng):
     number_of_classes = len(class_indices)
-    counter = 0
+    if number_of_classes < 2:
+        raise ValueError('Negative pairs need at least two classes')
+    sizes = np.array([len(indices) for indices in class_indices])
+    if not sizes.all():
+        raise ValueError('Every class needs at least one sample')
+    offsets = np.cumsum(sizes) - sizes
+    members = np.concatenate([np.asarray(indices, dtype=np.intp)
+                              for indices in class_indices])
+    classes = np.repeat(np.arange(number_of_classes), sizes)
+
+    def draw(which):
+        # one random member of each of these classes
+        return members[offsets[which] +
+                       (rng.random_sample(len(which)) *
+                        sizes[which]).astype(np.intp)]
+
+    # positive pairs on even rows, negative pairs on odd rows
+    labels = np.tile(np.array([1, 0], dtype=np.int32), batch_size)
+    while True:
+        anchors = rng.randint(len(members), size=batch_size)
+        anchor_class = classes[anchors]
+        other_class = ((anchor_class +
+                        rng.randint(1, number_of_classes, size=batch_size)) %
+                       number_of_classes)
+
+        first = np.repeat(members[anchors], 2)
+        second = np.empty(2 * batch_size, dtype=np.intp)
+        second[0::2] = draw(anchor_class)
+        second[1::2] = draw(other_class)
+
+        # fresh buffers each batch, the consumer may still hold the last
+        pairs1 = np.empty((2 * batch_size,) + data.shape[1:], np.float32)
+        pairs2 = np.empty((2 * batch_size,) + data.shape[1:], np.float32)
+        # data is float32 and the indices are in range, so take
+        # writes straight into the buffers without a temporary
+        np.take(data, first, axis=0, out=pairs1, mode='clip')
+        np.take(data, second, axis=0, out=pairs2, mode='clip')
+        yield [pairs1, pairs2], labels.copy()
+
+
+def _epoch_pair_batches(data, class_indices, batch_size, random_state,
+                        steps_per_epoch, initial_epoch):
+    for epoch in itertools.count(initial_epoch):
+        rng = np.random.RandomState(
+                  None if random_state is None else [random_state, epoch])
+        batches = _pair_batches(data, class_indices, batch_size, rng)
+        for batch in itertools.islice(batches, steps_per_epoch):
+            yield batch
+
+
+def _prefetch(iterator, size):
+    """Run an iterator in a background thread, ``size`` items ahead
+    """
+    items = queue.Queue(maxsize=size)
+
+    def fill():
+        try:
+            for item in iterator:
+                items.put((item, None))
+        except Exception as exc:  # pylint: disable=broad-except
+            items.put((None, exc))
+
+    thread = threading.Thread(target=fill)
+    thread.daemon = True
+    thread.start()
     while True:
-        for d in range(len(class_indices)):
-            for i in range(len(class_indices[d])):
-                counter += 1
-                # positive pair
-                j = random.randrange(0, len(class_indices[d]))
-                z1, z2 = class_indices[d][i], class_indices[d][j]
-
-                pairs1.append(data[z1])
-                pairs2.append(data[z2])
-                labels.append(1)
-
-                # negative pair
-                inc = random.randrange(1, number_of_classes)
-                other_class_id = (d + inc) % number_of_classes
-                j = random.randrange(0, len(class_indices[other_class_id])-1)
-                z1, z2 = class_indices[d][i], class_indices[other_class_id][j]
-
-                pairs1.append(data[z1])
-                pairs2.append(data[z2])
-                labels.append(0)
-
-                if counter == batch_size:
-                    #yield np.array(pairs), np.array(labels)
-                    yield [np.asarray(pairs1, np.float32), np.asarray(pairs2, np.float32)], np.asarray(labels, np.int32)
-                    counter = 0
-                    pairs1 = []
-                    pairs2 = []
-                    labels = []
+        item, exc = items.get()
+        if exc is not None:
+            raise exc
+        yield item
 
 
 def split_data_set(data, fraction_validation=.125, fraction_testing=None,
@@ -16,5 +16,14 @@
 # You should have received a copy of the GNU General Public License
 # along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
 
-from keras import backend as K
-K.set_image_dim_ordering('th')
+"""Train and run the Gravity Spy classifier and similarity models
+
+Importing this package does not import Keras, so scoring with the numpy
+backend never loads it. It used to set the Keras image dimension ordering
+to 'th', channels_first, for the whole process on import. Instead every
+function here that runs a Keras model now sets the image data format from
+its ``order_of_channels`` argument, channels_last by default. Code that
+builds its own Keras models after importing gravityspy and relied on
+channels_first should call ``keras.backend.set_image_data_format``
+itself.
+"""
@@ -0,0 +1,227 @@
+"""Resumable training of the Gravity Spy models
+
+`TrainingCheckpoint` is a Keras callback writing, every ``period``
+epochs, the weights of the model, the state of its optimizer, the state
+of the random number generators and the epoch reached to a single HDF5
+file. The random states are those at the beginning of the next epoch.
+Batches made ahead of time by worker threads may already have moved
+them on, so the samplers of `train_classifier` and `train_semantic_index`
+draw each epoch from their seed and its number instead, and a resumed
+run draws the same batches as one that was never stopped. The file is
+written under a temporary name and then renamed, so a job killed while
+writing leaves the previous checkpoint intact. The weights of the best
+epoch on the validation set are written beside it.
+
+A restarted job calls `TrainingCheckpoint.resume` before fitting and
+passes the epoch it returns as ``initial_epoch``.
+"""
+from keras.callbacks import Callback
+
+from gravityspy.utils import log
+
+import h5py
+import numpy
+import os
+import random
+
+LATEST = 'latest.h5'
+BEST = 'best.h5'
+
+
+class TrainingCheckpoint(Callback):
+    """Save and resume the state of a training run
+
+    The quantity deciding the best epoch is checked after every epoch,
+    but the files are only written every ``period`` epochs and at the
+    end of training. The random generators of the Keras backend, which
+    draw the dropout masks, cannot be read back and are not saved.
+
+    Parameters:
+
+        directory (str):
+            folder holding ``latest.h5`` and ``best.h5``
+
+        monitor (str, optional):
+            Default 'val_loss', the quantity deciding the best epoch
+
+        mode (str, optional):
+            Default 'auto', 'min' or 'max', with 'auto' a quantity
+            whose name contains 'acc' is maximised and any other
+            minimised
+
+        period (int, optional):
+            Default 1, number of epochs between checkpoints
+
+        random_states (list, optional):
+            Default None, `numpy.random.RandomState` objects driving
+            the training data, saved with the global NumPy and Python
+            states
+
+        verbose (bool, optional):
+            Default False
+    """
+    def __init__(self, directory, monitor='val_loss', mode='auto', period=1,
+                 random_states=None, verbose=False):
+        super(TrainingCheckpoint, self).__init__()
+        if mode == 'auto':
+            mode = 'max' if 'acc' in monitor else 'min'
+        if mode not in ['min', 'max']:
+            raise ValueError("Do not understand supplied mode, "
+                             "choose 'min', 'max' or 'auto'")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.monitor = monitor
+        self.mode = mode
+        self.period = period
+        self.random_states = random_states or []
+        self.verbose = verbose
+        self.best = None
+        self.logger = log.Logger('Gravity Spy: Checkpointing Training')
+        self._optimizer_weights = None
+        self._best_weights = None
+        self._epoch = None
+        self._saved_epoch = None
+        self._pending = False
+
+    @property
+    def latest(self):
+        return os.path.join(self.directory, LATEST)
+
+    @property
+    def best_filename(self):
+        return os.path.join(self.directory, BEST)
+
+    def resume(self, model):
+        """Restore the latest checkpoint, if there is one
+
+        The state of the optimizer is restored when training begins,
+        once the optimizer has made its weights.
+
+        Parameters:
+
+            model (`keras.models.Model`):
+                the compiled model about to be fitted
+
+        Returns:
+
+            initial_epoch (int):
+                the epoch to carry on training from, 0 if there
+                is no checkpoint
+        """
+        if not os.path.isfile(self.latest):
+            return 0
+
+        model.load_weights(self.latest)
+        with h5py.File(self.latest, 'r') as f:
+            group = f['optimizer_weights']
+            self._optimizer_weights = [group[str(idx)][:]
+                                       for idx in range(len(group))]
+            state = f['checkpoint']
+            epoch = int(state.attrs['epoch'])
+            if 'best' in state.attrs:
+                self.best = float(state.attrs['best'])
+            numpy.random.set_state(_read_random_state(state['numpy']))
+            random.setstate(_read_python_state(state['python']))
+            for idx, random_state in enumerate(self.random_states):
+                random_state.set_state(_read_random_state(
+                    state['random_state_{0}'.format(idx)]))
+
+        if self.verbose:
+            self.logger.info('Resuming training from epoch {0}'.format(
+                epoch))
+        return epoch
+
+    def restore_best(self, model):
+        """Load the weights of the best epoch into a model, if saved
+        """
+        if os.path.isfile(self.best_filename):
+            model.load_weights(self.best_filename)
+
+    def on_train_begin(self, logs=None):
+        if self._optimizer_weights is not None:
+            self.model.optimizer.set_weights(self._optimizer_weights)
+            self._optimizer_weights = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self._pending:
+            self._save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        current = logs.get(self.monitor)
+        if current is not None and (
+                self.best is None or
+                (current < self.best if self.mode == 'min' else
+                 current > self.best)):
+            if self.verbose:
+                self.logger.info('{0} improved to {1} at epoch {2}'.format(
+                    self.monitor, current, epoch + 1))
+            self.best = float(current)
+            self._best_weights = self.model.get_weights()
+
+        self._epoch = epoch + 1
+        # written when the next epoch begins, once the random states
+        # have moved on to it
+        self._pending = not self._epoch % self.period
+
+    def on_train_end(self, logs=None):
+        if self._epoch is not None and self._epoch != self._saved_epoch:
+            self._save()
+
+    def _save(self):
+        if self._best_weights is not None:
+            weights = self.model.get_weights()
+            self.model.set_weights(self._best_weights)
+            self.model.save_weights(self.best_filename + '.tmp',
+                                    overwrite=True)
+            self.model.set_weights(weights)
+            os.rename(self.best_filename + '.tmp', self.best_filename)
+            self._best_weights = None
+
+        tmp_filename = self.latest + '.tmp'
+        self.model.save_weights(tmp_filename, overwrite=True)
+        with h5py.File(tmp_filename, 'a') as f:
+            group = f.create_group('optimizer_weights')
+            for idx, weight in enumerate(self.model.optimizer.get_weights()):
+                group.create_dataset(str(idx), data=weight)
+            state = f.create_group('checkpoint')
+            state.attrs['epoch'] = self._epoch
+            if self.best is not None:
+                state.attrs['best'] = self.best
+            _write_random_state(state, 'numpy', numpy.random.get_state())
+            _write_python_state(state, 'python', random.getstate())
+            for idx, random_state in enumerate(self.random_states):
+                _write_random_state(state, 'random_state_{0}'.format(idx),
+                                    random_state.get_state())
+        os.rename(tmp_filename, self.latest)
+        self._saved_epoch = self._epoch
+        self._pending = False
+
+
+def _write_random_state(group, name, state):
+    dataset = group.create_dataset(name, data=state[1])
+    dataset.attrs['pos'] = state[2]
+    dataset.attrs['has_gauss'] = state[3]
+    dataset.attrs['cached_gaussian'] = state[4]
+
+
+def _read_random_state(dataset):
+    return ('MT19937', dataset[:], int(dataset.attrs['pos']),
+            int(dataset.attrs['has_gauss']),
+            float(dataset.attrs['cached_gaussian']))
+
+
+def _write_python_state(group, name, state):
+    dataset = group.create_dataset(name, data=numpy.array(state[1],
+                                                          dtype=numpy.int64))
+    dataset.attrs['version'] = state[0]
+    if state[2] is not None:
+        dataset.attrs['gauss_next'] = state[2]
+
+
+def _read_python_state(dataset):
+    return (int(dataset.attrs['version']),
+            tuple(int(x) for x in dataset[:]),
+            float(dataset.attrs['gauss_next'])
+            if 'gauss_next' in dataset.attrs else None)
@@ -0,0 +1,287 @@
+"""Cluster feature vectors that do not fit in memory
+
+The features of a catalogue are streamed in chunks from HDF5 files or
+from SQL tables by `HDF5Features` and `SQLFeatures`. `fit_kmeans` trains
+a mini-batch k-means on the chunks, `assign_clusters` writes the cluster
+of every event back one chunk at a time and `select_nclusters` compares
+several numbers of clusters in parallel.
+"""
+from gwpy.utils import mp as mp_utils
+from sklearn.cluster import MiniBatchKMeans
+
+from .similarity_index import feature_columns
+
+import h5py
+import numpy
+
+
+class HDF5Features(object):
+    """Stream feature vectors from tables written by `Events.write`
+
+    Parameters:
+
+        filename (str):
+            path to the HDF5 file
+
+        path (str, optional):
+            Default None, the table to read, if None every table in the
+            file holding a ``gravityspy_id`` column is read, as in the
+            ``features.hdf5`` files written by ``wscan``
+
+        chunk_size (int, optional):
+            Default 65536, number of events per chunk
+    """
+    def __init__(self, filename, path=None, chunk_size=65536):
+        self.filename = filename
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        with h5py.File(self.filename, 'r') as f:
+            if self.path is not None:
+                paths = [self.path]
+            else:
+                paths = []
+
+                def visit(name, item):
+                    if (isinstance(item, h5py.Dataset) and
+                            item.dtype.names and
+                            'gravityspy_id' in item.dtype.names):
+                        paths.append(name)
+                f.visititems(visit)
+
+            # gather rows across tables until a chunk is full
+            buffered = []
+            nbuffered = 0
+            for path in paths:
+                dataset = f[path]
+                for start in range(0, dataset.shape[0], self.chunk_size):
+                    rows = dataset[start:start + self.chunk_size]
+                    buffered.append(rows)
+                    nbuffered += len(rows)
+                    if nbuffered >= self.chunk_size:
+                        yield _split_rows(numpy.concatenate(buffered))
+                        buffered = []
+                        nbuffered = 0
+            if buffered:
+                yield _split_rows(numpy.concatenate(buffered))
+
+
+class SQLFeatures(object):
+    """Stream feature vectors from a SQL table
+
+    Parameters:
+
+        table (str):
+            name of the SQL table, e.g. ``updated_similarity_index``
+
+        connection_str (str):
+            passed to `sqlalchemy.engine.create_engine`,
+            see `gravityspy.table.events.get_connection_str`
+
+        chunk_size (int, optional):
+            Default 65536, number of events per chunk
+    """
+    def __init__(self, table, connection_str, chunk_size=65536):
+        self.table = table
+        self.connection_str = connection_str
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        import pandas
+        from sqlalchemy.engine import create_engine
+        engine = create_engine(self.connection_str)
+        try:
+            # a server side cursor, else the driver fetches every row
+            # before the first chunk is returned
+            connection = engine.connect().execution_options(
+                             stream_results=True)
+            try:
+                # the table is reflected by name, not pasted into a query
+                for chunk in pandas.read_sql_table(self.table, connection,
+                                                   chunksize=self.chunk_size):
+                    yield (numpy.asarray(chunk['gravityspy_id']).astype(str),
+                           feature_columns(chunk))
+            finally:
+                connection.close()
+        finally:
+            engine.dispose()
+
+
+def fit_kmeans(features, nclusters, random_state=30, batch_size=1024,
+               nepochs=1):
+    """Train a mini-batch k-means on streamed feature vectors
+
+    Parameters:
+
+        features (iterable):
+            yielding (gravityspy_id, features) chunks, such as
+            `HDF5Features` or `SQLFeatures`, which is iterated over
+            ``nepochs`` times
+
+        nclusters (int):
+            how many clusters to group the events into
+
+        random_state (int, optional):
+            Default 30
+
+        batch_size (int, optional):
+            Default 1024, events per k-means update
+
+        nepochs (int, optional):
+            Default 1, number of passes over the events
+
+    Returns:
+
+        `sklearn.cluster.MiniBatchKMeans`
+    """
+    kmeans = MiniBatchKMeans(nclusters, random_state=random_state,
+                             batch_size=batch_size)
+    # the first update places the centres so it needs nclusters events
+    batch_size = max(batch_size, nclusters)
+    for _ in range(nepochs):
+        for _, chunk in features:
+            for start in range(0, len(chunk), batch_size):
+                kmeans.partial_fit(chunk[start:start + batch_size])
+    return kmeans
+
+
+def assign_clusters(kmeans, features, filename=None, table=None,
+                    connection_str=None):
+    """Write the cluster of every event, one chunk at a time
+
+    Parameters:
+
+        kmeans (`sklearn.cluster.MiniBatchKMeans`):
+            as returned by `fit_kmeans`
+
+        features (iterable):
+            yielding (gravityspy_id, features) chunks
+
+        filename (str, optional):
+            Default None, HDF5 file to write ``gravityspy_id`` and
+            ``clusters`` datasets to
+
+        table (str, optional):
+            Default None, SQL table to append ``gravityspy_id`` and
+            ``clusters`` rows to
+
+        connection_str (str, optional):
+            Default None, needed with ``table``
+
+    Returns:
+
+        inertia (float):
+            the sum of the squared distances of the events
+            to their cluster centres
+    """
+    if filename is None and table is None:
+        raise ValueError('Please supply a filename and/or a table')
+
+    f = h5py.File(filename, 'w') if filename is not None else None
+    engine = None
+    if table is not None:
+        from sqlalchemy.engine import create_engine
+        engine = create_engine(connection_str)
+
+    inertia = 0.
+    try:
+        for gravityspy_id, chunk in features:
+            clusters = kmeans.predict(chunk)
+            inertia -= kmeans.score(chunk)
+            if f is not None:
+                _append(f, 'gravityspy_id',
+                        numpy.asarray(gravityspy_id, dtype='S100'))
+                _append(f, 'clusters', clusters)
+            if engine is not None:
+                import pandas
+                pandas.DataFrame({'gravityspy_id': gravityspy_id,
+                                  'clusters': clusters}).to_sql(
+                    table, engine, index=False, if_exists='append')
+    finally:
+        if f is not None:
+            f.close()
+        if engine is not None:
+            engine.dispose()
+
+    return float(inertia)
+
+
+def select_nclusters(features, candidates, nproc=1, **kwargs):
+    """Compare the inertia reached with several numbers of clusters
+
+    Parameters:
+
+        features (iterable):
+            yielding (gravityspy_id, features) chunks, which must be
+            picklable when ``nproc`` is more than 1, like
+            `HDF5Features` and `SQLFeatures`
+
+        candidates (list):
+            the numbers of clusters to try
+
+        nproc (int, optional):
+            Default 1, number of candidates fitted at once
+
+        **kwargs:
+            passed to `fit_kmeans`
+
+    Returns:
+
+        inertia (dict):
+            the inertia of the events for each number of clusters
+    """
+    inputs = ((features, nclusters, kwargs, nproc)
+              for nclusters in candidates)
+
+    output = mp_utils.multiprocess_with_queues(nproc, _fit_and_score, inputs)
+
+    inertia = {}
+    # raise exceptions (from multiprocessing, single process raises inline)
+    for inputs, x in output:
+        if isinstance(x, Exception):
+            x.args = ('Failed to cluster into %s clusters: %s' % (inputs[1],
+                                                                 str(x)),)
+            raise x
+        inertia[inputs[1]] = x
+    return inertia
+
+
+def _fit_and_score(inputs):
+    features = inputs[0]
+    nclusters = inputs[1]
+    kwargs = inputs[2]
+    nproc = inputs[3]
+
+    try:
+        kmeans = fit_kmeans(features, nclusters, **kwargs)
+        inertia = 0.
+        for _, chunk in features:
+            inertia -= kmeans.score(chunk)
+        return inputs, float(inertia)
+    except Exception as exc:  # pylint: disable=broad-except
+        if nproc == 1:
+            raise
+        else:
+            return inputs, exc
+
+
+def _split_rows(rows):
+    """Split the rows of a table into IDs and feature vectors
+    """
+    columns = sorted((name for name in rows.dtype.names if name.isdigit()),
+                     key=int)
+    if not columns:
+        raise ValueError("This table does not hold any features")
+    features = numpy.column_stack([rows[column] for column in columns])
+    return rows['gravityspy_id'].astype(str), features.astype(numpy.float32)
+
+
+def _append(f, name, values):
+    if name not in f:
+        f.create_dataset(name, data=values, maxshape=(None,),
+                         chunks=True)
+    else:
+        dataset = f[name]
+        dataset.resize(dataset.shape[0] + len(values), axis=0)
+        dataset[-len(values):] = values
@@ -0,0 +1,377 @@
+"""Serve the Gravity Spy models to many processes on one node
+
+`InferenceServer` keeps every model it is asked for in memory and
+listens on a Unix socket, or a localhost TCP port. Requests sent by
+concurrent clients for the same model are gathered for up to
+``max_wait`` seconds and scored as one batch.
+
+Clients must present the server's authkey, read from a file or from the
+``GRAVITYSPY_INFERENCE_AUTHKEY`` environment variable. The default socket
+lives in a directory only its owner can enter.
+
+`request` sends preprocessed views to a running server and returns None
+if there is no server to answer, or it does not answer within a timeout,
+so that callers can score in process instead.
+"""
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import json
+import numpy
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+AUTHKEY_VARIABLE = 'GRAVITYSPY_INFERENCE_AUTHKEY'
+
+SOCKET_DIRECTORY = os.path.join(tempfile.gettempdir(),
+                                'gravityspy-{0}'.format(os.getuid()))
+
+DEFAULT_ADDRESS = os.path.join(SOCKET_DIRECTORY, 'inference.sock')
+
+DEFAULT_TIMEOUT = 300
+
+KINDS = ['label_views', 'features']
+
+
+def parse_address(address=None):
+    """Turn an address given on the command-line into a socket address
+
+    Parameters:
+
+        address (str, optional):
+            Default None, either the path of a Unix socket or
+            ``host:port``, if None `DEFAULT_ADDRESS` is used
+
+    Returns:
+
+        the path of the socket, or a (host, port) tuple
+    """
+    if address is None:
+        return DEFAULT_ADDRESS
+    if isinstance(address, tuple):
+        return address
+    if ':' in address and os.path.sep not in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+def read_authkey(authkey_file=None):
+    """Read the key shared by the server and its clients
+
+    Parameters:
+
+        authkey_file (str, optional):
+            Default None, a file holding the key, if None the key is
+            read from the ``GRAVITYSPY_INFERENCE_AUTHKEY`` environment
+            variable
+
+    Returns:
+
+        authkey (bytes):
+            None if no key was found
+    """
+    if authkey_file is not None:
+        with open(authkey_file, 'rb') as f:
+            authkey = f.read().strip()
+    else:
+        authkey = os.environ.get(AUTHKEY_VARIABLE, '').encode()
+    return authkey or None
+
+
+def private_directory(directory):
+    """Make a directory only the current user can enter
+
+    Parameters:
+
+        directory (str):
+            created with mode 0700 if it does not exist
+
+    Raises a `ValueError` if the directory exists but is a link,
+    belongs to someone else or can be entered by other users.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    info = os.lstat(directory)
+    if os.path.islink(directory) or info.st_uid != os.getuid():
+        raise ValueError('{0} is not a directory owned by this '
+                         'user'.format(directory))
+    if info.st_mode & 0o077:
+        raise ValueError('{0} can be entered by other users, '
+                         'its permissions must be 0700'.format(directory))
+
+
+def connect(address=None, authkey=None):
+    """Connect to a running `InferenceServer`
+
+    Parameters:
+
+        address (str, optional):
+            Default None, see `parse_address`
+
+        authkey (bytes, optional):
+            Default None, the key the server was started with,
+            if None it is read by `read_authkey`
+
+    Returns:
+
+        `multiprocessing.connection.Connection`, or None if no
+        server is listening or it refused the key
+    """
+    address = parse_address(address)
+    if not isinstance(address, tuple) and not os.path.exists(address):
+        return None
+    if authkey is None:
+        authkey = read_authkey()
+    if authkey is None:
+        return None
+    try:
+        return Client(address, authkey=authkey)
+    except (IOError, OSError, EOFError, AuthenticationError):
+        return None
+
+
+def request(address, kind, model_name, views, options=None, authkey=None,
+            timeout=DEFAULT_TIMEOUT):
+    """Score views on a running server
+
+    Parameters:
+
+        address (str):
+            see `parse_address`
+
+        kind (str):
+            'label_views' for class confidences, or 'features' for
+            the embedding of the similarity model
+
+        model_name (str):
+            path to the model, as seen by the server
+
+        views (`numpy.ndarray`):
+            the views of the events, as passed to `label_views`
+            or `get_views_feature_space`
+
+        options (dict, optional):
+            Default None, other keyword arguments of those functions
+
+        authkey (bytes, optional):
+            Default None, see `connect`
+
+        timeout (float, optional):
+            Default `DEFAULT_TIMEOUT`, seconds to wait for the answer
+
+    Returns:
+
+        `numpy.ndarray` of the scores or features,
+        or None if no server scored them in time
+    """
+    if kind not in KINDS:
+        raise ValueError('Do not understand supplied kind, '
+                         'choose one of {0}'.format(KINDS))
+    conn = connect(address, authkey=authkey)
+    if conn is None:
+        return None
+    try:
+        conn.send((kind, os.path.abspath(model_name), options or {}, views))
+        if not conn.poll(timeout):
+            return None
+        status, result = conn.recv()
+    except (IOError, OSError, EOFError):
+        return None
+    finally:
+        conn.close()
+    if status != 'ok':
+        return None
+    return result
+
+
+class InferenceServer(object):
+    """Score the views sent by many clients with models loaded once
+
+    Parameters:
+
+        address (str, optional):
+            Default None, see `parse_address`
+
+        authkey (bytes, optional):
+            Default None, the key clients must present, if None it is
+            read from ``authkey_file`` or the
+            ``GRAVITYSPY_INFERENCE_AUTHKEY`` environment variable
+
+        authkey_file (str, optional):
+            Default None, a file holding the key
+
+        max_batch (int, optional):
+            Default 256, the most events scored at a time
+
+        max_wait (float, optional):
+            Default 0.01, seconds to wait for more requests
+            to join a batch
+
+        preload (list, optional):
+            Default None, paths of models to load before serving,
+            `serve_forever` raises if any of them cannot be loaded
+    """
+    def __init__(self, address=None, authkey=None, authkey_file=None,
+                 max_batch=256, max_wait=0.01, preload=None, verbose=False):
+        self.address = parse_address(address)
+        self.authkey = authkey or read_authkey(authkey_file)
+        if self.authkey is None:
+            raise ValueError('Refusing to serve without an authkey, supply '
+                             'one in a file or in the {0} environment '
+                             'variable'.format(AUTHKEY_VARIABLE))
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.preload = preload or []
+        self.verbose = verbose
+        self.requests = queue.Queue()
+        self.listener = None
+        self._ready = threading.Event()
+        self._preload_error = None
+
+    def serve_forever(self):
+        """Accept clients until the process is killed or `close` is called
+        """
+        # models must be loaded and run in the same thread
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+
+        # do not take clients before the models are in memory
+        self._ready.wait()
+        if self._preload_error is not None:
+            raise self._preload_error
+
+        if not isinstance(self.address, tuple):
+            if self.address == DEFAULT_ADDRESS:
+                private_directory(SOCKET_DIRECTORY)
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        self.listener = Listener(self.address, authkey=self.authkey)
+        if not isinstance(self.address, tuple):
+            os.chmod(self.address, 0o600)
+
+        try:
+            while True:
+                try:
+                    conn = self.listener.accept()
+                except (AuthenticationError, EOFError):
+                    # a client without the key
+                    continue
+                except (IOError, OSError):
+                    if self.listener is None:
+                        break
+                    continue
+                handler = threading.Thread(target=self._handle, args=(conn,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop listening and remove the socket
+        """
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.close()
+            if not isinstance(self.address, tuple) and os.path.exists(
+                    self.address):
+                os.remove(self.address)
+
+    def _handle(self, conn):
+        try:
+            while True:
+                try:
+                    kind, model_name, options, views = conn.recv()
+                except EOFError:
+                    break
+                done = threading.Event()
+                item = {'key': (kind, model_name,
+                                json.dumps(options, sort_keys=True)),
+                        'options': options, 'views': views,
+                        'done': done, 'result': None}
+                self.requests.put(item)
+                done.wait()
+                conn.send(item['result'])
+        except (IOError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _work(self):
+        from . import labelling_test_glitches as label_glitches
+
+        try:
+            for model_name in self.preload:
+                label_glitches.get_model(model_name)
+        except Exception as exc:  # pylint: disable=broad-except
+            self._preload_error = exc
+            return
+        finally:
+            self._ready.set()
+
+        while True:
+            batch = [self.requests.get()]
+            try:
+                self._score_batch(label_glitches, batch)
+            except Exception as exc:  # pylint: disable=broad-except
+                # answer every client rather than let the worker die
+                for item in batch:
+                    if not item['done'].is_set():
+                        item['result'] = ('error', str(exc))
+                        item['done'].set()
+
+    def _score_batch(self, label_glitches, batch):
+        """Gather more requests into the batch and score it by model
+        """
+        nb_events = len(batch[0]['views'])
+        deadline = time.time() + self.max_wait
+        while nb_events < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            nb_events += len(item['views'])
+
+        groups = {}
+        for item in batch:
+            groups.setdefault(item['key'], []).append(item)
+        for (kind, model_name, _), items in groups.items():
+            self._score(label_glitches, kind, model_name, items)
+
+    def _score(self, label_glitches, kind, model_name, items):
+        try:
+            views = numpy.concatenate([item['views'] for item in items])
+            options = dict(items[0]['options'], batch_size=self.max_batch)
+            if kind == 'label_views':
+                output, _ = label_glitches.label_views(views, model_name,
+                                                       **options)
+            elif kind == 'features':
+                output = label_glitches.get_views_feature_space(
+                             views, model_name, **options)
+            else:
+                raise ValueError('Do not understand supplied kind')
+            if self.verbose:
+                print ('Scored {0} events from {1} requests with {2}'.format(
+                    len(views), len(items), model_name))
+            start = 0
+            for item in items:
+                stop = start + len(item['views'])
+                item['result'] = ('ok', output[start:stop])
+                start = stop
+        except Exception as exc:  # pylint: disable=broad-except
+            for item in items:
+                item['result'] = ('error', str(exc))
+        for item in items:
+            item['done'].set()
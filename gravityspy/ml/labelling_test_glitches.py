@@ -1,11 +1,9 @@
 from .GS_utils import concatenate_views
-from keras import backend as K
-K.set_image_dim_ordering('th')
-from keras.models import load_model
+from .numpy_model import NumpyModel
+from . import inference_server
 from scipy.misc import imresize
-from keras.applications.vgg16 import preprocess_input
-from keras.optimizers import RMSprop
 
+import h5py
 import numpy
 import os
 
@@ -15,6 +13,120 @@ This function reads the trained ML classifier and pickle files of unlabelled gli
 file in a .csv file
 '''
 
+# models loaded in this process, keyed by absolute path,
+# each entry holding the file's mtime, the model and its class labels
+_MODEL_CACHE = {}
+
+def _cache_entry(model_name):
+    """Return the cache entry for this model file, reset if it changed
+    """
+    path = os.path.abspath(model_name)
+    mtime = os.path.getmtime(path)
+    entry = _MODEL_CACHE.get(path)
+    if entry is None or entry['mtime'] != mtime:
+        entry = {'mtime': mtime}
+        _MODEL_CACHE[path] = entry
+    return entry
+
+def get_model(model_name, backend='keras'):
+    """Load a model once per process
+
+    The model is loaded without compiling it, which is all inference needs,
+    and is kept for the life of the process. It is reloaded if the file on
+    disk is modified.
+
+    Parameters:
+
+        model_name (str):
+            Path to the saved model
+
+        backend (str, optional):
+            Default 'keras', or 'numpy' to run the model with
+            `gravityspy.ml.numpy_model.NumpyModel`
+
+    Returns:
+
+        `keras.models.Model` or `NumpyModel`
+    """
+    entry = _cache_entry(model_name)
+    if backend not in entry:
+        if backend == 'keras':
+            from keras.models import load_model
+            entry[backend] = load_model(model_name, compile=False)
+        elif backend == 'numpy':
+            entry[backend] = NumpyModel.read(model_name)
+        else:
+            raise ValueError("Do not understand supplied backend")
+    return entry[backend]
+
+def get_labels(model_name):
+    """Read the class labels stored alongside a model once per process
+
+    Parameters:
+
+        model_name (str):
+            Path to the saved model
+
+    Returns:
+
+        classes (np.array):
+            the class names in the order of the model output,
+            `None` if the file has no ``/labels/labels`` dataset
+    """
+    entry = _cache_entry(model_name)
+    if 'labels' not in entry:
+        with h5py.File(model_name, 'r') as f:
+            if '/labels/labels' in f:
+                entry['labels'] = numpy.array(
+                                      f['/labels/labels']).astype(str).T[0]
+            else:
+                entry['labels'] = None
+    return entry['labels']
+
+def get_activation_function(model_name, layers):
+    """Build once per process a function returning activations and scores
+
+    Parameters:
+
+        model_name (str):
+            Path to the saved classifier
+
+        layers (list):
+            index or name of each layer of the convolutional network
+            whose output is wanted
+
+    Returns:
+
+        function:
+            taking ``[merged_views, 0]`` and returning the output of each
+            of ``layers`` followed by the class confidences
+    """
+    from keras import backend as K
+
+    entry = _cache_entry(model_name)
+    key = ('activations',) + tuple(layers)
+    if key not in entry:
+        final_model = get_model(model_name)
+        # the convolutional network is nested as the first layer
+        cnn = final_model.layers[0]
+        if not hasattr(cnn, 'get_layer'):
+            cnn = final_model
+        outputs = []
+        for layer in layers:
+            if isinstance(layer, str):
+                outputs.append(cnn.get_layer(name=layer).output)
+            else:
+                outputs.append(cnn.get_layer(index=layer).output)
+        entry[key] = K.function([cnn.get_input_at(node_index=0),
+                                 K.learning_phase()],
+                                outputs + [final_model.output])
+    return entry[key]
+
+def clear_model_cache():
+    """Forget every model loaded by `get_model`
+    """
+    _MODEL_CACHE.clear()
+
 def main(image_data, model_adr, image_size=[140, 170], verbose=False):
     """
     Parameters
@@ -46,7 +158,8 @@ def label_glitches(image_data, model_name,
                    order_of_channels="channels_last",
                    original_order=False,
                    image_size=[140, 170],
-                   verbose=False):
+                   verbose=False,
+                   backend='keras'):
     """Obtain 1XNclasses confidence vector and label for image
 
     Parameters:
@@ -66,6 +179,9 @@ def label_glitches(image_data, model_name,
         verbose (bool, optional):
             Default False
 
+        backend (str, optional):
+            Default 'keras', or 'numpy' to score without Keras
+
     Returns:
 
         score3_unlabelled (np.array):
@@ -73,12 +189,102 @@ def label_glitches(image_data, model_name,
             index_label (int): ml label
     """
 
+    half_second_images = sorted(image_data.filter(regex=("0.5.png")).keys())
+    one_second_images = sorted(image_data.filter(regex=("1.0.png")).keys())
+    two_second_images = sorted(image_data.filter(regex=("2.0.png")).keys())
+    four_second_images = sorted(image_data.filter(regex=("4.0.png")).keys())
+
+    # read in 4 durations
+    views = numpy.stack([numpy.vstack(image_data[images].iloc[0])
+                         for images in (half_second_images, one_second_images,
+                                        two_second_images,
+                                        four_second_images)], axis=1)
+
+    confidence_array, index_label = label_views(
+                                        views, model_name,
+                                        order_of_channels=order_of_channels,
+                                        original_order=original_order,
+                                        image_size=image_size,
+                                        backend=backend,
+                                        verbose=verbose)
+
+    ids = []
+    for uid in half_second_images:
+        ids.append(uid.split('_')[1])
+
+    return confidence_array, index_label, ids, half_second_images, one_second_images, two_second_images, four_second_images
+
+def label_views(views, model_name,
+                order_of_channels="channels_last",
+                original_order=False,
+                image_size=[140, 170],
+                batch_size=64,
+                backend='keras',
+                server=None,
+                verbose=False):
+    """Obtain NXNclasses confidence vectors and labels for N events at once
+
+    Parameters:
+
+        views (`np.array`):
+            (N, 4, 140 * 170) or (N, 4, 140, 170) array holding the b/w
+            pixels of the 0.5, 1.0, 2.0 and 4.0 second views of each event
+            as determined by `read_image`
+
+        model_name (str):
+            Path to the model
+
+        order_of_channels (str, optional):
+            Default channels_last
+
+        original_order (bool, optional):
+            Default False, if True the views are merged in the order
+            0.5, 4.0, 1.0, 2.0 used by the original model
+
+        image_size (list, optional):
+            Default [140, 170]
+
+        batch_size (int, optional):
+            Default 64, how many events are merged and predicted at a time
+
+        backend (str, optional):
+            Default 'keras', or 'numpy' to score without Keras
+
+        server (str, optional):
+            Default None, address of a running
+            `gravityspy.ml.inference_server.InferenceServer` to score
+            the views on, they are scored in process if it cannot
+
+        verbose (bool, optional):
+            Default False
+
+    Returns:
+
+        confidence_array (np.array):
+            NXNclasses confidence scores per class (b/t 0 and 1)
+
+        index_label (np.array):
+            the ml label of each event
+    """
+    if server is not None:
+        confidence_array = inference_server.request(
+                               server, 'label_views', model_name, views,
+                               {'order_of_channels': order_of_channels,
+                                'original_order': original_order,
+                                'image_size': list(image_size),
+                                'backend': backend})
+        if confidence_array is not None:
+            return confidence_array, confidence_array.argmax(1)
+
     numpy.random.seed(1986)  # for reproducibility
 
     img_rows, img_cols = image_size[0], image_size[1]
 
-    # load a model and weights
-    K.set_image_data_format(order_of_channels)
+    # only the keras backend needs keras imported
+    if backend == 'keras':
+        from keras import backend as K
+        K.set_image_data_format(order_of_channels)
+
     if order_of_channels == 'channels_last':
         reshape_order = (-1, img_rows, img_cols, 1)
     elif order_of_channels == 'channels_first':
@@ -86,40 +292,237 @@ def label_glitches(image_data, model_name,
     else:
         raise ValueError("Do not understand supplied channel order")
 
-    final_model = load_model(model_name)
+    if original_order:
+        view_order = [0, 3, 1, 2]
+    else:
+        view_order = [0, 1, 2, 3]
+
+    views = numpy.asarray(views, dtype=numpy.float32)
+    views = views.reshape(views.shape[0], 4, img_rows * img_cols)
+
+    final_model = get_model(model_name, backend=backend)
+
+    confidence_array = []
+    for start in range(0, views.shape[0], batch_size):
+        batch = views[start:start + batch_size]
+        concat_test_unlabelled = concatenate_views(
+                                     *[batch[:, iview].reshape(reshape_order)
+                                       for iview in view_order],
+                                     image_size=[img_rows, img_cols],
+                                     rgb_flag=False,
+                                     order_of_channels=order_of_channels,
+                                     dtype=numpy.float32)
+        confidence_array.append(final_model.predict(concat_test_unlabelled,
+                                                    batch_size=batch_size,
+                                                    verbose=0))
+
+    confidence_array = numpy.concatenate(confidence_array)
+    index_label = confidence_array.argmax(1)
 
-    final_model.compile(loss='categorical_crossentropy',
-                        optimizer='adadelta',
-                        metrics=['accuracy'])
+    return confidence_array, index_label
+
+def compare_models(views, model_name, compressed_model_name,
+                   order_of_channels="channels_last",
+                   original_order=False,
+                   image_size=[140, 170],
+                   batch_size=64,
+                   backend='keras',
+                   verbose=False):
+    """Report how closely a compressed export reproduces the full model
+
+    Parameters:
+
+        views (`np.array`):
+            (N, 4, 140 * 170) b/w pixels of N events as in `label_views`
+
+        model_name (str):
+            Path to the full precision model
+
+        compressed_model_name (str):
+            Path to the model written by
+            `gravityspy.ml.numpy_model.export_model`, always scored
+            with the numpy backend
+
+        backend (str, optional):
+            Default 'keras', the backend scoring the full model
+
+    Returns:
+
+        report (dict):
+            ``label_agreement``, the fraction of events given the same
+            label, ``max_score_difference`` and ``mean_score_difference``,
+            the largest and mean absolute difference of the confidences,
+            and ``size_ratio``, the size of the compressed file relative
+            to the full model
+    """
+    kwargs = dict(order_of_channels=order_of_channels,
+                  original_order=original_order, image_size=image_size,
+                  batch_size=batch_size, verbose=verbose)
+    scores, labels = label_views(views, model_name, backend=backend,
+                                 **kwargs)
+    compressed_scores, compressed_labels = label_views(views,
+                                                       compressed_model_name,
+                                                       backend='numpy',
+                                                       **kwargs)
+    difference = numpy.abs(compressed_scores - scores)
+
+    return {'label_agreement': float(numpy.mean(labels == compressed_labels)),
+            'max_score_difference': float(difference.max()),
+            'mean_score_difference': float(difference.mean()),
+            'size_ratio': (float(os.path.getsize(compressed_model_name)) /
+                           os.path.getsize(model_name))}
+
+def extract_all(views, model_name, rgb_views=None, semantic_model_name=None,
+                layers=[], order_of_channels="channels_last",
+                original_order=False, image_size=[140, 170], batch_size=64,
+                backend='keras', server=None, verbose=False):
+    """Scores, labels, intermediate activations and features in one pass
+
+    The merged views of each batch are built once and pushed through the
+    classifier once, returning the requested activations alongside the
+    confidences.
+
+    Parameters:
+
+        views (`np.array`):
+            (N, 4, 140 * 170) b/w pixels of N events as in `label_views`
+
+        model_name (str):
+            Path to the classifier
+
+        rgb_views (`np.array`, optional):
+            Default None, (N, 4, 3, 140 * 170) RGB pixels of the same
+            events as in `get_views_feature_space`
+
+        semantic_model_name (str, optional):
+            Default None, path to the similarity model, features are
+            only computed if this and ``rgb_views`` are given
+
+        layers (list, optional):
+            Default [], index or name of each layer of the convolutional
+            network whose activations are wanted, e.g. [20]
+
+        order_of_channels (str, optional):
+            Default channels_last
+
+        original_order (bool, optional):
+            Default False, if True the views are merged in the order
+            0.5, 4.0, 1.0, 2.0 used by the original model
+
+        image_size (list, optional):
+            Default [140, 170]
+
+        batch_size (int, optional):
+            Default 64, how many events are merged and predicted at a time
+
+        backend (str, optional):
+            Default 'keras', or 'numpy' to score without Keras,
+            which cannot return intermediate activations
+
+        server (str, optional):
+            Default None, address of a running
+            `gravityspy.ml.inference_server.InferenceServer`, used
+            when no intermediate activations are asked for
+
+        verbose (bool, optional):
+            Default False
+
+    Returns:
+
+        confidence_array (np.array):
+            NXNclasses confidence scores per class (b/t 0 and 1)
+
+        index_label (np.array):
+            the ml label of each event
+
+        activations (dict):
+            the activations of each of ``layers`` keyed by layer
+
+        features (np.array):
+            the 200 dimensional feature space vector of each event,
+            None if no similarity model was given
+    """
+    if layers and backend != 'keras':
+        raise ValueError("Intermediate activations need the keras backend")
+
+    if not layers and (backend != 'keras' or server is not None):
+        confidence_array, index_label = label_views(
+                                            views, model_name,
+                                            order_of_channels=order_of_channels,
+                                            original_order=original_order,
+                                            image_size=image_size,
+                                            batch_size=batch_size,
+                                            backend=backend,
+                                            server=server,
+                                            verbose=verbose)
+        return (confidence_array, index_label, {},
+                _views_features(rgb_views, semantic_model_name,
+                                order_of_channels, image_size, batch_size,
+                                server, verbose))
+
+    from keras import backend as K
+
+    numpy.random.seed(1986)  # for reproducibility
+
+    img_rows, img_cols = image_size[0], image_size[1]
+
+    K.set_image_data_format(order_of_channels)
+    if order_of_channels == 'channels_last':
+        reshape_order = (-1, img_rows, img_cols, 1)
+    elif order_of_channels == 'channels_first':
+        reshape_order = (-1, 1, img_rows, img_cols)
+    else:
+        raise ValueError("Do not understand supplied channel order")
 
-    half_second_images = sorted(image_data.filter(regex=("0.5.png")).keys())
-    one_second_images = sorted(image_data.filter(regex=("1.0.png")).keys())
-    two_second_images = sorted(image_data.filter(regex=("2.0.png")).keys())
-    four_second_images = sorted(image_data.filter(regex=("4.0.png")).keys())
-    
-    # read in 4 durations
     if original_order:
-        test_set_unlabelled_x_1 = numpy.vstack(image_data[half_second_images].iloc[0]).reshape(reshape_order)
-        test_set_unlabelled_x_2 = numpy.vstack(image_data[four_second_images].iloc[0]).reshape(reshape_order)
-        test_set_unlabelled_x_3 = numpy.vstack(image_data[one_second_images].iloc[0]).reshape(reshape_order)
-        test_set_unlabelled_x_4 = numpy.vstack(image_data[two_second_images].iloc[0]).reshape(reshape_order)
+        view_order = [0, 3, 1, 2]
     else:
-        test_set_unlabelled_x_1 = numpy.vstack(image_data[half_second_images].iloc[0]).reshape(reshape_order)
-        test_set_unlabelled_x_2 = numpy.vstack(image_data[one_second_images].iloc[0]).reshape(reshape_order)
-        test_set_unlabelled_x_3 = numpy.vstack(image_data[two_second_images].iloc[0]).reshape(reshape_order)
-        test_set_unlabelled_x_4 = numpy.vstack(image_data[four_second_images].iloc[0]).reshape(reshape_order)
+        view_order = [0, 1, 2, 3]
+
+    views = numpy.asarray(views, dtype=numpy.float32)
+    views = views.reshape(views.shape[0], 4, img_rows * img_cols)
 
-    concat_test_unlabelled = concatenate_views(test_set_unlabelled_x_1,
-                            test_set_unlabelled_x_2, test_set_unlabelled_x_3, test_set_unlabelled_x_4, [img_rows, img_cols], False, order_of_channels)
+    if verbose:
+        print ('Scoring unlabelled glitches')
 
-    confidence_array = final_model.predict_proba(concat_test_unlabelled, verbose=0)
+    extract = get_activation_function(model_name, layers)
+
+    outputs = [[] for _ in range(len(layers) + 1)]
+    for start in range(0, views.shape[0], batch_size):
+        batch = views[start:start + batch_size]
+        concat_test_unlabelled = concatenate_views(
+                                     *[batch[:, iview].reshape(reshape_order)
+                                       for iview in view_order],
+                                     image_size=[img_rows, img_cols],
+                                     rgb_flag=False,
+                                     order_of_channels=order_of_channels,
+                                     dtype=numpy.float32)
+        for output, values in zip(outputs,
+                                  extract([concat_test_unlabelled, 0])):
+            output.append(values)
+
+    outputs = [numpy.concatenate(output) for output in outputs]
+    confidence_array = outputs.pop()
     index_label = confidence_array.argmax(1)
+    activations = dict(zip(layers, outputs))
 
-    ids = []
-    for uid in half_second_images:
-        ids.append(uid.split('_')[1])
+    features = _views_features(rgb_views, semantic_model_name,
+                               order_of_channels, image_size, batch_size,
+                               server, verbose)
 
-    return confidence_array, index_label, ids, half_second_images, one_second_images, two_second_images, four_second_images
+    return confidence_array, index_label, activations, features
+
+def _views_features(rgb_views, semantic_model_name, order_of_channels,
+                    image_size, batch_size, server, verbose):
+    if semantic_model_name is None or rgb_views is None:
+        return None
+    if verbose:
+        print ('Extracting features of unlabelled glitches')
+    return get_views_feature_space(rgb_views, semantic_model_name,
+                                   order_of_channels=order_of_channels,
+                                   image_size=image_size,
+                                   batch_size=batch_size, server=server,
+                                   verbose=verbose)
 
 def get_feature_space(image_data, semantic_model_name, image_size=[140, 170],
                       verbose=False):
@@ -148,7 +551,7 @@ def get_feature_space(image_data, semantic_model_name, image_size=[140, 170],
             a 200 dimensional feature space vector
     """
     img_rows, img_cols = image_size[0], image_size[1]
-    semantic_idx_model = load_model(semantic_model_name)
+    semantic_idx_model = get_model(semantic_model_name)
     test_data = image_data.filter(regex=("1.0.png")).iloc[0].iloc[0].reshape(-1, 1, img_rows, img_cols)
     test_data = test_data.reshape([test_data.shape[0], img_rows, img_cols, 1])
     test_data = numpy.repeat(test_data, 3, axis=3)
@@ -189,6 +592,79 @@ def get_multiview_feature_space(image_data, semantic_model_name,
         np.array:
             a 200 dimensional feature space vector
     """
+    half_second_images = sorted(image_data.filter(regex=("0.5.png")).keys())
+    one_second_images = sorted(image_data.filter(regex=("1.0.png")).keys())
+    two_second_images = sorted(image_data.filter(regex=("2.0.png")).keys())
+    four_second_images = sorted(image_data.filter(regex=("4.0.png")).keys())
+
+    # each cell holds the r, g and b pixels of one image
+    views = numpy.stack([numpy.vstack(image_data[images].iloc[0]).reshape(
+                             len(images), -1)
+                         for images in (half_second_images, one_second_images,
+                                        two_second_images,
+                                        four_second_images)], axis=1)
+
+    features = get_views_feature_space(views, semantic_model_name,
+                                       order_of_channels=order_of_channels,
+                                       image_size=image_size,
+                                       verbose=verbose)
+
+    ids = []
+    for uid in half_second_images:
+        ids.append(uid.split('_')[1])
+
+    return features, ids
+
+
+def get_views_feature_space(views, semantic_model_name,
+                            order_of_channels="channels_last",
+                            image_size=[140, 170], batch_size=64,
+                            server=None, verbose=False):
+    """Obtain N dimensional feature space of many samples at once
+
+    Parameters:
+
+        views (`np.array`):
+            (N, 4, 3, 140 * 170) array holding the RGB pixels of the
+            0.5, 1.0, 2.0 and 4.0 second views of each event
+            as determined by `read_image`
+
+        semantic_model_name (str):
+            Path to the similarity model
+
+        order_of_channels (str, optional):
+            Default channels_last
+
+        image_size (list, optional):
+            default [140, 170]
+
+        batch_size (int, optional):
+            Default 64, how many events are merged and predicted at a time
+
+        server (str, optional):
+            Default None, address of a running
+            `gravityspy.ml.inference_server.InferenceServer` to score
+            the views on, they are scored in process if it cannot
+
+        verbose (bool, optional):
+            default False
+
+    Returns:
+
+        np.array:
+            a 200 dimensional feature space vector per sample
+    """
+    if server is not None:
+        features = inference_server.request(
+                       server, 'features', semantic_model_name, views,
+                       {'order_of_channels': order_of_channels,
+                        'image_size': list(image_size)})
+        if features is not None:
+            return features
+
+    from keras import backend as K
+    from keras.applications.vgg16 import preprocess_input
+
     img_rows, img_cols = image_size[0], image_size[1]
 
     K.set_image_data_format(order_of_channels)
@@ -199,34 +675,34 @@ def get_multiview_feature_space(image_data, semantic_model_name,
     else:
         raise ValueError("Do not understand supplied channel order")
 
-    half_second_images = sorted(image_data.filter(regex=("0.5.png")).keys())
-    one_second_images = sorted(image_data.filter(regex=("1.0.png")).keys())
-    two_second_images = sorted(image_data.filter(regex=("2.0.png")).keys())
-    four_second_images = sorted(image_data.filter(regex=("4.0.png")).keys())
-
-    test_set_unlabelled_x_1 = numpy.vstack(image_data[half_second_images].iloc[0]).reshape(reshape_order)
-    test_set_unlabelled_x_2 = numpy.vstack(image_data[one_second_images].iloc[0]).reshape(reshape_order)
-    test_set_unlabelled_x_3 = numpy.vstack(image_data[two_second_images].iloc[0]).reshape(reshape_order)
-    test_set_unlabelled_x_4 = numpy.vstack(image_data[four_second_images].iloc[0]).reshape(reshape_order)
+    views = numpy.asarray(views, dtype=numpy.float32)
+    views = views.reshape(views.shape[0], 4, 3 * img_rows * img_cols)
 
-    concat_test_unlabelled = concatenate_views(test_set_unlabelled_x_1,
-                            test_set_unlabelled_x_2, test_set_unlabelled_x_3, test_set_unlabelled_x_4, [img_rows, img_cols], True, order_of_channels)
+    semantic_idx_model = get_model(semantic_model_name)
 
-    concat_test_unlabelled = preprocess_input(concat_test_unlabelled)
+    features = []
+    for start in range(0, views.shape[0], batch_size):
+        batch = views[start:start + batch_size]
+        concat_test_unlabelled = concatenate_views(
+                                     *[batch[:, iview].reshape(reshape_order)
+                                       for iview in range(4)],
+                                     image_size=[img_rows, img_cols],
+                                     rgb_flag=True,
+                                     order_of_channels=order_of_channels,
+                                     dtype=numpy.float32)
 
-    ids = []
-    for uid in half_second_images:
-        ids.append(uid.split('_')[1])
+        concat_test_unlabelled = preprocess_input(concat_test_unlabelled)
 
-    semantic_idx_model = load_model(semantic_model_name)
-    features = semantic_idx_model.predict([concat_test_unlabelled])
+        features.append(semantic_idx_model.predict([concat_test_unlabelled],
+                                                   batch_size=batch_size))
 
-    return features, ids
+    return numpy.concatenate(features)
 
 
 def get_deeplayer(image_data, model_name, image_size=[140, 170],
+                  order_of_channels="channels_last", original_order=True,
                   verbose=False):
-    """Obtain 1XNclasses confidence vector and label for image
+    """Obtain 1XNclasses confidence vector, label and layer 20 activations
 
     Parameters:
 
@@ -242,6 +718,14 @@ def get_deeplayer(image_data, model_name, image_size=[140, 170],
         image_size (list, optional):
             Default [140, 170]
 
+        order_of_channels (str, optional):
+            Default channels_last, as in `label_glitches`, the views
+            used to be reshaped channels_first under the 'th' ordering
+            importing `gravityspy.ml` set
+
+        original_order (bool, optional):
+            Default True, merge the views in the order 0.5, 4.0, 1.0, 2.0
+
         verbose (bool, optional):
             Default False
 
@@ -251,55 +735,27 @@ def get_deeplayer(image_data, model_name, image_size=[140, 170],
             confidence scores per class (b/t 0 and 1)
             index_label (int): ml label
     """
-
-    numpy.random.seed(1986)  # for reproducibility
-
-    img_rows, img_cols = image_size[0], image_size[1]
-
-    # load a model and weights
-    if verbose:
-        print ('Retrieving the trained ML classifier')
-    final_model = load_model(model_name)
-
-    final_model.compile(loss='categorical_crossentropy',
-                        optimizer='adadelta',
-                        metrics=['accuracy'])
-
-    if verbose:
-        print ('Scoring unlabelled glitches')
-
     half_second_images = sorted(image_data.filter(regex=("0.5.png")).keys())
     one_second_images = sorted(image_data.filter(regex=("1.0.png")).keys())
     two_second_images = sorted(image_data.filter(regex=("2.0.png")).keys())
     four_second_images = sorted(image_data.filter(regex=("4.0.png")).keys())
 
     # read in 4 durations
-    test_set_unlabelled_x_1 = numpy.vstack(image_data[half_second_images].iloc[0].values)
-    test_set_unlabelled_x_1 = test_set_unlabelled_x_1.reshape(-1, 1, img_rows, img_cols)
-
-    test_set_unlabelled_x_2 = numpy.vstack(image_data[four_second_images].iloc[0].values)
-    test_set_unlabelled_x_2 = test_set_unlabelled_x_2.reshape(-1, 1, img_rows, img_cols)
-
-    test_set_unlabelled_x_3 = numpy.vstack(image_data[one_second_images].iloc[0].values)
-    test_set_unlabelled_x_3 = test_set_unlabelled_x_3.reshape(-1, 1, img_rows, img_cols)
-
-    test_set_unlabelled_x_4 = numpy.vstack(image_data[two_second_images].iloc[0].values)
-    test_set_unlabelled_x_4 = test_set_unlabelled_x_4.reshape(-1, 1, img_rows, img_cols)
-
-    concat_test_unlabelled = concatenate_views(test_set_unlabelled_x_1,
-                            test_set_unlabelled_x_2, test_set_unlabelled_x_3, test_set_unlabelled_x_4, [img_rows, img_cols], False)
-
-    feature_exc1 = K.function([final_model.layers[0].get_input_at(node_index=0),
-                K.learning_phase()],
-               [final_model.layers[0].get_layer(index=20).output])
-
-    deeplayer = feature_exc1([concat_test_unlabelled, 0])[0]
+    views = numpy.stack([numpy.vstack(image_data[images].iloc[0])
+                         for images in (half_second_images, one_second_images,
+                                        two_second_images,
+                                        four_second_images)], axis=1)
+
+    confidence_array, index_label, activations, _ = extract_all(
+        views, model_name, layers=[20],
+        order_of_channels=order_of_channels,
+        original_order=original_order,
+        image_size=image_size,
+        verbose=verbose)
+    deeplayer = activations[20]
 
     ids = []
     for uid in half_second_images:
         ids.append(uid.split('_')[1])
 
-    confidence_array = final_model.predict_proba(concat_test_unlabelled, verbose=0)
-    index_label = confidence_array.argmax(1)
-
     return confidence_array, index_label, deeplayer, ids, half_second_images, one_second_images, two_second_images, four_second_images
@@ -0,0 +1,351 @@
+"""Run the Gravity Spy classifier with NumPy alone
+
+`export_model` reads the architecture and weights of a model saved by
+Keras (e.g. by ``bin/trainmodel``) straight from the h5 file, and
+`NumpyModel` runs its forward pass with NumPy, so scoring needs neither
+Keras nor its backend. The layers used by `GS_utils.build_cnn` and the
+softmax head put on top of it are supported.
+
+The exported kernels can be stored compressed, as float16 or as int8
+with one scale per output channel, which shrinks the file by a factor of
+2 or 4. This is compressed storage only: the kernels are expanded back
+to float32 when read and the forward pass runs in float32, as NumPy has
+no float16 or int8 BLAS to make the arithmetic itself cheaper. Scoring
+is therefore as fast as with an uncompressed export, and the scores move
+by the rounding of the stored kernels, see
+`labelling_test_glitches.compare_models`.
+"""
+import json
+
+import h5py
+import numpy
+
+SUPPORTED_LAYERS = ['Conv2D', 'Activation', 'MaxPooling2D', 'Dropout',
+                    'Flatten', 'Dense']
+
+STORAGE_DTYPES = ['float32', 'float16', 'int8']
+
+
+class NumpyModel(object):
+    """A Keras `Sequential` classifier evaluated with NumPy
+
+    Parameters:
+
+        layers (list):
+            (class_name, config, weights) of every layer in order,
+            as returned by `read_keras_model`
+
+        labels (array, optional):
+            Default None, the class names of the model output
+    """
+    def __init__(self, layers, labels=None):
+        for class_name, _, _ in layers:
+            if class_name not in SUPPORTED_LAYERS:
+                raise ValueError('Layer {0} is not supported'.format(
+                                                                class_name))
+        self.layers = layers
+        self.labels = labels
+
+    @classmethod
+    def read(cls, filename):
+        """Read a model saved by Keras or by `export_model`
+
+        Parameters:
+
+            filename (str):
+                path to the h5 file
+
+        Returns:
+
+            `NumpyModel`
+        """
+        with h5py.File(filename, 'r') as f:
+            if 'model_config' in f.attrs:
+                layers = read_keras_model(f)
+            else:
+                layers = _read_exported_layers(f)
+            labels = None
+            if '/labels/labels' in f:
+                labels = numpy.array(f['/labels/labels']).astype(str).T[0]
+        return cls(layers, labels=labels)
+
+    def predict(self, x, batch_size=32, verbose=0):
+        """Class confidences of each sample, like `keras.Model.predict`
+
+        Parameters:
+
+            x (`numpy.ndarray`):
+                the merged views laid out as the model was trained,
+                channels_last or channels_first
+
+            batch_size (int, optional):
+                Default 32
+
+        Returns:
+
+            `numpy.ndarray` of shape (N, Nclasses)
+        """
+        x = numpy.asarray(x, dtype=numpy.float32)
+        output = []
+        for start in range(0, x.shape[0], batch_size):
+            output.append(self._forward(x[start:start + batch_size]))
+        return numpy.concatenate(output)
+
+    predict_proba = predict
+
+    def _forward(self, x):
+        # everything runs channels_last, the layout of the stored kernels
+        data_format = None
+        for class_name, config, weights in self.layers:
+            if data_format is None and 'data_format' in config:
+                data_format = config['data_format']
+                if data_format == 'channels_first':
+                    x = x.transpose(0, 2, 3, 1)
+
+            if class_name == 'Conv2D':
+                x = _conv2d(x, weights[0], config)
+                if config.get('use_bias', True):
+                    x += weights[1]
+                x = _activation(x, config.get('activation', 'linear'))
+            elif class_name == 'Activation':
+                x = _activation(x, config['activation'])
+            elif class_name == 'MaxPooling2D':
+                x = _max_pool(x, config)
+            elif class_name == 'Flatten':
+                if data_format == 'channels_first':
+                    x = x.transpose(0, 3, 1, 2)
+                x = x.reshape(x.shape[0], -1)
+            elif class_name == 'Dense':
+                x = numpy.dot(x, weights[0])
+                if config.get('use_bias', True):
+                    x += weights[1]
+                x = _activation(x, config.get('activation', 'linear'))
+            # Dropout does nothing at inference
+        return x
+
+
+def read_keras_model(f):
+    """Read the layers of a `Sequential` model saved by Keras
+
+    Nested `Sequential` models are flattened into one list of layers.
+
+    Parameters:
+
+        f (`h5py.File`):
+            the file written by `keras.models.Model.save`
+
+    Returns:
+
+        list of (class_name, config, weights) tuples
+    """
+    model_config = f.attrs['model_config']
+    if isinstance(model_config, bytes):
+        model_config = model_config.decode('utf-8')
+    model_config = json.loads(model_config)
+
+    backend = f.attrs.get('backend', b'tensorflow')
+    if isinstance(backend, bytes):
+        backend = backend.decode('utf-8')
+
+    # every weight of every (possibly nested) layer, keyed by layer name
+    weights = {}
+    model_weights = f['model_weights']
+    for group_name in model_weights.attrs['layer_names']:
+        if isinstance(group_name, bytes):
+            group_name = group_name.decode('utf-8')
+        group = model_weights[group_name]
+        for weight_name in group.attrs['weight_names']:
+            if isinstance(weight_name, bytes):
+                weight_name = weight_name.decode('utf-8')
+            layer_name = weight_name.split('/')[-2]
+            weights.setdefault(layer_name, []).append(
+                numpy.asarray(group[weight_name], dtype=numpy.float32))
+
+    layers = []
+    for class_name, config in _flatten_layers(model_config):
+        layer_weights = weights.get(config.get('name'), [])
+        # theano convolves with flipped kernels, numpy correlates
+        if class_name == 'Conv2D' and backend == 'theano':
+            layer_weights[0] = layer_weights[0][::-1, ::-1].copy()
+        layers.append((class_name, config, layer_weights))
+
+    return layers
+
+
+def export_model(model_name, filename, storage_dtype='float32'):
+    """Write a Keras model out in the format read by `NumpyModel`
+
+    Only h5py is needed to read the exported file back.
+
+    Parameters:
+
+        model_name (str):
+            path to the model saved by Keras
+
+        filename (str):
+            path to the h5 file to write
+
+        storage_dtype (str, optional):
+            Default 'float32', 'float16' or 'int8' to store the kernels
+            of the Conv2D and Dense layers compressed, biases are kept
+            in float32, everything is computed in float32
+
+    Returns:
+
+        `NumpyModel`
+    """
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError('Do not understand supplied storage_dtype, '
+                         'choose one of {0}'.format(STORAGE_DTYPES))
+    model = NumpyModel.read(model_name)
+    _write_layers(model.layers, filename, labels=model.labels,
+                  storage_dtype=storage_dtype)
+    return model
+
+
+def compress_kernel(weight, storage_dtype):
+    """Round a kernel whose last axis runs over the output channels
+
+    Parameters:
+
+        weight (`numpy.ndarray`):
+            the float32 kernel
+
+        storage_dtype (str):
+            'float32', 'float16' or 'int8'
+
+    Returns:
+
+        values, scale (`numpy.ndarray`):
+            the stored values and, for int8, the float32 scale of each
+            output channel, so that ``weight ~= values * scale``,
+            otherwise None
+    """
+    if storage_dtype != 'int8':
+        return weight.astype(storage_dtype), None
+    # symmetric, one scale per output channel
+    scale = numpy.abs(weight.reshape(-1, weight.shape[-1])).max(axis=0) / 127.
+    scale[scale == 0] = 1.
+    values = numpy.clip(numpy.round(weight / scale), -127, 127)
+    return values.astype(numpy.int8), scale.astype(numpy.float32)
+
+
+def _write_layers(layers, filename, labels=None, storage_dtype='float32'):
+    with h5py.File(filename, 'w') as f:
+        group = f.create_group('layers')
+        group.attrs['nlayers'] = len(layers)
+        for idx, (class_name, config, weights) in enumerate(layers):
+            layer = group.create_group(str(idx))
+            layer.attrs['class_name'] = class_name
+            layer.attrs['config'] = json.dumps(config)
+            for iweight, weight in enumerate(weights):
+                scale = None
+                if weight.ndim > 1:
+                    weight, scale = compress_kernel(weight, storage_dtype)
+                dataset = layer.create_dataset(str(iweight), data=weight)
+                if scale is not None:
+                    dataset.attrs['scale'] = scale
+        if labels is not None:
+            f.create_group('labels').create_dataset(
+                'labels', (len(labels), 1), 'S100',
+                [[label.encode('utf-8')] for label in labels])
+
+
+def _read_exported_layers(f):
+    layers = []
+    group = f['layers']
+    for idx in range(group.attrs['nlayers']):
+        layer = group[str(idx)]
+        class_name = layer.attrs['class_name']
+        if isinstance(class_name, bytes):
+            class_name = class_name.decode('utf-8')
+        config = layer.attrs['config']
+        if isinstance(config, bytes):
+            config = config.decode('utf-8')
+        weights = []
+        for iweight in range(len(layer)):
+            dataset = layer[str(iweight)]
+            # compressed kernels are expanded, the arithmetic is float32
+            weight = numpy.asarray(dataset, dtype=numpy.float32)
+            if 'scale' in dataset.attrs:
+                weight *= dataset.attrs['scale']
+            weights.append(weight)
+        layers.append((class_name, json.loads(config), weights))
+    return layers
+
+
+def _flatten_layers(model_config):
+    """Yield (class_name, config) of each layer, descending into models
+    """
+    config = model_config['config']
+    if isinstance(config, dict):
+        # keras >= 2.2 keeps the layers under a 'layers' key
+        config = config['layers']
+    for layer in config:
+        if layer['class_name'] in ('Sequential', 'Model'):
+            for sublayer in _flatten_layers(layer):
+                yield sublayer
+        elif layer['class_name'] != 'InputLayer':
+            yield layer['class_name'], layer['config']
+
+
+def _conv2d(x, kernel, config):
+    """Cross-correlate channels_last images with a (kh, kw, in, out) kernel
+
+    Rather than building the full im2col matrix, whose size is
+    kh * kw times that of the input, each kernel tap is applied as one
+    BLAS matrix product over every pixel and the products are summed.
+    """
+    kh, kw = kernel.shape[:2]
+    sh, sw = config.get('strides', (1, 1))
+    if config.get('padding', 'valid') == 'same':
+        nrows = -(-x.shape[1] // sh)
+        ncols = -(-x.shape[2] // sw)
+        pad_rows = max((nrows - 1) * sh + kh - x.shape[1], 0)
+        pad_cols = max((ncols - 1) * sw + kw - x.shape[2], 0)
+        x = numpy.pad(x, ((0, 0), (pad_rows // 2, pad_rows - pad_rows // 2),
+                          (pad_cols // 2, pad_cols - pad_cols // 2), (0, 0)),
+                      mode='constant')
+    nrows = (x.shape[1] - kh) // sh + 1
+    ncols = (x.shape[2] - kw) // sw + 1
+
+    output = numpy.zeros((x.shape[0], nrows, ncols, kernel.shape[3]),
+                         dtype=numpy.float32)
+    for row in range(kh):
+        for col in range(kw):
+            patch = x[:, row:row + (nrows - 1) * sh + 1:sh,
+                      col:col + (ncols - 1) * sw + 1:sw, :]
+            output += numpy.dot(patch, kernel[row, col])
+    return output
+
+
+def _max_pool(x, config):
+    ph, pw = config.get('pool_size', (2, 2))
+    sh, sw = config.get('strides') or (ph, pw)
+    if config.get('padding', 'valid') != 'valid':
+        raise ValueError('Only valid max pooling is supported')
+    nrows = (x.shape[1] - ph) // sh + 1
+    ncols = (x.shape[2] - pw) // sw + 1
+    output = None
+    for row in range(ph):
+        for col in range(pw):
+            patch = x[:, row:row + (nrows - 1) * sh + 1:sh,
+                      col:col + (ncols - 1) * sw + 1:sw, :]
+            output = patch.copy() if output is None else numpy.maximum(
+                                                             output, patch)
+    return output
+
+
+def _activation(x, activation):
+    if activation == 'linear':
+        return x
+    elif activation == 'relu':
+        return numpy.maximum(x, 0)
+    elif activation == 'softmax':
+        x = numpy.exp(x - x.max(axis=-1, keepdims=True))
+        return x / x.sum(axis=-1, keepdims=True)
+    elif activation == 'sigmoid':
+        return 1. / (1. + numpy.exp(-x))
+    elif activation == 'tanh':
+        return numpy.tanh(x)
+    raise ValueError('Activation {0} is not supported'.format(activation))
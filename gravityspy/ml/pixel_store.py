@@ -0,0 +1,360 @@
+"""Columnar storage of pixelized training set images
+
+Rather than pickling a `pandas.DataFrame` whose cells each hold the pixels
+of one image, every duration is kept in its own fixed-shape float32 HDF5
+dataset, alongside ``gravityspy_id`` and ``true_label`` columns, one row per
+sample. Rows can be appended and read back in any order without loading
+the rest of the file.
+
+`pixelize_trainingset` fills grayscale and/or RGB stores from a folder of
+training set images, decoding each image once in a pool of processes.
+"""
+from gwpy.utils import mp as mp_utils
+
+from gravityspy.utils import log
+from . import read_image
+
+import h5py
+import numpy
+import os
+
+DURATIONS = ['0.5.png', '1.0.png', '2.0.png', '4.0.png']
+SCALAR_CHUNK_SIZE = 4096
+DENSE_READ_FRACTION = 0.5
+
+
+class PixelStore(object):
+    """An HDF5 file of pixelized samples keyed by ``gravityspy_id``
+
+    Parameters:
+
+        filename (str):
+            path to the HDF5 file
+
+        mode (str, optional):
+            Default 'r', any mode understood by `h5py.File`
+    """
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        if 'gravityspy_id' not in self.file:
+            return 0
+        return self.file['gravityspy_id'].shape[0]
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def columns(self):
+        """The pixel columns held in this store
+        """
+        return [column for column in DURATIONS if column in self.file]
+
+    @property
+    def gravityspy_id(self):
+        return self.file['gravityspy_id'][:].astype(str)
+
+    @property
+    def true_label(self):
+        return self.file['true_label'][:].astype(str)
+
+    def append(self, pixels, gravityspy_id, true_label):
+        """Add samples to the end of the store
+
+        Once the store holds samples, every append must supply the
+        same columns.
+
+        Parameters:
+
+            pixels (dict):
+                maps each duration, e.g. '0.5.png', to an array whose
+                first axis runs over the samples
+
+            gravityspy_id (list):
+                the ID of each sample
+
+            true_label (list):
+                the label of each sample
+        """
+        gravityspy_id = numpy.asarray(gravityspy_id, dtype='S100')
+        true_label = numpy.asarray(true_label, dtype='S100')
+        nb_samples = len(gravityspy_id)
+        start = len(self)
+
+        columns = dict((column, numpy.asarray(values, dtype=numpy.float32))
+                       for column, values in pixels.items())
+        columns['gravityspy_id'] = gravityspy_id
+        columns['true_label'] = true_label
+
+        if start:
+            stored = set(self.columns + ['gravityspy_id', 'true_label'])
+            if set(columns) != stored:
+                raise ValueError('This store holds the columns {0} but {1} '
+                                 'were given'.format(sorted(stored),
+                                                     sorted(columns)))
+
+        for column, values in columns.items():
+            if len(values) != nb_samples:
+                raise ValueError('Column {0} has {1} rows but {2} samples '
+                                 'were given'.format(column, len(values),
+                                                     nb_samples))
+            if column not in self.file:
+                # a chunk per image, but large chunks for the scalar columns
+                chunks = ((1,) + values.shape[1:] if values.ndim > 1
+                          else (SCALAR_CHUNK_SIZE,))
+                self.file.create_dataset(column, data=values,
+                                         maxshape=(None,) + values.shape[1:],
+                                         chunks=chunks)
+            else:
+                dataset = self.file[column]
+                dataset.resize(start + nb_samples, axis=0)
+                dataset[start:] = values
+
+    def read(self, column, index=None):
+        """Read the pixels of some or all samples
+
+        Parameters:
+
+            column (str):
+                the duration to read, e.g. '0.5.png'
+
+            index (array, optional):
+                Default None, the rows to read in any order,
+                if None all rows are read
+
+        Returns:
+
+            pixels (`numpy.ndarray`):
+                float32 array with one row per requested sample
+        """
+        dataset = self.file[column]
+        if index is None:
+            return dataset[:]
+
+        # h5py only reads increasing, unique rows
+        rows, inverse = numpy.unique(numpy.asarray(index, dtype=int),
+                                     return_inverse=True)
+        if not len(rows):
+            return numpy.empty((0,) + dataset.shape[1:], dtype=dataset.dtype)
+
+        # h5py fancy indexing is slow for many rows, so when they cover
+        # most of their span read the whole span and index it in numpy
+        start, stop = rows[0], rows[-1] + 1
+        if len(rows) >= DENSE_READ_FRACTION * (stop - start):
+            return dataset[start:stop][rows[inverse] - start]
+        return dataset[rows][inverse]
+
+    def to_pandas(self):
+        """The ID and label columns as a `pandas.DataFrame`
+
+        The pixels are left on disk, the index of each row is its
+        position in the store.
+        """
+        import pandas
+        return pandas.DataFrame({'gravityspy_id': self.gravityspy_id,
+                                 'true_label': self.true_label})
+
+    @classmethod
+    def from_pandas(cls, data, filename):
+        """Convert a pickled training set `pandas.DataFrame` to a store
+
+        Parameters:
+
+            data (`pandas.DataFrame`):
+                as made by ``pickle_trainingset``
+
+            filename (str):
+                path of the HDF5 file to write
+
+        Returns:
+
+            `PixelStore` opened for appending
+        """
+        store = cls(filename, mode='w')
+        store.append(dict((column, numpy.stack(data[column].values))
+                          for column in DURATIONS if column in data),
+                     data['gravityspy_id'].values,
+                     data['true_label'].values)
+        return store
+
+
+def read_column(data, column, index):
+    """Read one duration of some samples from a store or `pandas.DataFrame`
+
+    Parameters:
+
+        data (`PixelStore`, `pandas.DataFrame`):
+            the training set
+
+        column (str):
+            the duration to read, e.g. '0.5.png'
+
+        index (array):
+            positions of the samples to read
+
+    Returns:
+
+        pixels (`numpy.ndarray`)
+    """
+    if isinstance(data, PixelStore):
+        return data.read(column, index)
+    return numpy.vstack(data[column].values[numpy.asarray(index, dtype=int)])
+
+
+def pixelize_trainingset(path_to_trainingset, grayscale_file=None,
+                         rgb_file=None, nproc=1, chunk_size=256,
+                         resolution=0.3, verbose=False):
+    """Pixelize a training set into grayscale and/or RGB `PixelStore` files
+
+    Every image is decoded once, even if both variants are asked for.
+    Samples are pixelized ``chunk_size`` at a time across ``nproc``
+    processes and each chunk is written to the stores as one block.
+
+    Parameters:
+
+        path_to_trainingset (str):
+            Path to trainingset where format of training set folder
+            is "somedirectoryname"/"classname/"images"
+
+        grayscale_file (str, optional):
+            Default None, HDF5 file to save the grayscale pixels to
+
+        rgb_file (str, optional):
+            Default None, HDF5 file to save the RGB pixels to
+
+        nproc (int, optional):
+            Default 1, number of processes decoding images
+
+        chunk_size (int, optional):
+            Default 256, number of samples held in memory at once
+
+        resolution (float, optional):
+            Default 0.3
+
+        verbose (bool, optional):
+            Default False
+
+    Returns:
+
+        grayscale_store, rgb_store (`PixelStore`):
+            None for any variant that was not asked for
+    """
+    if grayscale_file is None and rgb_file is None:
+        raise ValueError('Please supply a grayscale_file and/or an rgb_file')
+
+    logger = log.Logger('Gravity Spy: Pixelizing Trainingset')
+
+    samples = _list_samples(path_to_trainingset)
+    logger.info('Found {0} samples in {1} classes'.format(
+        len(samples), len(set(sample[0] for sample in samples))))
+
+    stores = []
+    for filename in (grayscale_file, rgb_file):
+        if filename is None:
+            stores.append(None)
+            continue
+        if os.path.dirname(filename) and not os.path.exists(
+                os.path.dirname(filename)):
+            if verbose:
+                logger.info('making... ' + os.path.dirname(filename))
+            os.makedirs(os.path.dirname(filename))
+        stores.append(PixelStore(filename, mode='w'))
+    grayscale_store, rgb_store = stores
+
+    for start in range(0, len(samples), chunk_size):
+        chunk = samples[start:start + chunk_size]
+        inputs = ((sample[2], grayscale_store is not None,
+                   rgb_store is not None, resolution, nproc)
+                  for sample in chunk)
+
+        output = mp_utils.multiprocess_with_queues(nproc,
+                                                   _pixelize_sample,
+                                                   inputs)
+
+        grayscale_pixels = {}
+        rgb_pixels = {}
+        # raise exceptions (from multiprocessing, single process raises inline)
+        for isample, (images, x) in enumerate(output):
+            if isinstance(x, Exception):
+                x.args = ('Failed to pixelize %s: %s' % (images[0],
+                                                        str(x)),)
+                raise x
+            for pixels, views in zip((grayscale_pixels, rgb_pixels), x):
+                for duration, view in views:
+                    if duration not in pixels:
+                        pixels[duration] = numpy.empty(
+                                               (len(chunk),) + view.shape,
+                                               dtype=numpy.float32)
+                    pixels[duration][isample] = view
+
+        ids = [sample[1] for sample in chunk]
+        labels = [sample[0] for sample in chunk]
+        if grayscale_store is not None:
+            grayscale_store.append(grayscale_pixels, ids, labels)
+        if rgb_store is not None:
+            rgb_store.append(rgb_pixels, ids, labels)
+
+        logger.info('Pixelized {0} of {1} samples'.format(
+            start + len(chunk), len(samples)))
+
+    return grayscale_store, rgb_store
+
+
+def _list_samples(path_to_trainingset):
+    """Group the images of a training set folder into samples
+
+    Returns:
+
+        a list of (true_label, gravityspy_id, images) tuples,
+        where images lists the paths to the 4 durations of a sample
+    """
+    samples = []
+    for iclass in sorted(os.listdir(path_to_trainingset)):
+        images = sorted(os.listdir(os.path.join(path_to_trainingset, iclass)))
+        images = [imageidx for imageidx in images
+                  if 'L1_' in imageidx or 'H1_' in imageidx or 'V1_' in imageidx]
+        # Group each sample into sets of 4 different durations
+        for isample in zip(*(iter(images),) * 4):
+            samples.append((iclass, isample[-1].split('_')[1],
+                            [os.path.join(path_to_trainingset, iclass, idur)
+                             for idur in isample]))
+    return samples
+
+
+def _pixelize_sample(inputs):
+    images = inputs[0]
+    grayscale = inputs[1]
+    rgb = inputs[2]
+    resolution = inputs[3]
+    nproc = inputs[4]
+
+    try:
+        grayscale_views = []
+        rgb_views = []
+        for image in images:
+            duration = image.split('_')[-1]
+            image_data = read_image.read_and_crop_image(image, x=[66, 532],
+                                                        y=[105, 671])
+            if grayscale:
+                grayscale_views.append((duration,
+                                        read_image._pixelize_grayscale(
+                                            image_data, resolution)))
+            if rgb:
+                rgb_views.append((duration,
+                                  numpy.stack(read_image._pixelize_rgb(
+                                      image_data, resolution))))
+
+        return images, (grayscale_views, rgb_views)
+    except Exception as exc:  # pylint: disable=broad-except
+        if nproc == 1:
+            raise
+        else:
+            return images, exc
@@ -0,0 +1,339 @@
+"""Compact storage and search of the similarity features
+
+`ProductQuantizer` splits each unit-normalised feature vector into
+``nsubspaces`` equal slices and replaces each slice by the index of the
+nearest of 256 centroids trained for that slice, so a 200 dimensional
+float64 vector of 1600 bytes is stored as ``nsubspaces`` uint8 codes.
+The codebooks are saved in an HDF5 group, which can live in the file of
+the semantic model itself.
+
+`PQIndex` scans the codes of a whole catalogue with asymmetric distance
+computation: the queries stay exact and only the stored vectors are
+quantized. Each query gets a lookup table of its inner products with the
+``ncentroids`` centroids of every slice, and the similarity of a code is
+the sum over slices of the table entries it points to. That is
+``nsubspaces`` additions per code rather than ``ndim`` multiply-adds.
+For batches of more than `LOOKUP_MAX_QUERIES` queries, one BLAS product
+of the queries with the decoded codes is faster in NumPy than the
+gathers, and gives the same similarities.
+
+Measured on one core for 200000 vectors of dimension 200 in 50 slices,
+the time in seconds of a top-10 search was:
+
+    ========  =====  ==============  ===============
+    queries   exact  decode + BLAS   lookup tables
+    ========  =====  ==============  ===============
+    1         0.055  0.33            0.045
+    8         0.11   0.34            0.19
+    16        0.17   0.37            0.51
+    256       2.1    1.7             9.3
+    ========  =====  ==============  ===============
+
+where exact is `ExactIndex.search` over the float32 features. So for
+a few queries the scan is about as fast as the exact scan. The
+gain is in memory: the codes take 50 bytes per event rather than the 800
+bytes of float32 features.
+"""
+import h5py
+import numpy
+
+from .similarity_index import blocked_top_k, feature_columns, _normalise
+
+CODE_PREFIX = 'pq_'
+
+LOOKUP_MAX_QUERIES = 8
+
+
+class ProductQuantizer(object):
+    """Codebooks quantizing feature vectors into uint8 codes
+
+    Parameters:
+
+        nsubspaces (int, optional):
+            Default 50, number of slices each vector is split into,
+            which must divide its dimension
+
+        ncentroids (int, optional):
+            Default 256, number of centroids per slice, at most 256
+
+        random_state (int, optional):
+            Default 30, seed of the k-means training the codebooks
+    """
+    def __init__(self, nsubspaces=50, ncentroids=256, random_state=30):
+        if ncentroids > 256:
+            raise ValueError('Codes are stored as uint8, '
+                             'ncentroids must be at most 256')
+        self.nsubspaces = nsubspaces
+        self.ncentroids = ncentroids
+        self.random_state = random_state
+        self.codebooks = None
+
+    @property
+    def is_trained(self):
+        return self.codebooks is not None
+
+    def train(self, vectors, niter=20, max_samples=32768):
+        """Train the codebook of each slice by k-means
+
+        Parameters:
+
+            vectors (`numpy.ndarray`):
+                (N, ndim) feature vectors representative of the data
+
+            niter (int, optional):
+                Default 20, number of k-means iterations
+
+            max_samples (int, optional):
+                Default 32768, train on a random subset of this many
+                vectors
+        """
+        vectors = self._split(_normalise(vectors))
+        rng = numpy.random.RandomState(self.random_state)
+        if len(vectors) > max_samples:
+            vectors = vectors[rng.choice(len(vectors), max_samples,
+                                         replace=False)]
+        ncentroids = min(self.ncentroids, len(vectors))
+        self.codebooks = numpy.stack([
+            _kmeans(numpy.ascontiguousarray(vectors[:, subspace]),
+                    ncentroids, niter, rng)
+            for subspace in range(self.nsubspaces)])
+
+    def encode(self, vectors, chunk_size=65536):
+        """Quantize feature vectors
+
+        Parameters:
+
+            vectors (`numpy.ndarray`):
+                (N, ndim) feature vectors
+
+        Returns:
+
+            codes (`numpy.ndarray`):
+                (N, nsubspaces) uint8 array
+        """
+        if not self.is_trained:
+            raise ValueError('This quantizer has not been trained')
+        codes = numpy.empty((len(vectors), self.nsubspaces), dtype=numpy.uint8)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = self._split(_normalise(vectors[start:start + chunk_size]))
+            for subspace in range(self.nsubspaces):
+                codes[start:start + chunk_size, subspace] = _nearest(
+                    chunk[:, subspace], self.codebooks[subspace])
+        return codes
+
+    def decode(self, codes):
+        """The unit vectors approximated by some codes
+
+        Parameters:
+
+            codes (`numpy.ndarray`):
+                (N, nsubspaces) codes as made by `encode`
+
+        Returns:
+
+            `numpy.ndarray` of shape (N, ndim)
+        """
+        # look every slice up at once in the stacked codebooks
+        nsubspaces, ncentroids, ndim = self.codebooks.shape
+        lookup = (numpy.asarray(codes, dtype=numpy.intp) +
+                  numpy.arange(nsubspaces) * ncentroids)
+        return self.codebooks.reshape(-1, ndim)[lookup].reshape(
+                   len(lookup), -1)
+
+    def save(self, filename, path='product_quantizer'):
+        """Write the codebooks to a group of an HDF5 file
+
+        The file is appended to, so the codebooks can be kept in the
+        file of the semantic model they were trained for.
+        """
+        with h5py.File(filename, 'a') as f:
+            if path in f:
+                del f[path]
+            group = f.create_group(path)
+            group.attrs['nsubspaces'] = self.nsubspaces
+            group.attrs['ncentroids'] = self.ncentroids
+            group.attrs['random_state'] = self.random_state
+            group.create_dataset('codebooks', data=self.codebooks)
+
+    @classmethod
+    def read(cls, filename, path='product_quantizer'):
+        """Read codebooks written by `save`
+        """
+        with h5py.File(filename, 'r') as f:
+            group = f[path]
+            quantizer = cls(nsubspaces=int(group.attrs['nsubspaces']),
+                            ncentroids=int(group.attrs['ncentroids']),
+                            random_state=int(group.attrs['random_state']))
+            quantizer.codebooks = group['codebooks'][:]
+        return quantizer
+
+    def to_events(self, events):
+        """Replace the feature columns of a table by code columns
+
+        Parameters:
+
+            events (`Events`):
+                with columns '0', '1', ... holding the features
+
+        Returns:
+
+            `Events` with ``pq_0``, ``pq_1``, ... uint8 columns instead
+        """
+        codes = self.encode(feature_columns(events))
+        events = events.copy()
+        events.remove_columns([column for column in events.keys()
+                               if str(column).isdigit()])
+        for subspace in range(self.nsubspaces):
+            events['{0}{1}'.format(CODE_PREFIX, subspace)] = codes[:, subspace]
+        return events
+
+    def _split(self, vectors):
+        ndim = vectors.shape[1]
+        if ndim % self.nsubspaces:
+            raise ValueError('{0} subspaces do not divide vectors of '
+                             'dimension {1}'.format(self.nsubspaces, ndim))
+        return vectors.reshape(len(vectors), self.nsubspaces, -1)
+
+
+class PQIndex(object):
+    """Approximate top-k cosine search over product-quantized codes
+
+    Parameters:
+
+        quantizer (`ProductQuantizer`):
+            the codebooks the codes were made with
+
+        codes (`numpy.ndarray`):
+            (N, nsubspaces) uint8 codes
+
+        gravityspy_id (list):
+            the ID of each code
+    """
+    def __init__(self, quantizer, codes, gravityspy_id):
+        self.quantizer = quantizer
+        self.codes = numpy.ascontiguousarray(codes, dtype=numpy.uint8)
+        self.gravityspy_id = numpy.asarray(gravityspy_id, dtype='S100')
+        if len(self.codes) != len(self.gravityspy_id):
+            raise ValueError('Got {0} codes but {1} ids'.format(
+                len(self.codes), len(self.gravityspy_id)))
+
+    def __len__(self):
+        return len(self.gravityspy_id)
+
+    @classmethod
+    def from_events(cls, quantizer, events):
+        """Build an index from a table of codes or of features
+
+        Parameters:
+
+            quantizer (`ProductQuantizer`):
+                the codebooks
+
+            events (`Events`, `pandas.DataFrame`):
+                with ``pq_0``, ``pq_1``, ... columns as made by
+                `ProductQuantizer.to_events`, or with feature columns
+                '0', '1', ... which are encoded, and a ``gravityspy_id``
+                column
+        """
+        columns = ['{0}{1}'.format(CODE_PREFIX, subspace)
+                   for subspace in range(quantizer.nsubspaces)]
+        if all(column in events.keys() for column in columns):
+            codes = numpy.column_stack([numpy.asarray(events[column])
+                                        for column in columns])
+        else:
+            codes = quantizer.encode(feature_columns(events))
+        return cls(quantizer, codes, numpy.asarray(events['gravityspy_id']))
+
+    def search(self, queries, k=10, block_size=None, nthreads=1):
+        """Find the events most similar to each of a batch of vectors
+
+        Up to `LOOKUP_MAX_QUERIES` queries are scored with lookup
+        tables, larger batches against the decoded codes.
+
+        Parameters:
+
+            queries (`numpy.ndarray`):
+                (Nqueries, ndim) feature vectors
+
+            k (int, optional):
+                Default 10, number of neighbours to return
+
+            block_size (int, optional):
+                Default None, codes scanned at a time
+
+            nthreads (int, optional):
+                Default 1, number of threads scanning blocks
+
+        Returns:
+
+            gravityspy_id, similarity (`numpy.ndarray`):
+                (Nqueries, k) IDs of the nearest events and their
+                approximate cosine similarity to each query,
+                most similar first
+        """
+        if not len(self):
+            raise ValueError('This index is empty')
+        queries = _normalise(queries)
+
+        if len(queries) > LOOKUP_MAX_QUERIES:
+            def similarity(start, stop):
+                return queries.dot(self.quantizer.decode(
+                                       self.codes[start:stop]).T)
+        else:
+            # (nsubspaces, nqueries, ncentroids) inner products of the
+            # slices of each query with the centroids of that slice
+            tables = numpy.ascontiguousarray(numpy.einsum(
+                         'qsd,scd->sqc', self.quantizer._split(queries),
+                         self.quantizer.codebooks.astype(numpy.float32)))
+
+            def similarity(start, stop):
+                codes = self.codes[start:stop]
+                output = numpy.zeros((len(queries), len(codes)),
+                                     dtype=numpy.float32)
+                for subspace, table in enumerate(tables):
+                    output += numpy.take(table, codes[:, subspace], axis=1)
+                return output
+
+        rows, similarity = blocked_top_k(similarity, len(self), len(queries),
+                                         k, block_size=block_size,
+                                         nthreads=nthreads)
+        return self.gravityspy_id[rows].astype(str), similarity
+
+    def query(self, vector, k=10):
+        """Find the events most similar to a vector
+
+        Returns:
+
+            gravityspy_id, similarity (`numpy.ndarray`):
+                the IDs of the ``k`` nearest events and their approximate
+                cosine similarity, most similar first
+        """
+        gravityspy_id, similarity = self.search(numpy.atleast_2d(vector),
+                                                k=k)
+        return gravityspy_id[0], similarity[0]
+
+
+def _kmeans(vectors, ncentroids, niter, rng):
+    """Euclidean k-means of the slices of one subspace
+    """
+    centroids = vectors[rng.choice(len(vectors), ncentroids, replace=False)]
+    for _ in range(niter):
+        cells = _nearest(vectors, centroids)
+        counts = numpy.bincount(cells, minlength=ncentroids)
+        filled = counts > 0
+        sums = numpy.zeros_like(centroids)
+        starts = numpy.cumsum(counts) - counts
+        sums[filled] = numpy.add.reduceat(
+            vectors[numpy.argsort(cells, kind='mergesort')], starts[filled])
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # reseed empty cells on random slices
+        centroids[~filled] = vectors[rng.randint(len(vectors),
+                                                 size=(~filled).sum())]
+    return centroids
+
+
+def _nearest(vectors, centroids):
+    """The centroid closest in euclidean distance to each vector
+    """
+    distance = ((centroids ** 2).sum(1) - 2 * vectors.dot(centroids.T))
+    return distance.argmin(1)
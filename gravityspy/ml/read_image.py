@@ -1,9 +1,24 @@
 from skimage import io
 from skimage.color import rgb2gray
 from skimage.transform import rescale
+from matplotlib import cm
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import os
-from functools import reduce
+from functools import partial, reduce
+
+# Pixel geometry of the individual spectrogram plots made by
+# `gravityspy.plot.plot_qtransform`: an 8 by 6 inch figure saved at 100 dpi
+# whose axes sit at [0.125, 0.1, 0.775, 0.8] before a colorbar
+# (5% wide, 3% pad) is split off their right hand side.
+AXES_TOP = 60.
+AXES_HEIGHT = 480.
+AXES_LEFT = 100.
+AXES_WIDTH = 620. / 1.08
+
+# (rows, cols, clip_to_input) resampling of `downsample`, keyed by
+# (input shape, resolution)
+_RESAMPLING_MATRICES = {}
 
 
 def read_and_crop_image(filename, x, y):
@@ -54,9 +69,13 @@ def read_grayscale(filename, resolution=0.3, x=[66, 532], y=[105, 671],
     """
     image_data = read_and_crop_image(filename, x=x, y=y)
 
+    return _pixelize_grayscale(image_data, resolution)
+
+def _pixelize_grayscale(image_data, resolution):
+    """Convert a cropped RGB image to gray, downsample and flatten
+    """
     image_data = rgb2gray(image_data)
-    image_data = rescale(image_data, resolution, mode='constant',
-                         preserve_range='True', multichannel=False)
+    image_data = downsample(image_data, resolution)
 
     dim = np.int(reduce(lambda x, y: x * y, image_data.shape))
     image_data = np.reshape(image_data, (dim))
@@ -84,11 +103,279 @@ def read_rgb(filename, resolution=0.3, x=[66, 532], y=[105, 671],
             and then downsampled by the resolution.
     """
     image_data = read_and_crop_image(filename, x=x, y=y)
-    image_data = rescale(image_data, resolution, mode='constant',
-                         preserve_range='True', multichannel=True)
-    dim = np.int(reduce(lambda x, y: x * y, image_data[:,:,0].shape))
-    image_data_r = np.reshape(image_data[:,:,0], (dim))
-    image_data_g = np.reshape(image_data[:,:,1], (dim))
-    image_data_b = np.reshape(image_data[:,:,2], (dim))
+
+    return _pixelize_rgb(image_data, resolution)
+
+def _pixelize_rgb(image_data, resolution):
+    """Downsample a cropped RGB image and flatten each channel
+    """
+    image_data = downsample(np.moveaxis(image_data, 2, 0).astype(float),
+                            resolution)
+    dim = np.int(reduce(lambda x, y: x * y, image_data[0].shape))
+    image_data_r = np.reshape(image_data[0], (dim))
+    image_data_g = np.reshape(image_data[1], (dim))
+    image_data_b = np.reshape(image_data[2], (dim))
 
     return image_data_r, image_data_g, image_data_b
+
+def downsample(image_data, resolution=0.3):
+    """Downsample images exactly as `skimage.transform.rescale` does
+
+    `rescale` is separable and linear in the image, so for a given input
+    shape it amounts to ``rows @ image @ cols.T`` for two fixed resampling
+    matrices. These are worked out once per shape and resolution, after
+    which any number of images and channels are downsampled with two
+    matrix products. Some versions of `rescale` then clip the edges to
+    the range of the input image, which is repeated here.
+
+    Parameters
+        image_data (`np.array`):
+            (..., nrows, ncols) float images
+
+        resolution (float, optional):
+            default: 0.3
+
+    Returns
+        image_data (`np.array`):
+            (..., round(nrows * resolution), round(ncols * resolution))
+    """
+    rows, cols, clip_to_input = _resampling_matrices(image_data.shape[-2:],
+                                                     resolution)
+    output = np.matmul(np.matmul(rows, image_data), cols.T)
+    if clip_to_input:
+        output = np.clip(output,
+                         image_data.min(axis=(-2, -1), keepdims=True),
+                         image_data.max(axis=(-2, -1), keepdims=True))
+    return output
+
+def _resampling_matrices(shape, resolution, spacing=32):
+    """The row and column resampling matrices of `rescale`, and whether
+    it clips its output to the range of its input
+
+    They are measured by rescaling combs of unit impulses ``spacing``
+    pixels apart, far enough that their responses never overlap.
+    """
+    key = (tuple(shape), resolution)
+    if key in _RESAMPLING_MATRICES:
+        return _RESAMPLING_MATRICES[key]
+
+    nrows, ncols = shape
+    # probe along the input row and column under the centre of the
+    # middle output pixel, which are sure to be sampled
+    irow = _input_centres(nrows, resolution)[int(round(nrows * resolution)) // 2]
+    icol = _input_centres(ncols, resolution)[int(round(ncols * resolution)) // 2]
+    irow, icol = int(round(irow)), int(round(icol))
+
+    row_combs = np.zeros((nrows, ncols, spacing))
+    col_combs = np.zeros((nrows, ncols, spacing))
+    for offset in range(spacing):
+        row_combs[offset::spacing, icol, offset] = 1
+        col_combs[irow, offset::spacing, offset] = 1
+
+    row_response = rescale(row_combs, resolution, mode='constant',
+                           preserve_range='True', multichannel=True)
+    col_response = rescale(col_combs, resolution, mode='constant',
+                           preserve_range='True', multichannel=True)
+
+    # the output column and row seeing the most of the impulses
+    ocol = row_response.sum(axis=(0, 2)).argmax()
+    orow = col_response.sum(axis=(1, 2)).argmax()
+
+    rows = _unfold_combs(row_response[:, ocol, :], nrows, resolution, spacing)
+    cols = _unfold_combs(col_response[orow, :, :], ncols, resolution, spacing)
+
+    # both responses carry a factor of the other axis' weight at the
+    # probed pixel, the row matrix keeps it and the column matrix drops it
+    cols /= rows[orow, irow]
+
+    # whether the zeros padding the image are left out of the clipping
+    # range, which only shows where the output overlaps the padding
+    clip_to_input = rescale(np.ones(shape), resolution, mode='constant',
+                            preserve_range='True',
+                            multichannel=False).min() == 1
+
+    _RESAMPLING_MATRICES[key] = rows, cols, clip_to_input
+    return rows, cols, clip_to_input
+
+def _input_centres(size, resolution):
+    """The input pixel each output pixel of `rescale` is centred on
+    """
+    nout = int(round(size * resolution))
+    return (np.arange(nout) + 0.5) * size / float(nout) - 0.5
+
+def _unfold_combs(response, size, resolution, spacing):
+    """Sort the responses to interleaved impulse combs into a matrix
+    """
+    matrix = np.zeros((response.shape[0], size))
+    centres = _input_centres(size, resolution)
+    for offset in range(spacing):
+        pixel = offset + spacing * np.round((centres - offset) / spacing)
+        pixel = pixel.astype(int)
+        inside = (pixel >= 0) & (pixel < size)
+        matrix[np.nonzero(inside)[0], pixel[inside]] = response[inside, offset]
+    return matrix
+
+def read_grayscale_and_rgb(filename, resolution=0.3, x=[66, 532],
+                           y=[105, 671]):
+    """Decode an image once and pixelize it both in grayscale and RGB
+
+    Parameters
+        filename (str):
+            the file you would like to pixelize
+
+        resolution (float, optional):
+            default: 0.3
+
+    Returns
+        image_data (`np.array`):
+            what `read_grayscale` returns
+
+        image_data_rgb (tuple):
+            what `read_rgb` returns
+    """
+    image_data = read_and_crop_image(filename, x=x, y=y)
+
+    return (_pixelize_grayscale(image_data, resolution),
+            _pixelize_rgb(image_data, resolution))
+
+def read_grayscale_and_rgb_batch(filenames, resolution=0.3, nthreads=1,
+                                 x=[66, 532], y=[105, 671]):
+    """Pixelize many images in grayscale and RGB, decoding each once
+
+    Parameters
+        filenames (list):
+            the files you would like to pixelize
+
+        resolution (float, optional):
+            default: 0.3
+
+        nthreads (int, optional):
+            default: 1
+            number of threads decoding images, the decoded batch
+            is then downsampled in one go
+
+    Returns
+        image_data (`np.array`):
+            (N, npixels) float32 grayscale pixels
+
+        image_data_rgb (`np.array`):
+            (N, 3, npixels) float32 RGB pixels
+    """
+    read = partial(read_and_crop_image, x=x, y=y)
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            images = pool.map(read, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        images = [read(filename) for filename in filenames]
+
+    if not images:
+        raise ValueError('No images to read')
+
+    images = np.stack(images)
+    nb_images = images.shape[0]
+
+    # downsample the whole batch at once
+    image_data = downsample(rgb2gray(images), resolution)
+    image_data = image_data.reshape(nb_images, -1).astype(np.float32)
+
+    image_data_rgb = downsample(np.moveaxis(images, 3, 1).astype(float),
+                                resolution)
+    image_data_rgb = image_data_rgb.reshape(nb_images, 3, -1).astype(
+                                                                 np.float32)
+
+    return image_data, image_data_rgb
+
+def render_spectrogram(specsgram, plot_normalized_energy_range,
+                       frange=(10, 2048), x=[66, 532], y=[105, 671]):
+    """Render a spectrogram to the RGB pixels its saved plot would contain
+
+    Every pixel of the crop is mapped back through the axes of the plot
+    made by `gravityspy.plot.plot_qtransform` (linear time axis, base 2
+    logarithmic frequency axis) to the spectrogram bin it shows, and
+    coloured with the same colormap and colour limits. No figure is drawn
+    and no PNG is written or read.
+
+    Parameters
+        specsgram (`gwpy.spectrogram.Spectrogram`):
+            the spectrogram you would like to render
+
+        plot_normalized_energy_range (array):
+            The min and max of the colorbar for the plots
+
+        frange (list, optional):
+            default: [10, 2048]
+            the frequency limits of the plot
+
+        x (float, list):
+            xrange of pixels to keep
+
+        y (float, list):
+            yrange of pixels to keep
+
+    Returns
+        image_data (`np.array):
+            (x[1] - x[0], y[1] - y[0], 3) uint8 RGB pixels
+    """
+    rows = np.arange(x[0], x[1]) + 0.5
+    cols = np.arange(y[0], y[1]) + 0.5
+
+    # frequency shown at the centre of each pixel row
+    fraction = (AXES_TOP + AXES_HEIGHT - rows) / AXES_HEIGHT
+    frequencies = frange[0] * (float(frange[1]) / frange[0]) ** fraction
+
+    # time shown at the centre of each pixel column
+    xspan = specsgram.xspan
+    times = xspan[0] + (cols - AXES_LEFT) / AXES_WIDTH * (xspan[1] - xspan[0])
+
+    # nearest spectrogram bin, as drawn by imshow with interpolation='none'
+    time_idx = np.floor((times - specsgram.x0.value) /
+                        specsgram.dx.value).astype(int)
+    freq_idx = np.floor((frequencies - specsgram.y0.value) /
+                        specsgram.dy.value).astype(int)
+    time_idx = np.clip(time_idx, 0, specsgram.shape[0] - 1)
+    freq_idx = np.clip(freq_idx, 0, specsgram.shape[1] - 1)
+
+    energies = specsgram.value[time_idx[np.newaxis, :],
+                               freq_idx[:, np.newaxis]]
+
+    vmin, vmax = plot_normalized_energy_range
+    normalized = (energies - vmin) / float(vmax - vmin)
+    image_data = cm.viridis(normalized, bytes=True)
+
+    return image_data[:, :, :3]
+
+def read_spectrogram_grayscale(specsgram, plot_normalized_energy_range,
+                               frange=(10, 2048), resolution=0.3,
+                               x=[66, 532], y=[105, 671]):
+    """Convert a spectrogram straight to the grayscale classifier input
+
+    This produces the same pixels as saving the spectrogram with
+    `gravityspy.utils.utils.save_q_scans` and reading the PNG back with
+    `read_grayscale`, up to differences in how matplotlib anti-aliases
+    the image edges.
+
+    Parameters
+        specsgram (`gwpy.spectrogram.Spectrogram`):
+            the spectrogram you would like to pixelize
+
+        plot_normalized_energy_range (array):
+            The min and max of the colorbar for the plots
+
+        frange (list, optional):
+            default: [10, 2048]
+
+        resolution (float, optional):
+            default: 0.3
+
+    Returns
+        image_data (`np.array):
+            the flattened, downsampled gray scale pixels
+    """
+    image_data = render_spectrogram(specsgram, plot_normalized_energy_range,
+                                    frange=frange, x=x, y=y)
+
+    return _pixelize_grayscale(image_data, resolution)
@@ -0,0 +1,759 @@
+"""Approximate nearest neighbour search over the similarity features
+
+`SimilarityIndex` is an inverted file (IVF) index on the unit-normalised
+feature vectors of the similarity model. The vectors are partitioned
+into ``nlist`` cells by spherical k-means and a query only scans the
+``nprobe`` cells whose centroids are closest to it, so the cost of a
+query grows with ``N * nprobe / nlist`` rather than with ``N``.
+
+The vectors of each cell are kept contiguous in memory and in the HDF5
+file the index is saved to, where every cell is a resizable dataset.
+Once the index has been trained on a representative sample, new vectors
+such as those produced by `Events.update_features` can be added to it at
+any time, in memory or straight to the file with `add_to_file`, which
+only appends to the cells they fall in.
+
+`ExactIndex` answers the same queries exactly. Its normalised vectors
+are one contiguous float32 matrix, memory-mapped straight from the HDF5
+file if wanted, which is scanned block by block against a batch of
+queries, so no full similarity matrix is ever held in memory.
+
+`find_duplicates` compares every event only with the events of the same
+detector shortly before it, to flag repeated scans of one glitch.
+"""
+from multiprocessing.pool import ThreadPool
+
+import time
+
+import h5py
+import numpy
+
+
+class SimilarityIndex(object):
+    """An IVF index of feature vectors keyed by ``gravityspy_id``
+
+    Parameters:
+
+        nlist (int, optional):
+            Default 256, number of cells the vectors are partitioned into
+
+        nprobe (int, optional):
+            Default 8, number of cells scanned by a query
+
+        random_state (int, optional):
+            Default 30, seed of the k-means that places the cells
+    """
+    def __init__(self, nlist=256, nprobe=8, random_state=30):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.random_state = random_state
+        self.centroids = None
+        self.vectors = None
+        self.gravityspy_id = numpy.empty(0, dtype='S100')
+        self.cells = numpy.empty(0, dtype=int)
+        self._offsets = None
+        self._rows = {}
+
+    def __len__(self):
+        return len(self.gravityspy_id)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, vectors, niter=20, max_samples=None):
+        """Place the cells by spherical k-means
+
+        Parameters:
+
+            vectors (`numpy.ndarray`):
+                (N, ndim) feature vectors representative of the data
+
+            niter (int, optional):
+                Default 20, number of k-means iterations
+
+            max_samples (int, optional):
+                Default None, train on a random subset of this many
+                vectors, 256 per cell if None
+        """
+        vectors = _normalise(vectors)
+        rng = numpy.random.RandomState(self.random_state)
+        if max_samples is None:
+            max_samples = 256 * self.nlist
+        if len(vectors) > max_samples:
+            vectors = vectors[rng.choice(len(vectors), max_samples,
+                                         replace=False)]
+        nlist = min(self.nlist, len(vectors))
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)]
+        for _ in range(niter):
+            cells = _nearest(vectors, centroids)
+            # sum the members of each cell in one pass over sorted vectors
+            counts = numpy.bincount(cells, minlength=nlist)
+            starts = numpy.cumsum(counts) - counts
+            filled = counts > 0
+            centroids[filled] = numpy.add.reduceat(
+                vectors[numpy.argsort(cells, kind='mergesort')],
+                starts[filled])
+            # reseed empty cells on random vectors
+            centroids[~filled] = vectors[rng.randint(len(vectors),
+                                                     size=(~filled).sum())]
+            centroids = _normalise(centroids)
+
+        self.centroids = centroids
+        self.nlist = nlist
+        if len(self):
+            self.cells = _nearest(self.vectors, self.centroids)
+            self._offsets = None
+
+    def add(self, vectors, gravityspy_id):
+        """Add or replace the vectors of some events
+
+        The index must have been trained first, on a sample of vectors
+        representative of everything that will be added, see `train`.
+        Vectors already held for any of these ``gravityspy_id`` are
+        replaced.
+
+        Parameters:
+
+            vectors (`numpy.ndarray`):
+                (N, ndim) feature vectors
+
+            gravityspy_id (list):
+                the ID of each vector
+        """
+        vectors = _normalise(vectors)
+        gravityspy_id = numpy.asarray(gravityspy_id, dtype='S100')
+        if len(vectors) != len(gravityspy_id):
+            raise ValueError('Got {0} vectors but {1} ids'.format(
+                len(vectors), len(gravityspy_id)))
+        if not self.is_trained:
+            raise ValueError('This index has not been trained, call train '
+                             'on a representative sample of vectors first')
+
+        self.remove(gravityspy_id)
+        if self.vectors is None:
+            self.vectors = vectors
+        else:
+            self.vectors = numpy.concatenate([self.vectors, vectors])
+        self.gravityspy_id = numpy.concatenate([self.gravityspy_id,
+                                                gravityspy_id])
+        self.cells = numpy.concatenate([self.cells,
+                                        _nearest(vectors, self.centroids)])
+        self._offsets = None
+
+    def add_events(self, events):
+        """Add the features of a table such as `Events.update_features` makes
+
+        Parameters:
+
+            events (`Events`, `pandas.DataFrame`):
+                with columns '0', '1', ... holding the features
+                and a ``gravityspy_id`` column
+        """
+        self.add(feature_columns(events), numpy.asarray(
+                                              events['gravityspy_id']))
+
+    def remove(self, gravityspy_id):
+        """Forget the vectors of some events
+
+        Parameters:
+
+            gravityspy_id (list):
+                the IDs to remove, unknown IDs are ignored
+        """
+        if not len(self):
+            return
+        keep = ~numpy.in1d(self.gravityspy_id,
+                           numpy.asarray(gravityspy_id, dtype='S100'))
+        if keep.all():
+            return
+        self.vectors = self.vectors[keep]
+        self.gravityspy_id = self.gravityspy_id[keep]
+        self.cells = self.cells[keep]
+        self._offsets = None
+
+    def vector(self, gravityspy_id):
+        """The normalised feature vector held for an event
+        """
+        self._build()
+        key = numpy.asarray(gravityspy_id, dtype='S100').item()
+        if key not in self._rows:
+            raise KeyError('{0} is not in this index'.format(gravityspy_id))
+        return self.vectors[self._rows[key]]
+
+    def query(self, vector, k=10, nprobe=None):
+        """Find the events most similar to a vector or to an event
+
+        Parameters:
+
+            vector (`numpy.ndarray`, str):
+                a feature vector, or the ``gravityspy_id`` of an event
+                held in the index
+
+            k (int, optional):
+                Default 10, number of neighbours to return
+
+            nprobe (int, optional):
+                Default None, number of cells to scan,
+                the ``nprobe`` of the index if None
+
+        Returns:
+
+            gravityspy_id, similarity (`numpy.ndarray`):
+                the IDs of the ``k`` nearest events and their cosine
+                similarity to the query, most similar first
+        """
+        if not len(self):
+            raise ValueError('This index is empty')
+        self._build()
+        if numpy.ndim(vector) == 0:
+            vector = self.vector(vector)
+        vector = _normalise(numpy.atleast_2d(vector))[0]
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+
+        cells = _top_k(self.centroids.dot(vector), nprobe)
+        rows = numpy.concatenate([numpy.arange(self._offsets[cell],
+                                               self._offsets[cell + 1])
+                                  for cell in cells])
+        similarity = self.vectors[rows].dot(vector)
+        best = _top_k(similarity, k)
+        return (self.gravityspy_id[rows[best]].astype(str),
+                similarity[best])
+
+    def save(self, filename):
+        """Write the index to an HDF5 file
+
+        The vectors and IDs of each cell are resizable datasets of the
+        group ``cells/<cell>``, so that `add_to_file` can append to them.
+        """
+        self._build()
+        with h5py.File(filename, 'w') as f:
+            f.attrs['nlist'] = self.nlist
+            f.attrs['nprobe'] = self.nprobe
+            f.attrs['random_state'] = self.random_state
+            if self.is_trained:
+                f.create_dataset('centroids', data=self.centroids)
+            cells = f.create_group('cells')
+            for cell in range(self.nlist if len(self) else 0):
+                start, stop = self._offsets[cell], self._offsets[cell + 1]
+                if stop > start:
+                    _write_cell(cells, cell, self.vectors[start:stop],
+                                self.gravityspy_id[start:stop])
+
+    @classmethod
+    def read(cls, filename):
+        """Read an index written by `save`
+        """
+        with h5py.File(filename, 'r') as f:
+            index = cls(nlist=int(f.attrs['nlist']),
+                        nprobe=int(f.attrs['nprobe']),
+                        random_state=int(f.attrs['random_state']))
+            if 'centroids' in f:
+                index.centroids = f['centroids'][:]
+            cells = sorted(f.get('cells', {}), key=int)
+            if cells:
+                groups = [f['cells'][cell] for cell in cells]
+                index.vectors = numpy.concatenate(
+                    [group['vectors'][:] for group in groups])
+                index.gravityspy_id = numpy.concatenate(
+                    [group['gravityspy_id'][:] for group in groups])
+                index.cells = numpy.concatenate(
+                    [numpy.full(len(group['gravityspy_id']), int(cell),
+                                dtype=int)
+                     for cell, group in zip(cells, groups)])
+        return index
+
+    @staticmethod
+    def add_to_file(filename, vectors, gravityspy_id):
+        """Add or replace the vectors of some events in a saved index
+
+        Only the cells the vectors fall in are written to, the other
+        vectors are neither read nor rewritten. Vectors already held for
+        any of these ``gravityspy_id`` are replaced.
+
+        Parameters:
+
+            filename (str):
+                an index written by `save`, which must have been trained
+
+            vectors (`numpy.ndarray`):
+                (N, ndim) feature vectors
+
+            gravityspy_id (list):
+                the ID of each vector
+        """
+        vectors = _normalise(vectors)
+        gravityspy_id = numpy.asarray(gravityspy_id, dtype='S100')
+        if len(vectors) != len(gravityspy_id):
+            raise ValueError('Got {0} vectors but {1} ids'.format(
+                len(vectors), len(gravityspy_id)))
+        with h5py.File(filename, 'r+') as f:
+            if 'centroids' not in f:
+                raise ValueError('This index has not been trained, call '
+                                 'train on a representative sample of '
+                                 'vectors first')
+            new_cells = _nearest(vectors, f['centroids'][:])
+            cells = f.require_group('cells')
+
+            # drop the vectors being replaced from whichever cell holds them
+            for cell in list(cells):
+                group = cells[cell]
+                keep = ~numpy.in1d(group['gravityspy_id'][:], gravityspy_id)
+                if keep.all():
+                    continue
+                kept_vectors = group['vectors'][:][keep]
+                kept_ids = group['gravityspy_id'][:][keep]
+                for name, data in (('vectors', kept_vectors),
+                                   ('gravityspy_id', kept_ids)):
+                    group[name].resize(len(data), axis=0)
+                    group[name][:] = data
+
+            for cell in numpy.unique(new_cells):
+                members = new_cells == cell
+                _write_cell(cells, cell, vectors[members],
+                            gravityspy_id[members])
+
+    @classmethod
+    def add_events_to_file(cls, filename, events):
+        """Add the features of a table to a saved index, see `add_to_file`
+
+        Parameters:
+
+            filename (str):
+                an index written by `save`
+
+            events (`Events`, `pandas.DataFrame`):
+                with columns '0', '1', ... holding the features
+                and a ``gravityspy_id`` column
+        """
+        cls.add_to_file(filename, feature_columns(events),
+                        numpy.asarray(events['gravityspy_id']))
+
+    @classmethod
+    def from_events(cls, events, **kwargs):
+        """Build an index from a table of features
+
+        The index is trained on these features, so the table should be
+        representative of the events that will be added later.
+
+        Parameters:
+
+            events (`Events`, `pandas.DataFrame`):
+                with columns '0', '1', ... holding the features
+                and a ``gravityspy_id`` column
+
+            **kwargs:
+                passed to `SimilarityIndex`
+        """
+        index = cls(**kwargs)
+        index.train(feature_columns(events))
+        index.add_events(events)
+        return index
+
+    def _build(self):
+        """Sort the vectors by cell so that each cell is one slice
+        """
+        if self._offsets is not None:
+            return
+        order = numpy.argsort(self.cells, kind='mergesort')
+        self.cells = self.cells[order]
+        self.gravityspy_id = self.gravityspy_id[order]
+        if self.vectors is not None:
+            self.vectors = numpy.ascontiguousarray(self.vectors[order])
+        self._offsets = numpy.searchsorted(self.cells,
+                                           numpy.arange(self.nlist + 1))
+        self._rows = dict((key, row) for row, key in
+                          enumerate(self.gravityspy_id))
+
+
+class ExactIndex(object):
+    """Exact top-k cosine search over feature vectors
+
+    Parameters:
+
+        vectors (`numpy.ndarray`):
+            (N, ndim) feature vectors
+
+        gravityspy_id (list):
+            the ID of each vector
+
+        normalised (bool, optional):
+            Default False, set to True if the rows of ``vectors`` are
+            already unit float32 vectors, so they are used as they are,
+            e.g. memory-mapped
+    """
+    def __init__(self, vectors, gravityspy_id, normalised=False):
+        if not normalised:
+            vectors = _normalise(vectors)
+        self.vectors = vectors
+        self.gravityspy_id = numpy.asarray(gravityspy_id, dtype='S100')
+        if len(self.vectors) != len(self.gravityspy_id):
+            raise ValueError('Got {0} vectors but {1} ids'.format(
+                len(self.vectors), len(self.gravityspy_id)))
+        self._rows = None
+
+    def __len__(self):
+        return len(self.gravityspy_id)
+
+    @classmethod
+    def from_events(cls, events):
+        """Build an index from a table of features
+
+        Parameters:
+
+            events (`Events`, `pandas.DataFrame`):
+                with columns '0', '1', ... holding the features
+                and a ``gravityspy_id`` column
+        """
+        return cls(feature_columns(events),
+                   numpy.asarray(events['gravityspy_id']))
+
+    def save(self, filename):
+        """Write the normalised vectors to an HDF5 file
+
+        The vectors are stored contiguously, so that `read` can
+        memory-map them.
+        """
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('vectors', data=self.vectors)
+            f.create_dataset('gravityspy_id', data=self.gravityspy_id)
+
+    @classmethod
+    def read(cls, filename, mmap=True):
+        """Read an index written by `save`
+
+        Parameters:
+
+            filename (str):
+                path to the HDF5 file
+
+            mmap (bool, optional):
+                Default True, map the vectors from the file rather than
+                reading them into memory
+        """
+        with h5py.File(filename, 'r') as f:
+            dataset = f['vectors']
+            gravityspy_id = f['gravityspy_id'][:]
+            offset = dataset.id.get_offset()
+            if not mmap or offset is None:
+                return cls(dataset[:], gravityspy_id, normalised=True)
+            shape, dtype = dataset.shape, dataset.dtype
+        vectors = numpy.memmap(filename, dtype=dtype, mode='r',
+                               offset=offset, shape=shape)
+        return cls(vectors, gravityspy_id, normalised=True)
+
+    def vector(self, gravityspy_id):
+        """The normalised feature vector held for an event
+        """
+        if self._rows is None:
+            self._rows = dict((key, row) for row, key in
+                              enumerate(self.gravityspy_id))
+        key = numpy.asarray(gravityspy_id, dtype='S100').item()
+        if key not in self._rows:
+            raise KeyError('{0} is not in this index'.format(gravityspy_id))
+        return numpy.asarray(self.vectors[self._rows[key]])
+
+    def query(self, vector, k=10):
+        """Find the events most similar to a vector or to an event
+
+        Parameters:
+
+            vector (`numpy.ndarray`, str):
+                a feature vector, or the ``gravityspy_id`` of an event
+                held in the index
+
+            k (int, optional):
+                Default 10, number of neighbours to return
+
+        Returns:
+
+            gravityspy_id, similarity (`numpy.ndarray`):
+                the IDs of the ``k`` nearest events and their cosine
+                similarity to the query, most similar first
+        """
+        if numpy.ndim(vector) == 0:
+            vector = self.vector(vector)
+        gravityspy_id, similarity = self.search(numpy.atleast_2d(vector), k=k)
+        return gravityspy_id[0], similarity[0]
+
+    def search(self, queries, k=10, block_size=None, nthreads=1):
+        """Find the events most similar to each of a batch of vectors
+
+        The index is scanned ``block_size`` rows at a time. Each block is
+        multiplied with all of the queries and only its ``k`` best rows
+        per query are kept.
+
+        Parameters:
+
+            queries (`numpy.ndarray`):
+                (Nqueries, ndim) feature vectors
+
+            k (int, optional):
+                Default 10, number of neighbours to return
+
+            block_size (int, optional):
+                Default None, rows scanned at a time, chosen so that a
+                block of similarities holds about 16 million values
+
+            nthreads (int, optional):
+                Default 1, number of threads scanning blocks
+
+        Returns:
+
+            gravityspy_id, similarity (`numpy.ndarray`):
+                (Nqueries, k) IDs of the nearest events and their cosine
+                similarity to each query, most similar first
+        """
+        if not len(self):
+            raise ValueError('This index is empty')
+        queries = _normalise(queries)
+
+        def similarity(start, stop):
+            return queries.dot(numpy.asarray(self.vectors[start:stop]).T)
+
+        rows, similarity = blocked_top_k(similarity, len(self), len(queries),
+                                         k, block_size=block_size,
+                                         nthreads=nthreads)
+        return self.gravityspy_id[rows].astype(str), similarity
+
+
+def blocked_top_k(similarity, nrows, nqueries, k, block_size=None,
+                  nthreads=1):
+    """The k most similar rows to each query, scanning rows in blocks
+
+    Parameters:
+
+        similarity (function):
+            taking ``start, stop`` and returning the (nqueries,
+            stop - start) similarities of those rows to the queries
+
+        nrows (int):
+            number of rows to scan
+
+        nqueries (int):
+            number of queries
+
+        k (int):
+            number of rows to return per query
+
+        block_size (int, optional):
+            Default None, rows scanned at a time, chosen so that a
+            block of similarities holds about 16 million values
+
+        nthreads (int, optional):
+            Default 1, number of threads scanning blocks
+
+    Returns:
+
+        rows, similarity (`numpy.ndarray`):
+            (nqueries, k) positions of the most similar rows and their
+            similarity, most similar first
+    """
+    k = min(k, nrows)
+    if block_size is None:
+        block_size = max(2 ** 24 // nqueries, 4 * k)
+    queries = numpy.arange(nqueries)[:, None]
+
+    def scan(start):
+        block = similarity(start, min(start + block_size, nrows))
+        if block.shape[1] > k:
+            best = numpy.argpartition(-block, k - 1, axis=1)[:, :k]
+            block = block[queries, best]
+        else:
+            best = numpy.tile(numpy.arange(block.shape[1]), (nqueries, 1))
+        return best + start, block
+
+    starts = range(0, nrows, block_size)
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            blocks = pool.map(scan, starts)
+        finally:
+            pool.close()
+    else:
+        blocks = [scan(start) for start in starts]
+
+    rows = numpy.concatenate([block[0] for block in blocks], axis=1)
+    values = numpy.concatenate([block[1] for block in blocks], axis=1)
+    order = numpy.argsort(-values, axis=1, kind='mergesort')[:, :k]
+    return rows[queries, order], values[queries, order]
+
+
+def find_duplicates(event_time, ifo=None, features=None, time_window=0.5,
+                    min_similarity=0.95, block_size=1024):
+    """Find the events that repeat an earlier event
+
+    An event duplicates an earlier event of the same detector if it
+    happened at most ``time_window`` seconds after it and, if features
+    are given, their cosine similarity is at least ``min_similarity``.
+    Events are sorted by time and compared a block at a time with the
+    events inside the window only.
+
+    Parameters:
+
+        event_time (array):
+            GPS time of each event
+
+        ifo (array, optional):
+            Default None, the detector of each event,
+            if None all events are taken to come from one detector
+
+        features (`numpy.ndarray`, optional):
+            Default None, (N, ndim) feature vectors, if None events
+            are matched on time alone
+
+        time_window (float, optional):
+            Default 0.5, seconds
+
+        min_similarity (float, optional):
+            Default 0.95
+
+        block_size (int, optional):
+            Default 1024, events compared at a time
+
+    Returns:
+
+        duplicate_of (`numpy.ndarray`):
+            for each event, the position of the first event of its
+            chain of duplicates, or -1 if it duplicates no event
+    """
+    event_time = numpy.asarray(event_time, dtype=numpy.float64)
+    if ifo is None:
+        ifo = numpy.zeros(len(event_time), dtype=int)
+    ifo = numpy.asarray(ifo)
+    vectors = _normalise(features) if features is not None else None
+
+    duplicate_of = numpy.full(len(event_time), -1, dtype=int)
+    for detector in numpy.unique(ifo):
+        members = numpy.flatnonzero(ifo == detector)
+        members = members[numpy.argsort(event_time[members],
+                                         kind='mergesort')]
+        times = event_time[members]
+        for start in range(0, len(members), block_size):
+            stop = min(start + block_size, len(members))
+            first = numpy.searchsorted(times, times[start] - time_window)
+            # compare with the earlier events inside the window only
+            match = ((times[start:stop, None] - times[None, first:stop] <=
+                      time_window) &
+                     (numpy.arange(start, stop)[:, None] >
+                      numpy.arange(first, stop)[None, :]))
+            if vectors is not None:
+                match &= (vectors[members[start:stop]].dot(
+                              vectors[members[first:stop]].T) >=
+                          min_similarity)
+            rows = numpy.flatnonzero(match.any(axis=1))
+            earliest = match[rows].argmax(axis=1) + first
+            # earlier events are resolved first so chains collapse
+            for row, original in zip(members[rows + start],
+                                     members[earliest]):
+                root = duplicate_of[original]
+                duplicate_of[row] = original if root < 0 else root
+
+    return duplicate_of
+
+
+def feature_columns(events):
+    """Stack the '0', '1', ... feature columns of a table
+
+    Parameters:
+
+        events (`Events`, `pandas.DataFrame`):
+            a table of features
+
+    Returns:
+
+        `numpy.ndarray` of shape (N, ndim)
+    """
+    columns = sorted((str(column) for column in events.keys()
+                      if str(column).isdigit()), key=int)
+    if not columns:
+        raise ValueError("This table does not hold any features")
+    return numpy.column_stack([numpy.asarray(events[column],
+                                             dtype=numpy.float32)
+                               for column in columns])
+
+
+def benchmark(index, queries, k=10, nprobe=None):
+    """Measure the recall and latency of an index
+
+    Parameters:
+
+        index (`SimilarityIndex`):
+            the index to measure
+
+        queries (`numpy.ndarray`):
+            (Nqueries, ndim) feature vectors to search for
+
+        k (int, optional):
+            Default 10
+
+        nprobe (int, optional):
+            Default None, the ``nprobe`` of the index if None
+
+    Returns:
+
+        report (dict):
+            ``recall``, the mean fraction of the exact ``k`` nearest
+            neighbours found, and ``mean_latency`` and ``max_latency``
+            of a query in seconds
+    """
+    queries = _normalise(queries)
+    index._build()
+    exact, _ = ExactIndex(index.vectors, index.gravityspy_id,
+                          normalised=True).search(queries, k=k)
+    recall = []
+    latency = []
+    for query, neighbours in zip(queries, exact):
+        start = time.time()
+        found, _ = index.query(query, k=k, nprobe=nprobe)
+        latency.append(time.time() - start)
+        recall.append(len(numpy.intersect1d(found, neighbours)) /
+                      float(len(neighbours)))
+    return {'recall': float(numpy.mean(recall)),
+            'mean_latency': float(numpy.mean(latency)),
+            'max_latency': float(numpy.max(latency))}
+
+
+def _write_cell(cells, cell, vectors, gravityspy_id):
+    """Append vectors to the resizable datasets of a cell of a saved index
+    """
+    name = str(cell)
+    if name not in cells:
+        group = cells.create_group(name)
+        group.create_dataset('vectors', data=vectors,
+                             maxshape=(None, vectors.shape[1]),
+                             chunks=True)
+        group.create_dataset('gravityspy_id', data=gravityspy_id,
+                             maxshape=(None,), chunks=True)
+        return
+    group = cells[name]
+    start = len(group['gravityspy_id'])
+    for dataset, data in ((group['vectors'], vectors),
+                          (group['gravityspy_id'], gravityspy_id)):
+        dataset.resize(start + len(data), axis=0)
+        dataset[start:] = data
+
+
+def _normalise(vectors):
+    vectors = numpy.array(vectors, dtype=numpy.float32, ndmin=2)
+    norms = numpy.sqrt((vectors ** 2).sum(1, keepdims=True))
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _nearest(vectors, centroids, chunk_size=65536):
+    """The cell whose centroid is most similar to each vector
+    """
+    cells = numpy.empty(len(vectors), dtype=int)
+    for start in range(0, len(vectors), chunk_size):
+        cells[start:start + chunk_size] = vectors[
+            start:start + chunk_size].dot(centroids.T).argmax(1)
+    return cells
+
+
+def _top_k(similarity, k):
+    """Positions of the k largest similarities, largest first
+    """
+    k = min(k, len(similarity))
+    best = numpy.argpartition(-similarity, k - 1)[:k]
+    return best[numpy.argsort(-similarity[best], kind='mergesort')]
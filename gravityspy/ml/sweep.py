@@ -0,0 +1,215 @@
+"""Search the training options of the classifier
+
+A sweep trains one classifier per set of `train_classifier.make_model`
+options, drawn from a grid by `grid` or at random by `random_search`,
+and compares them on the same held-out samples. Trials run in a pool of
+processes, each limited to a few threads. The linear algebra libraries
+read their number of threads from the environment when NumPy is first
+imported, so ``sweep_classifier`` sets it before importing anything,
+and `limit_threads` caps the threads of a running process with
+``threadpoolctl`` if it is installed. The trials all read their batches
+from one `PixelStore` file opened read-only, so the pixels sit once in
+the page cache of the node however many trials run.
+"""
+from gwpy.utils import mp as mp_utils
+
+from gravityspy.utils import log
+
+import itertools
+import numpy
+import pandas
+import time
+
+
+def grid(spec):
+    """Every combination of some options
+
+    Parameters:
+
+        spec (dict):
+            maps each option of `make_model` to a list of values
+
+    Returns:
+
+        list of dict
+    """
+    names = sorted(spec)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(spec[name] for name in names))]
+
+
+def random_search(spec, ntrials, random_state=None):
+    """Random combinations of some options
+
+    Parameters:
+
+        spec (dict):
+            maps each option of `make_model` to a list of values to
+            choose from, or to a dict ``{'uniform': [low, high]}`` or
+            ``{'loguniform': [low, high]}`` to draw a float from
+
+        ntrials (int):
+            number of combinations to draw
+
+        random_state (int, optional):
+            Default None
+
+    Returns:
+
+        list of dict
+    """
+    rng = numpy.random.RandomState(random_state)
+
+    def draw(values):
+        if isinstance(values, dict):
+            if 'uniform' in values:
+                return float(rng.uniform(*values['uniform']))
+            if 'loguniform' in values:
+                return float(numpy.exp(rng.uniform(
+                    *numpy.log(values['loguniform']))))
+            raise ValueError("Do not understand supplied distribution, "
+                             "choose 'uniform' or 'loguniform'")
+        return values[rng.randint(len(values))]
+
+    names = sorted(spec)
+    return [dict((name, draw(spec[name])) for name in names)
+            for _ in range(ntrials)]
+
+
+def run_sweep(filename, trials, nproc=1, nthreads=1, results_file=None,
+              verbose=False, **kwargs):
+    """Train and score a classifier for each set of options
+
+    Parameters:
+
+        filename (str):
+            a grayscale `PixelStore` of the training set
+
+        trials (list):
+            of dicts of options of `make_model`, as made by
+            `grid` or `random_search`
+
+        nproc (int, optional):
+            Default 1, number of trials run at once
+
+        nthreads (int, optional):
+            Default 1, number of threads each trial may use
+
+        results_file (str, optional):
+            Default None, CSV file to write the results to
+
+        **kwargs:
+            options of `make_model` shared by all of the trials
+
+    Returns:
+
+        `pandas.DataFrame` with a row per trial holding its options,
+        ``accuracy`` on the held-out samples, ``recall_<class>`` for
+        every class, the ``wall_time`` of `make_model` in seconds
+        and the ``images_per_second`` it trained on
+    """
+    logger = log.Logger('Gravity Spy: Sweeping '
+                        'Classifier Options')
+
+    inputs = ((filename, dict(kwargs, **trial), nthreads, verbose, nproc)
+              for trial in trials)
+
+    output = mp_utils.multiprocess_with_queues(nproc, _run_trial, inputs)
+
+    results = []
+    # raise exceptions (from multiprocessing, single process raises inline)
+    for inputs, x in output:
+        if isinstance(x, Exception):
+            x.args = ('Failed to train with options %s: %s' % (inputs[1],
+                                                               str(x)),)
+            raise x
+        if verbose:
+            logger.info('Trial {0} reached an accuracy of {1}'.format(
+                inputs[1], x['accuracy']))
+        results.append(x)
+
+    results = pandas.DataFrame(results)
+    if results_file is not None:
+        results.to_csv(results_file, index=False)
+    return results
+
+
+def limit_threads(nthreads):
+    """Limit the threads used by the linear algebra of this process
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        threadpool_limits(nthreads)
+    from keras import backend as K
+    if K.backend() == 'tensorflow':
+        import tensorflow
+        K.set_session(tensorflow.Session(config=tensorflow.ConfigProto(
+            intra_op_parallelism_threads=nthreads,
+            inter_op_parallelism_threads=1)))
+
+
+def _run_trial(inputs):
+    filename = inputs[0]
+    options = dict(inputs[1])
+    nthreads = inputs[2]
+    verbose = inputs[3]
+    nproc = inputs[4]
+
+    try:
+        from . import train_classifier
+        from .pixel_store import PixelStore
+
+        limit_threads(nthreads)
+
+        fraction_validation = options.get('fraction_validation', .125)
+        fraction_testing = options.get('fraction_testing', None)
+        random_seed = options.get('random_seed', 1986)
+        nb_epoch = options.get('nb_epoch', 10)
+        options.setdefault('use_generator', True)
+        options.setdefault('verbose', verbose)
+
+        with PixelStore(filename) as store:
+            data = store.to_pandas()
+            classes = sorted(data.true_label.unique())
+            options.setdefault('nb_classes', len(classes))
+            data['pixel_index'] = numpy.arange(len(data))
+            data['true_label'] = data.true_label.apply(classes.index)
+
+            # the samples make_model holds out, as it draws them
+            data, validationDF, testingDF = train_classifier.hold_out(
+                data, fraction_validation, fraction_testing, random_seed)
+            held_out = validationDF if testingDF is None else testingDF
+
+            start = time.time()
+            model = train_classifier.make_model(store, **options)
+            wall_time = time.time() - start
+
+        sequence = train_classifier.PixelStoreSequence(
+                       filename, held_out['pixel_index'].values,
+                       held_out['true_label'].values, len(classes),
+                       batch_size=options.get('batch_size', 22),
+                       image_size=options.get('image_size', [140, 170]),
+                       order_of_channels=options.get('order_of_channels',
+                                                     'channels_last'),
+                       shuffle=False)
+        predicted = model.predict_generator(sequence).argmax(axis=1)
+        true_label = held_out['true_label'].values
+
+        result = dict(inputs[1])
+        result['accuracy'] = float(numpy.mean(predicted == true_label))
+        for idx, label in enumerate(classes):
+            in_class = true_label == idx
+            result['recall_{0}'.format(label)] = (
+                float(numpy.mean(predicted[in_class] == idx))
+                if in_class.any() else numpy.nan)
+        result['wall_time'] = wall_time
+        result['images_per_second'] = len(data) * nb_epoch / wall_time
+        return inputs, result
+    except Exception as exc:  # pylint: disable=broad-except
+        if nproc == 1:
+            raise
+        else:
+            return inputs, exc
@@ -1,16 +1,20 @@
 from .GS_utils import build_cnn, concatenate_views
 from keras import backend as K
-from keras.models import Sequential
-from keras.layers import Dense
-from keras.utils import np_utils
+from keras.models import Model, Sequential, load_model
+from keras.layers import Conv2D, Dense, Input
+from keras.utils import np_utils, Sequence
 from keras.callbacks import ModelCheckpoint
 from gravityspy.utils import log
+from .checkpoint import TrainingCheckpoint
 from gwpy.table import EventTable
 from gwpy.timeseries import TimeSeries
 
+import h5py
 import numpy as np
 import os
 from . import read_image
+from .pixel_store import (PixelStore, pixelize_trainingset, read_column,
+                          DURATIONS)
 import pandas as pd
 
 '''
@@ -145,7 +149,9 @@ def pickle_trainingset(path_to_trainingset,
     logger.info('The classes you are pickling are {0}'.format(
           classes))
 
-    data = pd.DataFrame()
+    # collect the samples and build the DataFrame once at the end,
+    # appending to it sample by sample is quadratic
+    samples_data = []
     for iclass in classes:
         logger.info('Converting {0} into b/w info'.format(iclass))
         images = sorted(os.listdir(os.path.join(path_to_trainingset, iclass)))
@@ -164,21 +170,228 @@ def pickle_trainingset(path_to_trainingset,
                 tmpDF[information_on_image[-1]] = [image_data]
             tmpDF['gravityspy_id'] = information_on_image[1]
             tmpDF['true_label'] = iclass
-            data = data.append(tmpDF)
+            samples_data.append(tmpDF)
 
         logger.info('Finished converting {0} into b/w info'.format(iclass))
 
+    data = pd.concat(samples_data)
+
     picklepath = os.path.join(save_address)
     logger.info('Saving pickled data to {0}'.format(picklepath))
     data.to_pickle(picklepath)
     return data
 
 
+def store_trainingset(path_to_trainingset,
+                      save_address='pickleddata/trainingset.h5',
+                      nproc=1, verbose=False):
+    """Pre-processes the training set images and save to a `PixelStore`.
+
+    Parameters:
+
+        path_to_trainingset (str):
+            Path to trainingset where format of training set folder
+            is "somedirectoryname"/"classname/"images"
+
+        save_address (str, optional):
+            Defaults to `pickleddata/trainingset.h5`
+            HDF5 file you would like to save the pixelated training data to
+
+        nproc (int, optional):
+            Defaults to 1
+            Number of processes decoding images
+
+        verbose (bool, optional):
+            Defaults to False
+            Extra verbosity
+
+    Returns:
+
+        `PixelStore`:
+            with a row per sample holding the pixelated 0.5, 1.0, 2.0,
+            and 4.0 duration images, the true_label and an ID
+            that uniquely identifies that sample
+    """
+    grayscale_store, _ = pixelize_trainingset(path_to_trainingset,
+                                              grayscale_file=save_address,
+                                              nproc=nproc, verbose=verbose)
+    return grayscale_store
+
+
+def sample_per_class(data, fraction, random_seed=1986):
+    """Set aside the same fraction of the samples of every class
+
+    Parameters:
+
+        data (`pandas.DataFrame`):
+            with a ``true_label`` column
+
+        fraction (float):
+            of the samples of each class to draw
+
+        random_seed (int, optional):
+            Default 1986
+
+    Returns:
+
+        `pandas.DataFrame` of the samples drawn
+    """
+    return data.groupby('true_label').apply(
+               lambda x: x.sample(frac=fraction,
+                                  random_state=random_seed)
+               ).reset_index(drop=True)
+
+
+def hold_out(data, fraction_validation, fraction_testing=None,
+             random_seed=1986):
+    """Split the samples `make_model` trains on from those it holds out
+
+    Parameters:
+
+        data (`pandas.DataFrame`):
+            with ``gravityspy_id`` and ``true_label`` columns
+
+        fraction_validation (float):
+            of the samples of each class to validate on
+
+        fraction_testing (float, optional):
+            Default None, of the samples of each class left after
+            validation to test on
+
+        random_seed (int, optional):
+            Default 1986
+
+    Returns:
+
+        data (`pandas.DataFrame`):
+            the samples to train on
+
+        validationDF (`pandas.DataFrame`):
+            the samples to validate on
+
+        testingDF (`pandas.DataFrame`):
+            the samples to test on, None without ``fraction_testing``
+    """
+    validationDF = sample_per_class(data, fraction_validation, random_seed)
+    data = data.loc[~data.gravityspy_id.isin(validationDF.gravityspy_id)]
+    testingDF = None
+    if fraction_testing:
+        testingDF = sample_per_class(data, fraction_testing, random_seed)
+        data = data.loc[~data.gravityspy_id.isin(testingDF.gravityspy_id)]
+    return data, validationDF, testingDF
+
+
+class PixelStoreSequence(Sequence):
+    """Batches of merged views read from a `PixelStore` as they are needed
+
+    Only the rows of one batch are read and merged at a time, so the
+    training set never has to fit in memory. The store is opened again
+    in every process, so the batches can be made by the worker
+    processes of `keras.models.Model.fit_generator`.
+
+    Parameters:
+
+        filename (str):
+            path to the grayscale `PixelStore`
+
+        index (array):
+            the rows of the store to draw samples from
+
+        labels (array):
+            the class index of each sample
+
+        nb_classes (int):
+            number of classes
+
+        batch_size (int, optional):
+            Default 22
+
+        image_size (list, optional):
+            Default [140, 170]
+
+        order_of_channels (str, optional):
+            Default 'channels_last'
+
+        shuffle (bool, optional):
+            Default True, draw the samples in a new order every epoch
+
+        random_seed (int, optional):
+            Default 1986, the order of every epoch is drawn from it and
+            the number of the epoch, so a resumed run draws the same
+            batches as one that was never stopped
+
+        initial_epoch (int, optional):
+            Default 0, the epoch the first batches are drawn for
+    """
+    def __init__(self, filename, index, labels, nb_classes, batch_size=22,
+                 image_size=[140, 170], order_of_channels='channels_last',
+                 shuffle=True, random_seed=1986, initial_epoch=0):
+        if order_of_channels == 'channels_last':
+            self.reshape_order = (-1, image_size[0], image_size[1], 1)
+        elif order_of_channels == 'channels_first':
+            self.reshape_order = (-1, 1, image_size[0], image_size[1])
+        else:
+            raise ValueError("Do not understand supplied channel order")
+        self.filename = filename
+        self.index = np.asarray(index, dtype=int)
+        self.labels = np.asarray(labels, dtype=int)
+        self.nb_classes = nb_classes
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.order_of_channels = order_of_channels
+        self.shuffle = shuffle
+        self.random_seed = random_seed
+        self.epoch = initial_epoch
+        self.order = self._draw_order()
+        self._store = None
+        self._pid = None
+
+    def __len__(self):
+        return int(np.ceil(len(self.index) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        rows = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        store = self.store
+        views = [store.read(column, self.index[rows]).reshape(
+                     self.reshape_order)
+                 for column in DURATIONS]
+        concat = concatenate_views(*(views + [self.image_size, False,
+                                              self.order_of_channels]),
+                                   dtype=np.float32)
+        return concat, np_utils.to_categorical(self.labels[rows],
+                                                self.nb_classes)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self._draw_order()
+
+    def _draw_order(self):
+        if not self.shuffle:
+            return np.arange(len(self.index))
+        rng = np.random.RandomState(self.random_seed + self.epoch)
+        return rng.permutation(len(self.index))
+
+    @property
+    def store(self):
+        # HDF5 handles cannot be shared with forked processes
+        if self._pid != os.getpid():
+            self._store = PixelStore(self.filename)
+            self._pid = os.getpid()
+        return self._store
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_store'] = None
+        state['_pid'] = None
+        return state
+
+
 def make_model(data, batch_size=22, nb_epoch=10,
                order_of_channels="channels_last",
                nb_classes=22, fraction_validation=.125, fraction_testing=None,
                best_model_based_validset=0, image_size=[140, 170],
-               random_seed=1986, verbose=True):
+               use_generator=False, workers=1, max_queue_size=10,
+               checkpoint_dir=None, random_seed=1986, verbose=True):
     """Train a Convultional Neural Net (CNN).
 
     This module uses `keras <https://keras.io/>`_ to interface
@@ -191,8 +404,9 @@ def make_model(data, batch_size=22, nb_epoch=10,
     The loss function being optimized is `softmax <https://en.wikipedia.org/wiki/Softmax_function>`_
 
     Parameters:
-        data (str):
-            Pickle file containing training set data
+        data (`pandas.DataFrame`, `PixelStore`):
+            training set data as made by `pickle_trainingset`
+            or `store_trainingset`
 
         model_name (str, optional):
             Defaults to `multi_view_classifier.h5`
@@ -217,11 +431,31 @@ def make_model(data, batch_size=22, nb_epoch=10,
             Default 1
 
         best_model_based_validset (int,optional):
-            Default 0
+            Default 0, if 1 and ``checkpoint_dir`` is given, the model
+            returned has the weights of the epoch with the lowest
+            validation loss rather than of the last epoch
 
         image_size (list, optional):
             Default [140, 170]
 
+        use_generator (bool, optional):
+            Default False, read the batches from ``data``, which must be
+            a `PixelStore`, with a `PixelStoreSequence` rather than
+            holding the whole training set in memory
+
+        workers (int, optional):
+            Default 1, number of processes making batches
+            when ``use_generator`` is True
+
+        max_queue_size (int, optional):
+            Default 10, number of batches made ahead of time
+            when ``use_generator`` is True
+
+        checkpoint_dir (str, optional):
+            Default None, folder to save a `TrainingCheckpoint` to
+            after every epoch, training resumes from the checkpoint
+            found there if any
+
         random_seed (int, optional):
             Default 1986
 
@@ -247,6 +481,14 @@ def make_model(data, batch_size=22, nb_epoch=10,
 
     logger.info('The size of the images being trained {0}'.format(image_size))
 
+    # keep the pixels where they are and only split the IDs and labels
+    pixels = data
+    if isinstance(data, PixelStore):
+        data = data.to_pandas()
+    else:
+        data = data[['gravityspy_id', 'true_label']].reset_index(drop=True)
+    data['pixel_index'] = np.arange(len(data))
+
     classes = sorted(data.true_label.unique())
 
     if len(classes) != nb_classes:
@@ -267,37 +509,83 @@ def make_model(data, batch_size=22, nb_epoch=10,
                 'images per class for validation.'.format(
                                        fraction_validation * 100))
 
-    validationDF = data.groupby('true_label').apply(
-                       lambda x: x.sample(frac=fraction_validation,
-                       random_state=random_seed)
-                       ).reset_index(drop=True)
+    if fraction_testing:
+        logger.info('Selecting samples for testing ...')
+        logger.info('You have selected to set aside {0} percent of '
+                'images per class for validation.'.format(
+
+                                       fraction_testing * 100))
 
-    logger.info('Removing validation images from training DF ...')
+    logger.info('Removing the held out images from training DF ...')
 
-    data = data.loc[~data.gravityspy_id.isin(
-                                    validationDF.gravityspy_id)]
+    data, validationDF, testingDF = hold_out(data, fraction_validation,
+                                             fraction_testing, random_seed)
 
     logger.info('There are now {0} samples remaining'.format(
                                                        len(data)))
 
-    if fraction_testing:
-        logger.info('Selecting samples for testing ...')
-        logger.info('You have selected to set aside {0} percent of '
-                'images per class for validation.'.format(
+    cnn1 = build_cnn(img_rows*2, img_cols*2, order_of_channels)
+    final_model = Sequential()
+    final_model.add(cnn1)
+    final_model.add(Dense(nb_classes, activation='softmax'))
 
-                                       fraction_testing * 100))
-        testingDF = data.groupby('true_label').apply(
-                   lambda x: x.sample(frac=fraction_testing,
-                             random_state=random_seed)
-                   ).reset_index(drop=True)
+    final_model.compile(loss='categorical_crossentropy',
+                        optimizer='adadelta',
+                        metrics=['accuracy'])
 
-        logger.info('Removing testing images from training DF ...')
+    def resume():
+        if checkpoint_dir is None:
+            return None, [], 0
+        checkpoint = TrainingCheckpoint(checkpoint_dir, verbose=verbose)
+        return checkpoint, [checkpoint], checkpoint.resume(final_model)
+
+    if use_generator:
+        if not isinstance(pixels, PixelStore):
+            raise ValueError('Training from a generator needs the training '
+                             'set in a PixelStore')
+
+        def sequence(df, shuffle, initial_epoch=0):
+            return PixelStoreSequence(pixels.filename,
+                                      df['pixel_index'].values,
+                                      df['true_label'].values, nb_classes,
+                                      batch_size=batch_size,
+                                      image_size=image_size,
+                                      order_of_channels=order_of_channels,
+                                      shuffle=shuffle,
+                                      random_seed=random_seed,
+                                      initial_epoch=initial_epoch)
+
+        checkpoint, callbacks, initial_epoch = resume()
+        train_sequence = sequence(data, True, initial_epoch)
+        valid_sequence = sequence(validationDF, False)
+        fit_options = dict(workers=workers,
+                           use_multiprocessing=workers > 1,
+                           max_queue_size=max_queue_size)
+
+        logger.info('Reading batches from {0} with {1} workers'.format(
+            pixels.filename, workers))
+        final_model.fit_generator(train_sequence, epochs=nb_epoch, verbose=1,
+                                  validation_data=valid_sequence,
+                                  callbacks=callbacks,
+                                  initial_epoch=initial_epoch,
+                                  **fit_options)
+        if checkpoint is not None and best_model_based_validset:
+            checkpoint.restore_best(final_model)
+
+        if fraction_testing:
+            score = final_model.evaluate_generator(
+                        sequence(testingDF, False), **fit_options)
+            logger.info('Test accuracy (last): {0}'.format(score[1]))
+
+        score2 = final_model.evaluate_generator(valid_sequence,
+                                                **fit_options)
+        logger.info('valid accuracy (last): {0}'.format(score2[1]))
 
-        data = data.loc[~data.gravityspy_id.isin(
-                                        testingDF.gravityspy_id)]
+        score3 = final_model.evaluate_generator(sequence(data, False),
+                                                **fit_options)
+        logger.info('Train accuracy (last): {0}'.format(score3[1]))
 
-        logger.info('There are now {0} samples remaining'.format(
-                                                           len(data)))
+        return final_model
 
     if order_of_channels == 'channels_last':
         reshape_order = (-1, img_rows, img_cols, 1)
@@ -306,23 +594,23 @@ def make_model(data, batch_size=22, nb_epoch=10,
     else:
         raise ValueError("Do not understand supplied channel order")
     # concatenate the pixels
-    train_set_x_1 = np.vstack(data['0.5.png'].values).reshape(reshape_order)
-    validation_x_1 = np.vstack(validationDF['0.5.png'].values).reshape(reshape_order)
+    train_set_x_1 = read_column(pixels, '0.5.png', data['pixel_index'].values).reshape(reshape_order)
+    validation_x_1 = read_column(pixels, '0.5.png', validationDF['pixel_index'].values).reshape(reshape_order)
 
-    train_set_x_2 = np.vstack(data['1.0.png'].values).reshape(reshape_order)
-    validation_x_2 = np.vstack(validationDF['1.0.png'].values).reshape(reshape_order)
+    train_set_x_2 = read_column(pixels, '1.0.png', data['pixel_index'].values).reshape(reshape_order)
+    validation_x_2 = read_column(pixels, '1.0.png', validationDF['pixel_index'].values).reshape(reshape_order)
 
-    train_set_x_3 = np.vstack(data['2.0.png'].values).reshape(reshape_order)
-    validation_x_3 = np.vstack(validationDF['2.0.png'].values).reshape(reshape_order)
+    train_set_x_3 = read_column(pixels, '2.0.png', data['pixel_index'].values).reshape(reshape_order)
+    validation_x_3 = read_column(pixels, '2.0.png', validationDF['pixel_index'].values).reshape(reshape_order)
 
-    train_set_x_4 = np.vstack(data['4.0.png'].values).reshape(reshape_order)
-    validation_x_4 = np.vstack(validationDF['4.0.png'].values).reshape(reshape_order)
+    train_set_x_4 = read_column(pixels, '4.0.png', data['pixel_index'].values).reshape(reshape_order)
+    validation_x_4 = read_column(pixels, '4.0.png', validationDF['pixel_index'].values).reshape(reshape_order)
 
     if fraction_testing:
-        testing_x_1 = np.vstack(testingDF['0.5.png'].values).reshape(reshape_order)
-        testing_x_2 = np.vstack(testingDF['1.0.png'].values).reshape(reshape_order)
-        testing_x_3 = np.vstack(testingDF['2.0.png'].values).reshape(reshape_order)
-        testing_x_4 = np.vstack(testingDF['4.0.png'].values).reshape(reshape_order)
+        testing_x_1 = read_column(pixels, '0.5.png', testingDF['pixel_index'].values).reshape(reshape_order)
+        testing_x_2 = read_column(pixels, '1.0.png', testingDF['pixel_index'].values).reshape(reshape_order)
+        testing_x_3 = read_column(pixels, '2.0.png', testingDF['pixel_index'].values).reshape(reshape_order)
+        testing_x_4 = read_column(pixels, '4.0.png', testingDF['pixel_index'].values).reshape(reshape_order)
 
     # Concatenate the labels
     trainingset_labels = np.vstack(data['true_label'].values)
@@ -358,18 +646,14 @@ def make_model(data, batch_size=22, nb_epoch=10,
                             testing_x_3, testing_x_4,
                             [img_rows, img_cols], False,order_of_channels)
 
-    cnn1 = build_cnn(img_rows*2, img_cols*2, order_of_channels)
-    final_model = Sequential()
-    final_model.add(cnn1)
-    final_model.add(Dense(nb_classes, activation='softmax'))
-
-    final_model.compile(loss='categorical_crossentropy',
-                        optimizer='adadelta',
-                        metrics=['accuracy'])
+    checkpoint, callbacks, initial_epoch = resume()
 
     final_model.fit(concat_train, trainingset_labels,
         batch_size=batch_size, epochs=nb_epoch, verbose=1,
-        validation_data=(concat_valid, validation_labels), callbacks=[])
+        validation_data=(concat_valid, validation_labels),
+        callbacks=callbacks, initial_epoch=initial_epoch)
+    if checkpoint is not None and best_model_based_validset:
+        checkpoint.restore_best(final_model)
 
     if fraction_testing:
         score = final_model.evaluate(concat_test, testing_labels, verbose=0)
@@ -390,3 +674,170 @@ def make_model(data, batch_size=22, nb_epoch=10,
         logger.info('Train accuracy (last): {0}'.format(score3[1]))
 
     return final_model
+
+
+def fine_tune(model_name, data, batch_size=22, nb_epoch=20,
+              order_of_channels="channels_last", fraction_validation=.125,
+              unfreeze_last_block=False, image_size=[140, 170],
+              chunk_size=256, random_seed=1986, verbose=True):
+    """Teach a trained classifier new classes without training it again
+
+    The softmax layer of the model is widened with a column for each class
+    of ``data`` it does not know, keeping the weights of the classes it
+    does. The network below is run once over the training set and only
+    the layers above its output are then trained on these cached
+    activations, which takes minutes rather than days.
+
+    Parameters:
+        model_name (str):
+            path to the classifier, with its class labels in
+            ``/labels/labels`` as written by ``trainmodel``
+
+        data (`pandas.DataFrame`, `PixelStore`):
+            training set data of all of the classes, old and new,
+            as made by `pickle_trainingset` or `store_trainingset`
+
+        batch_size (int, optional):
+            Default 22
+
+        nb_epoch (int, optional):
+            Default 20
+
+        fraction_validation (float, optional):
+            Default .125
+
+        unfreeze_last_block (bool, optional):
+            Default False, train the last convolutional block as well,
+            in which case the activations cached are its input
+
+        image_size (list, optional):
+            Default [140, 170]
+
+        chunk_size (int, optional):
+            Default 256, samples merged and run through the frozen
+            layers at a time
+
+        random_seed (int, optional):
+            Default 1986
+
+    Returns:
+        model (`keras.models.Sequential`):
+            the classifier with the widened softmax layer
+
+        classes (list):
+            the sorted class labels matching its outputs,
+            to save as ``/labels/labels``
+    """
+    logger = log.Logger('Gravity Spy: Fine Tuning '
+                        'Model')
+
+    logger.info('Using random seed {0}'.format(random_seed))
+    np.random.seed(random_seed)  # for reproducibility
+    K.set_image_data_format(order_of_channels)
+
+    with h5py.File(model_name, 'r') as f:
+        old_classes = list(np.array(f['/labels/labels']).astype(str).T[0])
+    old_model = load_model(model_name, compile=False)
+    cnn = old_model.layers[0]
+    old_weight, old_bias = old_model.layers[-1].get_weights()
+
+    # keep the pixels where they are and only split the IDs and labels
+    pixels = data
+    if isinstance(data, PixelStore):
+        data = data.to_pandas()
+    else:
+        data = data[['gravityspy_id', 'true_label']].reset_index(drop=True)
+    data['pixel_index'] = np.arange(len(data))
+
+    new_classes = sorted(set(data.true_label.unique()) - set(old_classes))
+    if not new_classes:
+        raise ValueError('The data set does not hold any class this '
+                         'model does not already know')
+    classes = sorted(old_classes + new_classes)
+    nb_classes = len(classes)
+    logger.info('Adding the classes {0} to the {1} classes of {2}'.format(
+        new_classes, len(old_classes), model_name))
+
+    # the old classes keep their weights, the new ones start small
+    weight = np.random.normal(scale=old_weight.std(),
+                              size=(old_weight.shape[0], nb_classes))
+    bias = np.full(nb_classes, old_bias.mean())
+    old_columns = [classes.index(label) for label in old_classes]
+    weight[:, old_columns] = old_weight
+    bias[old_columns] = old_bias
+    softmax = Dense(nb_classes, activation='softmax')
+
+    # split the network where the trained layers start
+    if unfreeze_last_block:
+        start = max(idx for idx, layer in enumerate(cnn.layers)
+                    if isinstance(layer, Conv2D))
+        frozen = Model(inputs=cnn.input, outputs=cnn.layers[start - 1].output)
+    else:
+        start = len(cnn.layers)
+        frozen = cnn
+    for layer in cnn.layers[:start]:
+        layer.trainable = False
+
+    data['true_label'] = data.true_label.apply(classes.index)
+    data, validationDF, _ = hold_out(data, fraction_validation,
+                                     random_seed=random_seed)
+
+    if order_of_channels == 'channels_last':
+        reshape_order = (-1, image_size[0], image_size[1], 1)
+    elif order_of_channels == 'channels_first':
+        reshape_order = (-1, 1, image_size[0], image_size[1])
+    else:
+        raise ValueError("Do not understand supplied channel order")
+
+    def activations(df):
+        index = df['pixel_index'].values
+        output = []
+        for first in range(0, len(index), chunk_size):
+            rows = index[first:first + chunk_size]
+            views = [read_column(pixels, column, rows).reshape(reshape_order)
+                     for column in DURATIONS]
+            output.append(frozen.predict(
+                concatenate_views(*(views + [image_size, False,
+                                             order_of_channels]),
+                                  dtype=np.float32),
+                batch_size=chunk_size))
+        return np.concatenate(output)
+
+    logger.info('Caching the activations of the frozen layers ...')
+    train_activations = activations(data)
+    train_labels = np_utils.to_categorical(data['true_label'].values,
+                                           nb_classes)
+    validation_data = None
+    if len(validationDF):
+        validation_data = (activations(validationDF),
+                           np_utils.to_categorical(
+                               validationDF['true_label'].values, nb_classes))
+
+    # the trained layers, shared with the classifier returned
+    head_input = Input(shape=train_activations.shape[1:])
+    x = head_input
+    for layer in cnn.layers[start:]:
+        x = layer(x)
+    head = Model(inputs=head_input, outputs=softmax(x))
+    softmax.set_weights([weight, bias])
+    head.compile(loss='categorical_crossentropy', optimizer='adadelta',
+                 metrics=['accuracy'])
+
+    logger.info('Training the layers above the cached activations ...')
+    head.fit(train_activations, train_labels, batch_size=batch_size,
+             epochs=nb_epoch, verbose=1, validation_data=validation_data)
+
+    if validation_data is not None:
+        score = head.evaluate(*validation_data, verbose=0)
+        logger.info('valid accuracy (last): {0}'.format(score[1]))
+
+    for layer in cnn.layers:
+        layer.trainable = True
+    final_model = Sequential()
+    final_model.add(cnn)
+    final_model.add(softmax)
+    final_model.compile(loss='categorical_crossentropy',
+                        optimizer='adadelta',
+                        metrics=['accuracy'])
+
+    return final_model, classes
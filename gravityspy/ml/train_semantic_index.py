@@ -1,7 +1,8 @@
 import keras.backend as K
-from GS_utils import (cosine_distance,
-                      siamese_acc, eucl_dist_output_shape,
-                      contrastive_loss, concatenate_views)
+from .GS_utils import (cosine_distance,
+                       siamese_acc, eucl_dist_output_shape,
+                       contrastive_loss, concatenate_views,
+                       create_pairs3_gen)
 from keras import regularizers
 from keras.applications.vgg16 import VGG16, preprocess_input
 from keras.layers import Input, Dense, GlobalAveragePooling2D, Lambda
@@ -12,7 +13,11 @@ from itertools import combinations
 
 from gravityspy.utils import log
 from .read_image import read_rgb
+from .pixel_store import PixelStore, pixelize_trainingset, read_column
+from .checkpoint import TrainingCheckpoint
 
+import h5py
+import hashlib
 import numpy
 import os
 import pandas
@@ -59,7 +64,9 @@ def pickle_trainingset(path_to_trainingset,
     logger.info('The classes you are pickling are {0}'.format(
           classes))
 
-    data = pandas.DataFrame()
+    # collect the samples and build the DataFrame once at the end,
+    # appending to it sample by sample is quadratic
+    samples_data = []
     for iclass in classes:
         logger.info('Converting {0} into RGB info'.format(iclass))
         images = sorted(os.listdir(os.path.join(path_to_trainingset, iclass)))
@@ -79,15 +86,52 @@ def pickle_trainingset(path_to_trainingset,
                 tmpdf[information_on_image[-1]] = [[image_data_r, image_data_g, image_data_b]]
             tmpdf['gravityspy_id'] = information_on_image[1]
             tmpdf['true_label'] = iclass
-            data = data.append(tmpdf)
+            samples_data.append(tmpdf)
 
         logger.info('Finished converting {0} into b/w info'.format(iclass))
 
+    data = pandas.concat(samples_data)
+
     picklepath = os.path.join(save_address)
     logger.info('Saving pickled data to {0}'.format(picklepath))
     data.to_pickle(picklepath)
     return data
 
+def store_trainingset(path_to_trainingset,
+                      save_address='pickleddata/rgb_trainingset.h5',
+                      nproc=1, verbose=False):
+    """Pre-processes the training set images and save to a `PixelStore`.
+
+    Parameters:
+
+        path_to_trainingset (str):
+            Path to trainingset where format of training set folder
+            is "somedirectoryname"/"classname/"images"
+
+        save_address (str, optional):
+            Defaults to `pickleddata/rgb_trainingset.h5`
+            HDF5 file you would like to save the pixelated training data to
+
+        nproc (int, optional):
+            Defaults to 1
+            Number of processes decoding images
+
+        verbose (bool, optional):
+            Defaults to False
+            Extra verbosity
+
+    Returns:
+
+        `PixelStore`:
+            with a row per sample holding the (3, npixels) RGB pixels
+            of the 0.5, 1.0, 2.0, and 4.0 duration images, the true_label
+            and an ID that uniquely identifies that sample
+    """
+    _, rgb_store = pixelize_trainingset(path_to_trainingset,
+                                        rgb_file=save_address,
+                                        nproc=nproc, verbose=verbose)
+    return rgb_store
+
 def make_model(data,
                order_of_channels="channels_last",
                unknown_classes_labels=['Paired_Doves', 'Power_Line',
@@ -109,6 +153,8 @@ def make_model(data,
                training_steps_per_epoch=1000,
                validation_steps_per_epoch=100,
                image_size=[140, 170],
+               embedding_cache=None,
+               checkpoint_dir=None, best_model_based_validset=0,
                random_seed=1986, verbose=True):
     """Train a Semantic Index.
 
@@ -122,8 +168,9 @@ def make_model(data,
     The loss function being optimized is `softmax <https://en.wikipedia.org/wiki/Softmax_function>`_
 
     Parameters:
-        data (`pandas.DataFrame`):
-            pandas Data Frame scontianing the RGB values for the training set
+        data (`pandas.DataFrame`, `PixelStore`):
+            the RGB values for the training set as made by
+            `pickle_trainingset` or `store_trainingset`
 
         unknown_classes_labels (list, optional):
             Defaults to
@@ -167,6 +214,26 @@ def make_model(data,
             This refers to the shape of the non flattened pixelized image
             array: default = [140, 170]
 
+        embedding_cache (str, optional):
+            Default None, an HDF5 file. If given and ``train_vgg`` is
+            False, the frozen VGG16 layers are run once over the
+            training set, their pooled output is cached in this file,
+            or read from it if the cache matches the training set,
+            and only the dense layers are trained on the cached
+            embeddings. A `PixelStore` is matched by its file and
+            when it was modified, a `pandas.DataFrame` only by its
+            IDs, so delete the cache if its pixels change
+
+        checkpoint_dir (str, optional):
+            Default None, folder to save a `TrainingCheckpoint` to
+            after every epoch, training resumes from the checkpoint
+            found there if any
+
+        best_model_based_validset (int, optional):
+            Default 0, if 1 and ``checkpoint_dir`` is given, the models
+            returned have the weights of the epoch with the lowest
+            validation loss rather than of the last epoch
+
     Returns:
         semantic_idx_model (`keras.Model`):
             this model gives you a 200 dimensional feature space output
@@ -202,6 +269,14 @@ def make_model(data,
     # Create dict matching string labels to idx labels
     logger.info('Removing NOA images from the training set.')
 
+    # keep the pixels where they are and only select the IDs and labels
+    pixels = data
+    if isinstance(data, PixelStore):
+        data = data.to_pandas()
+    else:
+        data = data[['gravityspy_id', 'true_label']].reset_index(drop=True)
+    data['pixel_index'] = numpy.arange(len(data))
+
     data = data.loc[data.true_label != 'None_of_the_Above']
     tmp = dict(enumerate(sorted(data.true_label.unique())))
     str_to_idx = dict((str(v),k) for k,v in tmp.items())
@@ -229,71 +304,76 @@ def make_model(data,
     known_data_label = known_df['idx_label'].values
     unknown_data_label = unknown_df['idx_label'].values
 
-    known_x_1 = numpy.vstack(known_df['0.5.png'].values).reshape(reshape_order)
-    unknown_x_1 = numpy.vstack(unknown_df['0.5.png'].values).reshape(reshape_order)
-
-    known_x_2 = numpy.vstack(known_df['1.0.png'].values).reshape(reshape_order)
-    unknown_x_2 = numpy.vstack(unknown_df['1.0.png'].values).reshape(reshape_order)
-
-    known_x_3 = numpy.vstack(known_df['2.0.png'].values).reshape(reshape_order)
-    unknown_x_3 = numpy.vstack(unknown_df['2.0.png'].values).reshape(reshape_order)
-
-    known_x_4 = numpy.vstack(known_df['4.0.png'].values).reshape(reshape_order)
-    unknown_x_4 = numpy.vstack(unknown_df['4.0.png'].values).reshape(reshape_order)
-
     if multi_view:
-        known_classes = concatenate_views(known_x_1, known_x_2,
-                                          known_x_3, known_x_4,
-                                          [img_rows, img_cols],
-                                          True, order_of_channels)
-        unknown_classes = concatenate_views(unknown_x_1, unknown_x_2,
-                                            unknown_x_3, unknown_x_4,
-                                            [img_rows, img_cols],
-                                            True, order_of_channels)
-    else:
-        # We are only using one duration for the similarity search
-        known_classes = known_x_2
-        unknown_classes = unknown_x_2
-
-    known_classes = preprocess_input(known_classes)
-    unknown_classes = preprocess_input(unknown_classes)
-
-    known_classes = known_classes.astype(numpy.float32)
-    unknown_classes = unknown_classes.astype(numpy.float32)
+        # the four views are tiled two by two
+        if order_of_channels == 'channels_last':
+            channels_order = (2*img_rows, 2*img_cols, 3)
+        else:
+            channels_order = (3, 2*img_rows, 2*img_cols)
+
+    def read_images(df):
+        """Read and preprocess the images of some samples
+        """
+        index = df['pixel_index'].values
+        if multi_view:
+            images = concatenate_views(*[read_column(pixels, column,
+                                                     index).reshape(
+                                             reshape_order)
+                                         for column in ['0.5.png', '1.0.png',
+                                                        '2.0.png', '4.0.png']]
+                                       + [[img_rows, img_cols], True,
+                                          order_of_channels])
+        else:
+            # We are only using one duration for the similarity search
+            images = read_column(pixels, '1.0.png',
+                                 index).reshape(reshape_order)
+        return preprocess_input(images).astype(numpy.float32)
 
     known_classes_indices_for_metric_learning = [numpy.where(known_data_label == i)[0] for i in known_classes_labels_idx]
     unknown_classes_indices_for_metric_learning = [numpy.where(unknown_data_label == i)[0] for i in unknown_classes_labels_idx]
-    # create binary pairs for known classes
-    train_generator = create_pairs3_gen(known_classes, known_classes_indices_for_metric_learning,
-                                         batch_size)
-    valid_generator = create_pairs3_gen(unknown_classes, unknown_classes_indices_for_metric_learning,
-                                        batch_size)
-
     # Create the model
     vgg16 = VGG16(weights='imagenet', include_top=False,
-                  input_shape=known_classes.shape[1:])
-    x = vgg16.output
-    x = GlobalAveragePooling2D()(x)
-    # let's add a fully-connected layer
-    x = Dense(1024, kernel_regularizer=regularizers.l2(reglularization))(x)
-    x = Dense(200)(x)
-    predictions = LeakyReLU(alpha=0.3)(x)
+                  input_shape=channels_order)
+    pooled = GlobalAveragePooling2D()(vgg16.output)
+    # let's add a fully-connected layer, the same layers are applied
+    # to the cached embeddings when only they are trained
+    dense_layers = [Dense(1024, kernel_regularizer=regularizers.l2(reglularization)),
+                    Dense(200),
+                    LeakyReLU(alpha=0.3)]
+    x = pooled
+    for layer in dense_layers:
+        x = layer(x)
+    predictions = x
 
     #Then create the corresponding model
     base_network = Model(inputs=vgg16.input, outputs=predictions)
 
-    if order_of_channels == 'channels_last':
-        if multi_view:
-            img_cols = 2*img_cols
-            img_rows = 2*img_rows
-        channels_order = (img_rows, img_cols, 3)
-    elif order_of_channels == 'channels_first':
-        if multi_view:
-            img_cols = 2*img_cols
-            img_rows = 2*img_rows
-        channels_order = (3, img_rows, img_cols)
+    use_cache = embedding_cache is not None and not train_vgg
+    if use_cache:
+        # the frozen layers give the same output at every step
+        # so run them once over the training set, the pixels are
+        # only read if the cache does not hold these samples
+        backbone = Model(inputs=vgg16.input, outputs=pooled)
+        key = 'multi_view={0} order_of_channels={1}'.format(
+                  multi_view, order_of_channels)
+        if isinstance(pixels, PixelStore):
+            key += ' {0} {1}'.format(os.path.abspath(pixels.filename),
+                                     os.path.getmtime(pixels.filename))
+        known_classes = cached_embeddings(backbone,
+                                          lambda: read_images(known_df),
+                                          known_df['gravityspy_id'].values,
+                                          embedding_cache, 'known',
+                                          image_shape=channels_order,
+                                          key=key, verbose=verbose)
+        unknown_classes = cached_embeddings(backbone,
+                                            lambda: read_images(unknown_df),
+                                            unknown_df['gravityspy_id'].values,
+                                            embedding_cache, 'unknown',
+                                            image_shape=channels_order,
+                                            key=key, verbose=verbose)
     else:
-        raise ValueError("Do not understand supplied channel order")
+        known_classes = read_images(known_df)
+        unknown_classes = read_images(unknown_df)
 
     input_a = Input(shape=channels_order)
     input_b = Input(shape=channels_order)
@@ -316,9 +396,27 @@ def make_model(data,
 
     similarity_model.summary()
     semantic_idx_model.summary()
+
+    # the model being fitted, the dense layers alone on cached embeddings
+    trained_model = similarity_model
+    if use_cache:
+        embedding_a = Input(shape=known_classes.shape[1:])
+        embedding_b = Input(shape=known_classes.shape[1:])
+        head_a = embedding_a
+        head_b = embedding_b
+        for layer in dense_layers:
+            head_a = layer(head_a)
+            head_b = layer(head_b)
+        distance = Lambda(cosine_distance,
+                          output_shape=eucl_dist_output_shape)(
+                              [head_a, head_b]
+                          )
+        trained_model = Model(inputs=[embedding_a, embedding_b],
+                              outputs=distance)
+
     rms = RMSprop()
 
-    similarity_model.compile(loss=contrastive_loss, optimizer=rms,
+    trained_model.compile(loss=contrastive_loss, optimizer=rms,
                              metrics=[siamese_acc(0.1), siamese_acc(0.3), siamese_acc(0.4),
                                       siamese_acc(0.5), siamese_acc(0.6),
                                       siamese_acc(0.7), siamese_acc(0.8),
@@ -326,71 +424,143 @@ def make_model(data,
                                       siamese_acc(0.95), siamese_acc(0.975),
                                       siamese_acc(0.985),siamese_acc(0.99)])
 
+    checkpoint = None
+    callbacks = []
+    initial_epoch = 0
+    if checkpoint_dir is not None:
+        checkpoint = TrainingCheckpoint(checkpoint_dir, verbose=verbose)
+        callbacks.append(checkpoint)
+        initial_epoch = checkpoint.resume(trained_model)
+
+    # create binary pairs for known classes, drawn for every epoch from
+    # its number, so a resumed run draws the pairs of an unstopped one
+    train_generator = create_pairs3_gen(known_classes, known_classes_indices_for_metric_learning,
+                                        batch_size,
+                                        random_state=random_seed,
+                                        prefetch=2,
+                                        steps_per_epoch=training_steps_per_epoch,
+                                        initial_epoch=initial_epoch)
+    valid_generator = create_pairs3_gen(unknown_classes, unknown_classes_indices_for_metric_learning,
+                                        batch_size,
+                                        random_state=random_seed + 1,
+                                        prefetch=2,
+                                        steps_per_epoch=validation_steps_per_epoch,
+                                        initial_epoch=initial_epoch)
+
     # train
     logger.info('training the model ...')
 
     logger.info('training steps per epoch {0}'.format(training_steps_per_epoch))
     logger.info('validation steps per epoch {0}'.format(validation_steps_per_epoch))
 
-    similarity_model.fit_generator(train_generator,
-                                   validation_data=valid_generator,
-                                   steps_per_epoch=training_steps_per_epoch,
-                                   validation_steps=validation_steps_per_epoch,
-                                   epochs=nb_epoch,
-                                   verbose=2,
-                                   )
+    trained_model.fit_generator(train_generator,
+                                validation_data=valid_generator,
+                                steps_per_epoch=training_steps_per_epoch,
+                                validation_steps=validation_steps_per_epoch,
+                                epochs=nb_epoch,
+                                verbose=2,
+                                callbacks=callbacks,
+                                initial_epoch=initial_epoch,
+                                )
+    if checkpoint is not None and best_model_based_validset:
+        checkpoint.restore_best(trained_model)
 
     # validation
     logger.info('validating the model')
 
     logger.info('Known classes')
-    res1 = similarity_model.evaluate_generator(train_generator,
-                                               training_steps_per_epoch)
+    res1 = trained_model.evaluate_generator(train_generator,
+                                            training_steps_per_epoch)
     logger.info(res1)
 
     logger.info(' unknown classes')
-    res2 = similarity_model.evaluate_generator(valid_generator,
-                                               validation_steps_per_epoch)
+    res2 = trained_model.evaluate_generator(valid_generator,
+                                            validation_steps_per_epoch)
     logger.info(res2)
 
     return semantic_idx_model, similarity_model
 
-def create_pairs3_gen(data, class_indices, batch_size):
-    pairs1 = []
-    pairs2 = []
-    labels = []
-    number_of_classes = len(class_indices)
-    counter = 0
-    while True:
-        for d in numpy.random.randint(0, number_of_classes, size=number_of_classes):
-            num_images_in_class_d = len(class_indices[d])
-            for i in numpy.random.randint(0, num_images_in_class_d, size=num_images_in_class_d):
-                counter += 1
-                # positive pair
-                j = numpy.random.randint(0, high=len(class_indices[d]))
-                if j == i:
-                    # Pick another image from same class then
-                    j = numpy.random.randint(0, high=len(class_indices[d]))
-                z1, z2 = class_indices[d][i], class_indices[d][j]
-
-                pairs1.append(data[z1])
-                pairs2.append(data[z2])
-                labels.append(1)
-
-                # negative pair
-                inc = numpy.random.randint(1, high=number_of_classes)
-                other_class_id = (d + inc) % number_of_classes
-                j = numpy.random.randint(0, high=len(class_indices[other_class_id])-1)
-                z1, z2 = class_indices[d][i], class_indices[other_class_id][j]
-
-                pairs1.append(data[z1])
-                pairs2.append(data[z2])
-                labels.append(0)
-
-                if counter == batch_size:
-                    #yield np.array(pairs), np.array(labels)
-                    yield [numpy.asarray(pairs1, numpy.float32), numpy.asarray(pairs2, numpy.float32)], numpy.asarray(labels, numpy.int32)
-                    counter = 0
-                    pairs1 = []
-                    pairs2 = []
-                    labels = []
+def cached_embeddings(backbone, images, gravityspy_id, filename, name,
+                      image_shape=None, key='', batch_size=32,
+                      verbose=False):
+    """The output of a frozen network, cached in an HDF5 file
+
+    The cache is only read back if it was made by a network with the
+    same weights, for the same samples in the same order, of the same
+    image shape and with the same ``key``. Anything else changing the
+    images, such as new pixels in a `pandas.DataFrame`, is not checked,
+    and the cache has to be deleted by hand.
+
+    Parameters:
+
+        backbone (`keras.Model`):
+            the frozen layers, e.g. VGG16 followed by its pooling
+
+        images (`numpy.ndarray`, callable):
+            preprocessed images of the samples, or a function
+            returning them, which is only called if the cache
+            does not hold these samples
+
+        gravityspy_id (array):
+            the ID of each sample
+
+        filename (str):
+            the HDF5 file
+
+        name (str):
+            the group of the file holding this set of samples
+
+        image_shape (tuple, optional):
+            Default None, the shape of one image, taken from
+            ``images`` if None, required if ``images`` is callable
+
+        key (str, optional):
+            Default '', describes how the images were made, e.g. the
+            file the pixels were read from and when it was modified
+
+        batch_size (int, optional):
+            Default 32
+
+    Returns:
+
+        `numpy.ndarray` of the float32 embedding of each sample
+    """
+    logger = log.Logger('Gravity Spy: Caching '
+                        'Embeddings')
+    gravityspy_id = numpy.asarray(gravityspy_id).astype('S100')
+    if image_shape is None:
+        image_shape = images.shape[1:]
+    image_shape = tuple(image_shape)
+    digest = hashlib.sha1(key.encode('utf-8'))
+    for weight in backbone.get_weights():
+        digest.update(str(weight.shape).encode('utf-8'))
+        digest.update(numpy.ascontiguousarray(weight).tobytes())
+    key = digest.hexdigest()
+
+    with h5py.File(filename, 'a') as f:
+        if (name in f and
+                f[name].attrs.get('key') == key and
+                tuple(f[name].attrs['image_shape']) == image_shape and
+                numpy.array_equal(f[name]['gravityspy_id'][:],
+                                  gravityspy_id)):
+            if verbose:
+                logger.info('Reading {0} embeddings from {1}'.format(
+                    name, filename))
+            return f[name]['embeddings'][:]
+
+        if verbose:
+            logger.info('Caching {0} embeddings in {1}'.format(name,
+                                                                filename))
+        if callable(images):
+            images = images()
+        embeddings = backbone.predict(images, batch_size=batch_size,
+                                      verbose=verbose).astype(numpy.float32)
+        if name in f:
+            del f[name]
+        group = f.create_group(name)
+        group.attrs['image_shape'] = image_shape
+        group.attrs['key'] = key
+        group.create_dataset('gravityspy_id', data=gravityspy_id)
+        group.create_dataset('embeddings', data=embeddings)
+
+    return embeddings
@@ -20,13 +20,16 @@ from gwtrigfind import find_trigger_files
 from gwpy.segments import DataQualityFlag
 from gwpy.table import GravitySpyTable
 from gwpy.utils import mp as mp_utils
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from astropy.table import Column
 
 from ..utils import log
 from ..utils import utils
 from ..api.project import GravitySpyProject
 from ..ml.train_classifier import make_model
+from ..ml.similarity_index import (SimilarityIndex, feature_columns,
+                                   find_duplicates)
+from ..ml.product_quantizer import ProductQuantizer
 
 import panoptes_client
 import numpy
@@ -92,9 +95,17 @@ class Events(GravitySpyTable):
 
             **kwargs:
                 nproc : number of parallel event times to be processing at once
+                share_q_transform : compute one Q-transform per event and
+                derive all durations from it
+                share_blocks : read, resample and whiten the data once
+                for all triggers that fall within the same block of data,
+                the normalised energies then differ by a few percent from
+                those of a block per trigger, see
+                `gravityspy.utils.utils.make_block_q_scans`
 
         Returns:
-            `Events` table
+            `Events` table, without the events flagged as repeats
+            by `flag_duplicates`, which are dropped unclassified
         """
         if 'event_time' not in self.keys():
             raise ValueError("This method only works if you have defined "
@@ -108,34 +119,71 @@ class Events(GravitySpyTable):
         source = kwargs.pop('source', None)
         channel_name = kwargs.pop('channel_name', None)
         frametype = kwargs.pop('frametype', None)
+        share_q_transform = kwargs.pop('share_q_transform', False)
+        share_blocks = kwargs.pop('share_blocks', False)
         verbose = kwargs.pop('verbose', False)
         # calculate maximum number of processes
         nproc = kwargs.pop('nproc', 1)
 
-        # make a list of event times
-        inputs = zip(self['event_time'], self['ifo'],
-                     self['gravityspy_id'])
-
-        inputs = ((etime, ifo, gid, config, plot_directory,
-                   timeseries, source, channel_name, frametype, nproc, verbose)
-                  for etime, ifo, gid in inputs)
-
-        # make q_scans
-        output = mp_utils.multiprocess_with_queues(nproc,
-                                                   _make_single_qscan,
-                                                   inputs)
-
-        qvalues = []
-        # raise exceptions (from multiprocessing, single process raises inline)
-        for f, x in output:
-            if isinstance(x, Exception):
-                x.args = ('Failed to make q scan at time %s: %s' % (f,
-                                                                    str(x)),)
-                raise x
-            else:
-                qvalues.append(x)
+        # leave out the events repeating an earlier one
+        events = self
+        if 'duplicate_of' in self.keys():
+            events = self[numpy.array(self['duplicate_of']).astype(str) == '']
+
+        if share_blocks:
+            # make a list of groups of event times sharing a block of data
+            groups = utils.group_by_block(events['event_time'],
+                                          config.block_time)
+            inputs = ((numpy.array(events['event_time'])[group],
+                       numpy.array(events['ifo'])[group],
+                       numpy.array(events['gravityspy_id'])[group],
+                       config, plot_directory, timeseries, source,
+                       channel_name, frametype, nproc, verbose,
+                       share_q_transform)
+                      for group in groups)
+
+            # make q_scans
+            output = mp_utils.multiprocess_with_queues(nproc,
+                                                       _make_block_qscans,
+                                                       inputs)
+
+            qvalue_by_id = {}
+            # raise exceptions (from multiprocessing, single process raises inline)
+            for f, x in output:
+                if isinstance(x, Exception):
+                    x.args = ('Failed to make q scans for block starting '
+                              'at time %s: %s' % (min(f), str(x)),)
+                    raise x
+                else:
+                    qvalue_by_id.update(x)
 
-        self['q_value'] = qvalues
+            qvalues = [qvalue_by_id[gid] for gid in events['gravityspy_id']]
+        else:
+            # make a list of event times
+            inputs = zip(events['event_time'], events['ifo'],
+                         events['gravityspy_id'])
+
+            inputs = ((etime, ifo, gid, config, plot_directory,
+                       timeseries, source, channel_name, frametype, nproc,
+                       verbose, share_q_transform)
+                      for etime, ifo, gid in inputs)
+
+            # make q_scans
+            output = mp_utils.multiprocess_with_queues(nproc,
+                                                       _make_single_qscan,
+                                                       inputs)
+
+            qvalues = []
+            # raise exceptions (from multiprocessing, single process raises inline)
+            for f, x in output:
+                if isinstance(x, Exception):
+                    x.args = ('Failed to make q scan at time %s: %s' % (f,
+                                                                        str(x)),)
+                    raise x
+                else:
+                    qvalues.append(x)
+
+        events['q_value'] = qvalues
 
         results = utils.label_q_scans(plot_directory=plot_directory,
                                       path_to_cnn=path_to_cnn,
@@ -153,7 +201,7 @@ class Events(GravitySpyTable):
                                                           args=(plot_directory,))
 
 
-        results = Events.from_pandas(results.merge(self.to_pandas(),
+        results = Events.from_pandas(results.merge(events.to_pandas(),
                                                    on=['gravityspy_id']))
         return results
 
@@ -297,6 +345,9 @@ class Events(GravitySpyTable):
                 self.replace_column(col.name, col.astype('object'))
         # First filter out images that have already been uploaded
         tab = self[self['upload_flag'] != 1]
+        # and the duplicates of other events
+        if 'duplicate_of' in self.keys():
+            tab = tab[numpy.array(tab['duplicate_of']).astype(str) == '']
         # If you want a specific subject set to be uploaded to then the
         # subjectset column will be updated to reflect which one you want
         if subject_set_id is not None:
@@ -353,13 +404,12 @@ class Events(GravitySpyTable):
             raise ValueError("This method only works if the file paths "
                              "of the images of the images are known.")
 
-        results = utils.label_select_images(filename1=self['Filename1'],
-                                            filename2=self['Filename2'],
-                                            filename3=self['Filename3'],
-                                            filename4=self['Filename4'],
-                                            path_to_cnn=path_to_cnn, **kwargs)
-
-
+        results, _ = utils.extract_all_select_images(
+                         filename1=self['Filename1'],
+                         filename2=self['Filename2'],
+                         filename3=self['Filename3'],
+                         filename4=self['Filename4'],
+                         path_to_cnn=path_to_cnn, **kwargs)
 
         return Events(results)
 
@@ -369,21 +419,78 @@ class Events(GravitySpyTable):
         Parameters:
             path_to_semantic_model (str): filename of model
 
+            **kwargs:
+                path_to_similarity_index : add the new features to the
+                trained `gravityspy.ml.similarity_index.SimilarityIndex`
+                saved in this file, e.g. by
+                `SimilarityIndex.from_events` on a representative table
+                path_to_product_quantizer : replace the features by
+                the codes of the
+                `gravityspy.ml.product_quantizer.ProductQuantizer` saved
+                in this file, e.g. the semantic model
+
         Returns:
             `Events` table with columns containing new scores
         """
+        path_to_similarity_index = kwargs.pop('path_to_similarity_index',
+                                              None)
+        path_to_product_quantizer = kwargs.pop('path_to_product_quantizer',
+                                               None)
         if not all(elem in self.keys() for elem in ['Filename1', 'Filename2',
                                                     'Filename3', 'Filename4']):
             raise ValueError("This method only works if the file paths "
                              "of the images of the images are known.")
 
-        results = utils.get_features_select_images(filename1=self['Filename1'],
-                                            filename2=self['Filename2'],
-                                            filename3=self['Filename3'],
-                                            filename4=self['Filename4'],
-                                            path_to_semantic_model=path_to_semantic_model, **kwargs)
+        _, results = utils.extract_all_select_images(
+                         filename1=self['Filename1'],
+                         filename2=self['Filename2'],
+                         filename3=self['Filename3'],
+                         filename4=self['Filename4'],
+                         path_to_semantic_model=path_to_semantic_model,
+                         **kwargs)
 
-        return Events(results)
+        return Events(_store_features(results, path_to_similarity_index,
+                                      path_to_product_quantizer))
+
+    def update_scores_and_features(self, path_to_cnn, path_to_semantic_model,
+                                   nproc=1, **kwargs):
+        """Rescore and refeature the events reading their images once
+
+        Parameters:
+            path_to_cnn (str): filename of model
+
+            path_to_semantic_model (str): filename of model
+
+            **kwargs:
+                path_to_similarity_index, path_to_product_quantizer :
+                as in `update_features`
+
+        Returns:
+            scores, features (`Events`):
+                what `update_scores` and `update_features` return
+        """
+        path_to_similarity_index = kwargs.pop('path_to_similarity_index',
+                                              None)
+        path_to_product_quantizer = kwargs.pop('path_to_product_quantizer',
+                                               None)
+        if not all(elem in self.keys() for elem in ['Filename1', 'Filename2',
+                                                    'Filename3', 'Filename4']):
+            raise ValueError("This method only works if the file paths "
+                             "of the images of the images are known.")
+
+        scores, features = utils.extract_all_select_images(
+                               filename1=self['Filename1'],
+                               filename2=self['Filename2'],
+                               filename3=self['Filename3'],
+                               filename4=self['Filename4'],
+                               path_to_cnn=path_to_cnn,
+                               path_to_semantic_model=path_to_semantic_model,
+                               **kwargs)
+
+        return Events(scores), Events(_store_features(
+                                          features,
+                                          path_to_similarity_index,
+                                          path_to_product_quantizer))
 
     def determine_workflow_and_subjectset(self, project_info_pickle):
         """Obtain omicron triggers to run gravityspy on
@@ -459,14 +566,25 @@ class Events(GravitySpyTable):
 
         return collection_url
 
-    def cluster(self, nclusters, random_state=30):
+    def cluster(self, nclusters, random_state=30, minibatch=False,
+                batch_size=1024):
         """Create new clusters from feature space vectors
 
+        Catalogues too large to load at once can be clustered chunk by
+        chunk with `gravityspy.ml.clustering`.
+
         Parameters:
 
             nclusters (int): how many clusters to try to group
                 these triggers into
 
+            minibatch (bool, optional): Default False, use
+                `sklearn.cluster.MiniBatchKMeans`, which is much faster
+                on large tables
+
+            batch_size (int, optional): Default 1024, events per
+                mini-batch update
+
         Returns:
             `Events` table
         """
@@ -474,13 +592,73 @@ class Events(GravitySpyTable):
             raise ValueError("You are trying to cluster but you do not have "
                              "the feature space information in this table.")
 
-        features = self.to_pandas().values[:, 0:200]
-        kmeans_1 = KMeans(nclusters, random_state=random_state).fit(features)
+        features = feature_columns(self)
+        if minibatch:
+            kmeans_1 = MiniBatchKMeans(nclusters, random_state=random_state,
+                                       batch_size=batch_size).fit(features)
+        else:
+            kmeans_1 = KMeans(nclusters,
+                              random_state=random_state).fit(features)
         clusters = kmeans_1.labels_
         self['clusters'] = clusters
 
         return self
 
+    def flag_duplicates(self, time_window=None, min_similarity=0.95,
+                        use_features=True, block_size=1024):
+        """Flag events repeating an earlier event of the same detector
+
+        Before `classify` the table has no feature space vectors, so
+        events are matched on their time alone and only near-identical
+        times are flagged. Once the features are known, e.g. after
+        `update_features`, events are compared over a wider window.
+
+        Parameters:
+
+            time_window (float, optional): Default None, seconds after
+                an event within which a later event may repeat it,
+                0.5 when features are compared and 0.01 on time alone
+
+            min_similarity (float, optional): Default 0.95, cosine
+                similarity of the features above which two events
+                are the same glitch
+
+            use_features (bool, optional): Default True, compare the
+                feature space vectors when the table has them,
+                otherwise events are matched on time alone
+
+            block_size (int, optional): Default 1024, events compared
+                at a time
+
+        Returns:
+            `Events` table with a column duplicate_of holding the
+            gravityspy_id of the first event each event repeats,
+            or an empty string. Flagged events are neither classified
+            nor uploaded.
+        """
+        if 'event_time' not in self.keys():
+            raise ValueError("This method only works if you have defined "
+                             "a column event_time for your "
+                             "Event Trigger Generator.")
+
+        features = None
+        if use_features and '0' in self.columns:
+            features = feature_columns(self)
+        if time_window is None:
+            time_window = 0.5 if features is not None else 0.01
+        ifo = numpy.array(self['ifo']) if 'ifo' in self.keys() else None
+
+        duplicate_of = find_duplicates(self['event_time'], ifo=ifo,
+                                       features=features,
+                                       time_window=time_window,
+                                       min_similarity=min_similarity,
+                                       block_size=block_size)
+        gravityspy_id = numpy.array(self['gravityspy_id']).astype(str)
+        self['duplicate_of'] = numpy.where(duplicate_of >= 0,
+                                           gravityspy_id[duplicate_of], '')
+
+        return self
+
     @classmethod
     def get_triggers(cls, start, end, channel,
                      dqflag, verbose=True, **kwargs):
@@ -691,6 +869,24 @@ def get_connection_str(db='gravityspy',
     return '{0}://{1}:{2}@{3}:{4}/{5}'.format(server, user, passwd,
                                               host, port, db)
 
+def _store_features(features, path_to_similarity_index=None,
+                    path_to_product_quantizer=None):
+    """Add new features to a similarity index and quantize them if asked
+    """
+    if path_to_similarity_index is not None:
+        if not os.path.isfile(path_to_similarity_index):
+            raise ValueError("There is no similarity index at {0}, "
+                             "train one on a representative sample "
+                             "first".format(path_to_similarity_index))
+        SimilarityIndex.add_events_to_file(path_to_similarity_index,
+                                           features)
+
+    if path_to_product_quantizer is not None:
+        quantizer = ProductQuantizer.read(path_to_product_quantizer)
+        features = quantizer.to_events(features)
+
+    return features
+
 # define multiprocessing method
 def _make_single_qscan(inputs):
     event_time = inputs[0]
@@ -704,6 +900,7 @@ def _make_single_qscan(inputs):
     frametype = inputs[8]
     nproc = inputs[9]
     verbose = inputs[10]
+    share_q_transform = inputs[11]
 
     # Parse Ini File
     plot_time_ranges = config.plot_time_ranges
@@ -713,17 +910,20 @@ def _make_single_qscan(inputs):
             specsgrams, q_value = utils.make_q_scans(event_time=event_time,
                                                      config=config,
                                                      timeseries=timeseries,
+                                                     share_q_transform=share_q_transform,
                                                      verbose=verbose)
         if source is not None:
             specsgrams, q_value = utils.make_q_scans(event_time=event_time,
                                                      config=config,
                                                      source=source,
+                                                     share_q_transform=share_q_transform,
                                                      verbose=verbose)
         if channel_name is not None:
             specsgrams, q_value = utils.make_q_scans(event_time=event_time,
                                                      config=config,
                                                      channel_name=channel_name,
                                                      frametype=frametype,
+                                                     share_q_transform=share_q_transform,
                                                      verbose=verbose)
         utils.save_q_scans(plot_directory, specsgrams,
                            plot_normalized_energy_range, plot_time_ranges,
@@ -735,3 +935,47 @@ def _make_single_qscan(inputs):
             raise
         else:
             return event_time, exc
+
+def _make_block_qscans(inputs):
+    event_times = inputs[0]
+    ifos = inputs[1]
+    gids = inputs[2]
+    config = inputs[3]
+    plot_directory = inputs[4]
+    timeseries = inputs[5]
+    source = inputs[6]
+    channel_name = inputs[7]
+    frametype = inputs[8]
+    nproc = inputs[9]
+    verbose = inputs[10]
+    share_q_transform = inputs[11]
+
+    # Parse Ini File
+    plot_time_ranges = config.plot_time_ranges
+    plot_normalized_energy_range = config.plot_normalized_energy_range
+    try:
+        results = utils.make_block_q_scans(event_times=event_times,
+                                           config=config,
+                                           timeseries=timeseries,
+                                           source=source,
+                                           channel_name=channel_name,
+                                           frametype=frametype,
+                                           share_q_transform=share_q_transform,
+                                           verbose=verbose)
+
+        q_values = {}
+        for event_time, ifo, gid, (specsgrams, q_value) in zip(event_times,
+                                                               ifos, gids,
+                                                               results):
+            utils.save_q_scans(plot_directory, specsgrams,
+                               plot_normalized_energy_range, plot_time_ranges,
+                               ifo, event_time, id_string=gid,
+                               verbose=verbose)
+            q_values[gid] = q_value
+
+        return event_times, q_values
+    except Exception as exc:  # pylint: disable=broad-except
+        if nproc == 1:
+            raise
+        else:
+            return event_times, exc
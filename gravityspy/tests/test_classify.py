@@ -1,13 +1,19 @@
 from gwpy.timeseries import TimeSeries
 from gwpy.table import EventTable
 
-from gravityspy.classify import classify
+from gravityspy.classify import (classify, split_features)
+from gravityspy.utils import utils
+import numpy
 import os
 import pandas
 
 MODEL_NAME_CNN = os.path.join(os.path.split(__file__)[0], '..', '..', 'models',
                               'multi_view_classifier.h5')
 
+MODEL_NAME_FEATURE_MULTIVIEW = os.path.join(os.path.split(__file__)[0], '..',
+                                            '..', 'models',
+                                            'semantic_idx_model.h5')
+
 SCRATCHY_TIMESERIES_PATH = os.path.join(os.path.split(__file__)[0], 'data',
                                         'timeseries',
                                         'scratchy_timeseries_test.h5')
@@ -38,3 +44,100 @@ class TestUtils(object):
                                           RESULTS_TABLE.to_pandas(),
                                           check_dtype=False,
                                           check_less_precise=True)
+
+    def test_classify_with_features(self, tmpdir):
+
+        results = classify(event_time=EVENT_TIME,
+                           channel_name='L1:GDS-CALIB_STRAIN',
+                           path_to_cnn=MODEL_NAME_CNN,
+                           timeseries=SCRATCHY_TIMESERIES,
+                           plot_directory=str(tmpdir),
+                           path_to_semantic_model=MODEL_NAME_FEATURE_MULTIVIEW)
+
+        # one table comes back, as wscan stores it in two
+        scores, features = split_features(results)
+        assert features.colnames == (['gravityspy_id'] +
+                                     [str(idx) for idx in
+                                      range(len(features.colnames) - 1)])
+        assert list(features['gravityspy_id']) == \
+            list(scores['gravityspy_id'])
+
+        # the images live in tmpdir, so only the scores are compared
+        assert scores.colnames == RESULTS_TABLE.colnames
+        columns = [name for name in scores.colnames
+                   if not name.startswith('Filename')]
+        scores.convert_unicode_to_bytestring()
+        pandas.testing.assert_frame_equal(scores.to_pandas()[columns],
+                                          RESULTS_TABLE.to_pandas()[columns],
+                                          check_dtype=False,
+                                          check_less_precise=True)
+
+    def test_shared_q_scans(self):
+
+        specsgrams, q_value = utils.make_q_scans(event_time=EVENT_TIME,
+                                                 timeseries=SCRATCHY_TIMESERIES)
+
+        shared_specsgrams, shared_q_value = utils.make_q_scans(
+                                                event_time=EVENT_TIME,
+                                                timeseries=SCRATCHY_TIMESERIES,
+                                                share_q_transform=True)
+
+        assert q_value == shared_q_value
+        for spec, shared_spec in zip(specsgrams, shared_specsgrams):
+            assert spec.shape == shared_spec.shape
+            numpy.testing.assert_allclose(shared_spec.value, spec.value,
+                                          rtol=1e-6, atol=1e-6)
+
+    def test_block_q_scans(self):
+
+        specsgrams, q_value = utils.make_q_scans(event_time=EVENT_TIME,
+                                                 timeseries=SCRATCHY_TIMESERIES)
+
+        [(block_specsgrams, block_q_value)] = utils.make_block_q_scans(
+                                                  [EVENT_TIME],
+                                                  timeseries=SCRATCHY_TIMESERIES)
+
+        assert q_value == block_q_value
+        for spec, block_spec in zip(specsgrams, block_specsgrams):
+            assert spec.shape == block_spec.shape
+            numpy.testing.assert_allclose(block_spec.value, spec.value,
+                                          rtol=1e-6, atol=1e-6)
+
+    def test_block_q_scans_of_several_triggers(self):
+
+        # white noise with a loud sine-Gaussian at each of two triggers
+        # sharing an 84 second block
+        sample_rate = 16384
+        times = numpy.arange(120 * sample_rate) / float(sample_rate)
+        data = numpy.random.RandomState(1986).normal(size=times.size)
+        event_times = [40.2, 60.7]
+        for event_time in event_times:
+            data += 5 * (numpy.exp(-((times - event_time) / 0.01) ** 2) *
+                         numpy.sin(2 * numpy.pi * 200 * (times - event_time)))
+        timeseries = TimeSeries(data, sample_rate=sample_rate, t0=0)
+
+        block_results = utils.make_block_q_scans(event_times,
+                                                 timeseries=timeseries)
+
+        # the whole block gives a slightly different ASD than the block
+        # make_q_scans reads for each trigger, so the energies agree to
+        # within 10 percent rather than to rounding
+        for event_time, (block_specsgrams, _) in zip(event_times,
+                                                     block_results):
+            specsgrams, _ = utils.make_q_scans(event_time=event_time,
+                                               timeseries=timeseries)
+            for spec, block_spec in zip(specsgrams, block_specsgrams):
+                assert spec.shape == block_spec.shape
+                numpy.testing.assert_allclose(block_spec.value.max(),
+                                              spec.value.max(), rtol=0.1)
+                numpy.testing.assert_allclose(numpy.median(block_spec.value),
+                                              numpy.median(spec.value),
+                                              rtol=0.1)
+
+    def test_group_by_block(self):
+
+        event_times = [100.0, 150.0, 110.0, 131.9, 300.0, 132.5]
+        groups = utils.group_by_block(event_times, block_time=64)
+
+        assert [list(group) for group in groups] == [[0, 2, 3], [5, 1], [4]]
+        assert utils.group_by_block([], block_time=64) == []
@@ -0,0 +1,50 @@
+"""Unit test for GravitySpy
+"""
+
+__author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
+
+from gravityspy.ml.clustering import (HDF5Features, fit_kmeans,
+                                      assign_clusters, select_nclusters)
+
+import h5py
+import numpy
+import tempfile
+
+
+class TestGravitySpyClustering(object):
+    """`TestCase` for the GravitySpy clustering of features
+    """
+    def test_streaming_clusters(self):
+
+        rng = numpy.random.RandomState(1986)
+        centres = 10 * rng.randn(3, 200)
+        clusters = rng.randint(3, size=300)
+        features = centres[clusters] + rng.randn(300, 200)
+
+        dtype = ([('gravityspy_id', 'S10')] +
+                 [(str(idx), 'f8') for idx in range(200)])
+        with tempfile.NamedTemporaryFile(suffix='.h5') as f, \
+                tempfile.NamedTemporaryFile(suffix='.h5') as output:
+            # one table per event, as wscan writes them
+            with h5py.File(f.name, 'w') as h5file:
+                for idx, vector in enumerate(features):
+                    row = numpy.zeros(1, dtype=dtype)
+                    row['gravityspy_id'] = 'id{0}'.format(idx)
+                    for column in range(200):
+                        row[str(column)] = vector[column]
+                    h5file.create_dataset('id{0}/id{0}'.format(idx), data=row)
+
+            source = HDF5Features(f.name, chunk_size=64)
+            assert sum(len(ids) for ids, _ in source) == 300
+
+            kmeans = fit_kmeans(source, 3, batch_size=32, nepochs=3)
+            assign_clusters(kmeans, source, filename=output.name)
+            with h5py.File(output.name, 'r') as h5file:
+                ids = h5file['gravityspy_id'][:].astype(str)
+                found = h5file['clusters'][:]
+            truth = clusters[[int(gid[2:]) for gid in ids]]
+            # every true cluster maps to exactly one found cluster
+            assert len(set(zip(truth, found))) == 3
+
+            inertia = select_nclusters(source, [1, 3])
+            assert inertia[3] < inertia[1]
@@ -9,12 +9,30 @@ os.environ["KERAS_BACKEND"] = "theano"
 import gravityspy.ml.read_image as read_image
 import gravityspy.ml.labelling_test_glitches as label_glitches
 import gravityspy.ml.train_classifier as train_classifier
+import gravityspy.ml.train_semantic_index as train_semantic_index
+from gravityspy.ml.GS_utils import concatenate_views
+from gravityspy.ml import inference_server
+from gravityspy.ml.inference_server import InferenceServer
+from gravityspy.ml.numpy_model import export_model
+from gravityspy.ml.checkpoint import TrainingCheckpoint
+from gravityspy.ml.pixel_store import (PixelStore, pixelize_trainingset,
+                                       read_column)
+from gravityspy.utils import utils
+
+from skimage.color import rgb2gray
+from skimage.transform import rescale
 
 import pandas as pd
 import numpy
+import pytest
+import random
+import subprocess
+import sys
+import threading
 
 TEST_IMAGES_PATH = os.path.join(os.path.split(__file__)[0], 'data',
 'images')
+TRAINING_SET_PATH = os.path.join(TEST_IMAGES_PATH, 'TrainingSet')
 MODEL_NAME_CNN = os.path.join(os.path.split(__file__)[0], '..', '..', 'models',
                               'multi_view_classifier.h5')
 MODEL_NAME_FEATURE_SINGLE_VIEW = os.path.join(os.path.split(__file__)[0], '..', '..', 'models',
@@ -44,6 +62,29 @@ FEATURES = numpy.array([[0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
 
 MULTIVIEW_FEATURES = numpy.load(MULTIVIEW_FEATURES_FILE)
 
+# the four durations of the test event, shortest first
+LIST_OF_IMAGES = sorted(ifile for ifile in os.listdir(TEST_IMAGES_PATH)
+                        if 'spectrogram' in ifile)
+TEST_FILENAMES = [os.path.join(TEST_IMAGES_PATH, image)
+                  for image in LIST_OF_IMAGES]
+
+
+def read_test_views():
+    """The grayscale views of the test event, as `label_views` takes them
+    """
+    return numpy.stack([read_image.read_grayscale(filename, resolution=0.3)
+                        for filename in TEST_FILENAMES])[numpy.newaxis]
+
+NO_KERAS_SCRIPT = """
+import sys
+import numpy
+from gravityspy.utils import utils
+from gravityspy.ml import labelling_test_glitches as label_glitches
+views = numpy.load(sys.argv[1])
+label_glitches.label_views(views, sys.argv[2], backend='numpy')
+assert 'keras' not in sys.modules
+"""
+
 class TestGravitySpyML(object):
     """`TestCase` for the GravitySpy
     """
@@ -122,3 +163,490 @@ class TestGravitySpyML(object):
                                                         False)
         numpy.testing.assert_array_almost_equal(features, MULTIVIEW_FEATURES,
                                                 decimal=3)
+
+    def test_model_cache(self):
+
+        label_glitches.clear_model_cache()
+        model = label_glitches.get_model(MODEL_NAME_CNN)
+        assert label_glitches.get_model(MODEL_NAME_CNN) is model
+
+        classes = label_glitches.get_labels(MODEL_NAME_CNN)
+        assert len(classes) == model.output_shape[-1]
+
+    def test_concatenate_views(self):
+
+        rng = numpy.random.RandomState(1986)
+        for rgb_flag, ch in [(False, 1), (True, 3)]:
+            views = [rng.rand(5, 140, 170, ch).astype('f') for _ in range(4)]
+            expected = numpy.concatenate(
+                           [numpy.concatenate(views[:2], axis=1),
+                            numpy.concatenate(views[2:], axis=1)], axis=2)
+
+            merged = concatenate_views(views[0], views[1], views[2], views[3],
+                                       [140, 170], rgb_flag, 'channels_last')
+            assert merged.dtype == numpy.float64
+            numpy.testing.assert_array_equal(merged, expected)
+
+            views = [numpy.moveaxis(view, 3, 1) for view in views]
+            merged = concatenate_views(views[0], views[1], views[2], views[3],
+                                       [140, 170], rgb_flag, 'channels_first')
+            numpy.testing.assert_array_equal(merged,
+                                             numpy.moveaxis(expected, 3, 1))
+
+    def test_label_views(self):
+
+        views = numpy.concatenate([read_test_views()] * 3)
+
+        scores, MLlabel = label_glitches.label_views(views, MODEL_NAME_CNN)
+        scores_batched, MLlabel_batched = label_glitches.label_views(
+                                              views, MODEL_NAME_CNN,
+                                              batch_size=2)
+
+        assert scores.shape[0] == 3
+        numpy.testing.assert_array_equal(MLlabel, MLlabel_batched)
+        numpy.testing.assert_array_almost_equal(scores, scores_batched,
+                                                decimal=5)
+        numpy.testing.assert_allclose(scores[:, MLlabel[0]], SCORE,
+                                      rtol=1e-5)
+
+    def test_pixel_store(self, tmpdir):
+
+        image_dataDF = pd.DataFrame()
+        for image in LIST_OF_IMAGES:
+            image_dataDF[image.split('_')[-1]] = [read_image.read_grayscale(
+                                                      os.path.join(
+                                                          TEST_IMAGES_PATH,
+                                                          image),
+                                                      resolution=0.3)]
+        image_dataDF['gravityspy_id'] = LIST_OF_IMAGES[0].split('_')[1]
+        image_dataDF['true_label'] = 'Blip'
+
+        filename = str(tmpdir.join('pixel_store.h5'))
+        store = PixelStore.from_pandas(image_dataDF, filename)
+        store.append(dict((column, numpy.stack(image_dataDF[column].values))
+                          for column in store.columns),
+                     ['abcdefghij'], ['Whistle'])
+        # every append must supply the columns already stored
+        with pytest.raises(ValueError):
+            store.append({'0.5.png': numpy.stack(
+                              image_dataDF['0.5.png'].values)},
+                         ['klmnopqrst'], ['Blip'])
+        assert store.file['gravityspy_id'].chunks == (4096,)
+        store.close()
+
+        with PixelStore(filename) as store:
+            assert len(store) == 2
+            assert list(store.true_label) == ['Blip', 'Whistle']
+            for column in store.columns:
+                numpy.testing.assert_array_equal(
+                    read_column(store, column, [1, 0]),
+                    numpy.vstack([image_dataDF[column].values[0]] * 2))
+
+    def test_pixelize_trainingset(self, tmpdir):
+
+        tmpdir = str(tmpdir)
+        grayscale_store, rgb_store = pixelize_trainingset(
+                                         TRAINING_SET_PATH,
+                                         grayscale_file=os.path.join(
+                                             tmpdir, 'trainingset.h5'),
+                                         rgb_file=os.path.join(
+                                             tmpdir, 'rgb_trainingset.h5'),
+                                         chunk_size=2)
+
+        nb_samples = sum(len(os.listdir(os.path.join(TRAINING_SET_PATH,
+                                                     iclass))) // 4
+                         for iclass in os.listdir(TRAINING_SET_PATH))
+        assert len(grayscale_store) == len(rgb_store) == nb_samples
+        assert set(grayscale_store.true_label) == set(['Blip', 'Scratchy'])
+        assert grayscale_store.true_label[-1] == 'Scratchy'
+
+        image = sorted(os.listdir(os.path.join(TRAINING_SET_PATH,
+                                               'Scratchy')))[-1]
+        filename = os.path.join(TRAINING_SET_PATH, 'Scratchy', image)
+        duration = image.split('_')[-1]
+        numpy.testing.assert_array_equal(
+            grayscale_store.read(duration, [nb_samples - 1])[0],
+            read_image.read_grayscale(filename, resolution=0.3))
+        numpy.testing.assert_array_almost_equal(
+            rgb_store.read(duration, [nb_samples - 1])[0],
+            numpy.stack(read_image.read_rgb(filename, resolution=0.3)),
+            decimal=3)
+
+    def test_read_grayscale_and_rgb(self):
+
+        grayscale, rgb = read_image.read_grayscale_and_rgb_batch(
+                             TEST_FILENAMES, nthreads=2)
+        for idx, filename in enumerate(TEST_FILENAMES):
+            numpy.testing.assert_array_equal(
+                grayscale[idx], read_image.read_grayscale(filename,
+                                                          resolution=0.3))
+            numpy.testing.assert_array_almost_equal(
+                rgb[idx], numpy.stack(read_image.read_rgb(filename,
+                                                          resolution=0.3)),
+                decimal=3)
+
+    def test_downsample(self):
+
+        for filename in TEST_FILENAMES:
+            image_data = read_image.read_and_crop_image(
+                             filename, x=[66, 532], y=[105, 671])
+
+            grayscale = rgb2gray(image_data)
+            numpy.testing.assert_allclose(
+                read_image.downsample(grayscale, 0.3),
+                rescale(grayscale, 0.3, mode='constant',
+                        preserve_range='True', multichannel=False),
+                atol=1e-10)
+
+            numpy.testing.assert_allclose(
+                numpy.moveaxis(read_image.downsample(
+                    numpy.moveaxis(image_data, 2, 0).astype(float), 0.3),
+                    0, 2),
+                rescale(image_data, 0.3, mode='constant',
+                        preserve_range='True', multichannel=True),
+                atol=1e-8)
+
+    def test_numpy_backend(self, tmpdir):
+
+        views = read_test_views()
+
+        scores, MLlabel = label_glitches.label_views(views, MODEL_NAME_CNN)
+        scores_numpy, MLlabel_numpy = label_glitches.label_views(
+                                          views, MODEL_NAME_CNN,
+                                          backend='numpy')
+        numpy.testing.assert_array_equal(MLlabel, MLlabel_numpy)
+        numpy.testing.assert_allclose(scores_numpy, scores, atol=1e-5)
+
+        filename = str(tmpdir.join('numpy_model.h5'))
+        export_model(MODEL_NAME_CNN, filename)
+        scores_exported, _ = label_glitches.label_views(views, filename,
+                                                        backend='numpy')
+        numpy.testing.assert_allclose(scores_exported, scores_numpy,
+                                      rtol=1e-6)
+
+    def test_keras_image_data_format(self):
+        from keras import backend as K
+
+        image_dataDF = pd.DataFrame()
+        for image in LIST_OF_IMAGES:
+            image_dataDF[image] = [read_image.read_grayscale(os.path.join(
+                                                                 TEST_IMAGES_PATH,
+                                                                 image),
+                                                             resolution=0.3)]
+        views = numpy.stack([image_dataDF[image].iloc[0]
+                             for image in LIST_OF_IMAGES])[numpy.newaxis]
+
+        # importing gravityspy.ml no longer sets a global ordering, each
+        # call sets the data format of its order_of_channels
+        K.set_image_data_format('channels_first')
+        scores, MLlabel = label_glitches.label_views(views, MODEL_NAME_CNN,
+                                                     original_order=True)
+        assert K.image_data_format() == 'channels_last'
+
+        K.set_image_data_format('channels_first')
+        scores_deeplayer, MLlabel_deeplayer, deeplayer = \
+            label_glitches.get_deeplayer(image_dataDF, MODEL_NAME_CNN)[:3]
+        assert K.image_data_format() == 'channels_last'
+        numpy.testing.assert_array_equal(MLlabel_deeplayer, MLlabel)
+        numpy.testing.assert_allclose(scores_deeplayer, scores, rtol=1e-5)
+        assert deeplayer.shape[0] == 1
+
+    def test_numpy_backend_without_keras(self, tmpdir):
+
+        views = read_test_views()
+
+        # this module has imported keras already, so label in a fresh process
+        filename = str(tmpdir.join('views.npy'))
+        numpy.save(filename, views)
+        subprocess.check_call([sys.executable, '-c', NO_KERAS_SCRIPT,
+                               filename, MODEL_NAME_CNN])
+
+    def test_compressed_export(self, tmpdir):
+
+        views = read_test_views()
+
+        scores, MLlabel = label_glitches.label_views(views, MODEL_NAME_CNN)
+
+        for storage_dtype, tolerance in (('float16', 0.01), ('int8', 0.05)):
+            filename = str(tmpdir.join(storage_dtype + '.h5'))
+            export_model(MODEL_NAME_CNN, filename,
+                         storage_dtype=storage_dtype)
+            scores_compressed, MLlabel_compressed = \
+                label_glitches.label_views(views, filename, backend='numpy')
+            report = label_glitches.compare_models(views, MODEL_NAME_CNN,
+                                                   filename)
+            numpy.testing.assert_array_equal(MLlabel_compressed, MLlabel)
+            assert numpy.abs(scores_compressed - scores).max() < tolerance
+            assert report['label_agreement'] == 1
+            assert report['max_score_difference'] < tolerance
+            assert report['size_ratio'] < 1
+
+    def test_extract_all(self):
+
+        views, views_rgb = read_image.read_grayscale_and_rgb_batch(
+                               TEST_FILENAMES)
+        views = views.reshape(1, 4, -1)
+        views_rgb = views_rgb.reshape(1, 4, 3, -1)
+
+        scores, MLlabel, activations, features = label_glitches.extract_all(
+            views, MODEL_NAME_CNN, rgb_views=views_rgb,
+            semantic_model_name=MODEL_NAME_FEATURE_MULTIVIEW, layers=[20])
+
+        scores_views, MLlabel_views = label_glitches.label_views(
+                                          views, MODEL_NAME_CNN)
+        numpy.testing.assert_array_equal(MLlabel, MLlabel_views)
+        numpy.testing.assert_allclose(scores, scores_views, rtol=1e-5)
+        assert activations[20].shape[0] == 1
+        numpy.testing.assert_array_almost_equal(features, MULTIVIEW_FEATURES,
+                                                decimal=3)
+
+    def test_label_select_images(self):
+
+        filename1, filename2, filename3, filename4 = [
+            [filename] for filename in TEST_FILENAMES]
+
+        classes = label_glitches.get_labels(MODEL_NAME_CNN)
+        results = utils.label_select_images(filename1, filename2, filename3,
+                                            filename4, MODEL_NAME_CNN)
+        # rescored events keep the columns they had, without the filenames
+        assert results.colnames == (list(classes) +
+                                    ['gravityspy_id', 'ml_label',
+                                     'ml_confidence'])
+
+        views = numpy.stack([read_image.read_grayscale(filename[0],
+                                                       resolution=0.3)
+                             for filename in (filename1, filename2,
+                                              filename3, filename4)])
+        scores, MLlabel = label_glitches.label_views(views[numpy.newaxis],
+                                                     MODEL_NAME_CNN)
+        numpy.testing.assert_allclose(
+            numpy.array([results[name] for name in classes]).T, scores,
+            rtol=1e-5)
+        assert results['ml_label'][0] == classes[MLlabel[0]]
+
+        # one pass gives the same scores and the features as well
+        scores_table, features_table = utils.extract_all_select_images(
+            filename1, filename2, filename3, filename4,
+            path_to_cnn=MODEL_NAME_CNN,
+            path_to_semantic_model=MODEL_NAME_FEATURE_MULTIVIEW)
+        assert scores_table.colnames == results.colnames
+        for name in classes:
+            numpy.testing.assert_allclose(scores_table[name], results[name],
+                                          rtol=1e-5)
+        numpy.testing.assert_array_almost_equal(
+            numpy.array([features_table[str(idx)]
+                         for idx in range(MULTIVIEW_FEATURES.shape[1])]).T,
+            MULTIVIEW_FEATURES, decimal=3)
+        assert list(features_table['gravityspy_id']) == \
+            list(results['gravityspy_id'])
+
+    def test_inference_server(self, tmpdir):
+
+        views = read_test_views()
+
+        scores, MLlabel = label_glitches.label_views(views, MODEL_NAME_CNN)
+
+        address = str(tmpdir.join('inference.sock'))
+        # no server is listening yet, so the views are scored in process
+        scores_fallback, _ = label_glitches.label_views(views, MODEL_NAME_CNN,
+                                                        server=address)
+        numpy.testing.assert_array_equal(scores_fallback, scores)
+
+        # there is no serving without an authkey
+        with pytest.raises(ValueError):
+            InferenceServer('localhost:6000', authkey_file=os.devnull)
+
+        server = InferenceServer(address, authkey=b'gravityspy',
+                                 preload=[MODEL_NAME_CNN])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            while not os.path.exists(address):
+                thread.join(0.01)
+            # a client with the wrong key is refused and scores in process
+            assert inference_server.request(address, 'label_views',
+                                            MODEL_NAME_CNN, views,
+                                            authkey=b'wrong') is None
+            os.environ[inference_server.AUTHKEY_VARIABLE] = 'gravityspy'
+            scores_server, MLlabel_server = label_glitches.label_views(
+                                                views, MODEL_NAME_CNN,
+                                                server=address)
+        finally:
+            os.environ.pop(inference_server.AUTHKEY_VARIABLE, None)
+            server.close()
+        numpy.testing.assert_array_equal(MLlabel_server, MLlabel)
+        numpy.testing.assert_allclose(scores_server, scores, rtol=1e-5)
+
+    def test_inference_server_failures(self, tmpdir):
+
+        # a model that cannot be loaded stops the server before it
+        # takes any client
+        address = str(tmpdir.join('inference.sock'))
+        server = InferenceServer(address, authkey=b'gravityspy',
+                                 preload=[str(tmpdir.join('missing.h5'))])
+        with pytest.raises(Exception):
+            server.serve_forever()
+        assert not os.path.exists(address)
+
+        # a server that never answers is given up on
+        address = str(tmpdir.join('silent.sock'))
+        listener = inference_server.Listener(address, authkey=b'gravityspy')
+        accepted = []
+        thread = threading.Thread(
+                     target=lambda: accepted.append(listener.accept()))
+        thread.daemon = True
+        thread.start()
+        try:
+            assert inference_server.request(address, 'label_views',
+                                            MODEL_NAME_CNN,
+                                            numpy.zeros((1, 4, 1)),
+                                            authkey=b'gravityspy',
+                                            timeout=0.1) is None
+        finally:
+            thread.join()
+            for conn in accepted:
+                conn.close()
+            listener.close()
+
+    def test_cached_embeddings(self, tmpdir):
+        from keras.layers import Dense, Input
+        from keras.models import Model
+
+        inputs = Input(shape=(4,))
+        backbone = Model(inputs=inputs, outputs=Dense(2)(inputs))
+        images = numpy.random.RandomState(1986).rand(5, 4)
+        ids = ['id{0}'.format(idx) for idx in range(5)]
+
+        filename = str(tmpdir.join('embeddings.h5'))
+        embeddings = train_semantic_index.cached_embeddings(
+            backbone, images, ids, filename, 'known')
+        numpy.testing.assert_allclose(embeddings,
+                                      backbone.predict(images),
+                                      rtol=1e-5)
+        # read back without running the network or reading the images
+        def read_images():
+            raise AssertionError('The images should not be read')
+        cached = train_semantic_index.cached_embeddings(
+            backbone, read_images, ids, filename, 'known',
+            image_shape=(4,))
+        numpy.testing.assert_array_equal(cached, embeddings)
+        # other images or another network are computed again
+        for key, network in [('multi_view=True', backbone),
+                             ('', Model(inputs=inputs,
+                                        outputs=Dense(2)(inputs)))]:
+            with pytest.raises(AssertionError):
+                train_semantic_index.cached_embeddings(
+                    network, read_images, ids, filename, 'known',
+                    image_shape=(4,), key=key)
+        # another set of samples is computed again
+        embeddings = train_semantic_index.cached_embeddings(
+            backbone, images[:3], ids[:3], filename, 'known')
+        assert embeddings.shape == (3, 2)
+
+    def test_pixel_store_sequence(self, tmpdir):
+
+        filename = str(tmpdir.join('trainingset.h5'))
+        grayscale_store, _ = pixelize_trainingset(TRAINING_SET_PATH,
+                                                  grayscale_file=filename)
+        grayscale_store.close()
+        with PixelStore(filename) as store:
+            nb_samples = len(store)
+            index = numpy.arange(nb_samples)
+            concat = concatenate_views(
+                *([read_column(store, column, index).reshape(
+                       -1, 140, 170, 1)
+                   for column in ['0.5.png', '1.0.png',
+                                  '2.0.png', '4.0.png']] +
+                  [[140, 170], False, 'channels_last']))
+
+        sequence = train_classifier.PixelStoreSequence(
+            filename, index, numpy.zeros(nb_samples), 2, batch_size=1,
+            shuffle=False)
+        assert len(sequence) == nb_samples
+        views, labels = sequence[0]
+        assert views.dtype == numpy.float32
+        numpy.testing.assert_allclose(views, concat[:1], rtol=1e-6)
+        numpy.testing.assert_array_equal(labels, [[1, 0]])
+
+        sequence = train_classifier.PixelStoreSequence(
+            filename, index, numpy.zeros(nb_samples), 2, batch_size=1)
+        sequence.on_epoch_end()
+        resumed = train_classifier.PixelStoreSequence(
+            filename, index, numpy.zeros(nb_samples), 2, batch_size=1,
+            initial_epoch=1)
+        numpy.testing.assert_array_equal(resumed.order, sequence.order)
+
+    def test_training_checkpoint(self, tmpdir):
+        from keras.layers import Dense
+        from keras.models import Sequential
+
+        def make():
+            model = Sequential()
+            model.add(Dense(2, activation='softmax', input_shape=(4,)))
+            model.compile(loss='categorical_crossentropy',
+                          optimizer='adadelta')
+            return model
+
+        rng = numpy.random.RandomState(1986)
+        x = rng.rand(20, 4)
+        y = numpy.eye(2)[rng.randint(2, size=20)]
+        tmpdir = str(tmpdir)
+
+        model = make()
+        checkpoint = TrainingCheckpoint(tmpdir, period=3,
+                                        random_states=[rng])
+        model.fit(x, y, epochs=2, validation_data=(x, y),
+                  callbacks=[checkpoint], verbose=0)
+        assert os.path.isfile(os.path.join(tmpdir, 'best.h5'))
+        expected_random = random.random()
+
+        resumed = make()
+        state = numpy.random.RandomState()
+        checkpoint = TrainingCheckpoint(tmpdir, random_states=[state])
+        assert checkpoint.resume(resumed) == 2
+        for weight, expected in zip(resumed.get_weights(),
+                                    model.get_weights()):
+            numpy.testing.assert_array_equal(weight, expected)
+        for weight, expected in zip(resumed.optimizer.get_weights(),
+                                    model.optimizer.get_weights()):
+            numpy.testing.assert_array_equal(weight, expected)
+        assert state.randint(1000) == rng.randint(1000)
+        assert random.random() == expected_random
+
+    def test_fine_tune(self, tmpdir):
+
+        tmpdir = str(tmpdir)
+        data = train_classifier.pickle_trainingset(
+                   TRAINING_SET_PATH,
+                   save_address=os.path.join(tmpdir, 'trainingset.pkl'))
+        data.loc[data.true_label == 'Scratchy', 'true_label'] = 'New_Class'
+        old_classes = list(label_glitches.get_labels(MODEL_NAME_CNN))
+
+        model, classes = train_classifier.fine_tune(MODEL_NAME_CNN, data,
+                                                    nb_epoch=1,
+                                                    fraction_validation=.5)
+        assert classes == sorted(old_classes + ['New_Class'])
+        assert model.output_shape[-1] == len(classes)
+
+        # the frozen network is left as it was trained
+        old_model = label_glitches.get_model(MODEL_NAME_CNN)
+        for weight, expected in zip(model.layers[0].get_weights(),
+                                    old_model.layers[0].get_weights()):
+            numpy.testing.assert_array_equal(weight, expected)
+
+        # before any training, the old classes score the images as the
+        # old model did once the new class is taken out
+        model, classes = train_classifier.fine_tune(MODEL_NAME_CNN, data,
+                                                    nb_epoch=0,
+                                                    fraction_validation=.5)
+        index = numpy.arange(len(data))
+        views = concatenate_views(
+            *([read_column(data, column, index).reshape(-1, 140, 170, 1)
+               for column in ['0.5.png', '1.0.png', '2.0.png', '4.0.png']] +
+              [[140, 170], False, 'channels_last']))
+        old_columns = [classes.index(label) for label in old_classes]
+        scores = model.predict(views)[:, old_columns]
+        numpy.testing.assert_allclose(
+            scores / scores.sum(axis=1, keepdims=True),
+            old_model.predict(views), rtol=1e-4, atol=1e-6)
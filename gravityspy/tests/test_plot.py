@@ -4,9 +4,11 @@
 __author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
 
 import os
+import numpy
 import matplotlib
 matplotlib.use('agg')
 from gravityspy.plot.plot import plot_qtransform
+from gravityspy.ml import read_image
 from gwpy.timeseries import TimeSeries
 from gwpy.segments import Segment
 
@@ -61,3 +63,23 @@ class TestGravitySpyPlot(object):
                                                  plot_time_ranges,
                                                  detector_name,
                                                  start_time)
+
+    def test_render_spectrogram(self, tmpdir):
+        # The in-memory render must match the saved PNG to a pixel tolerance
+        ind_fig_all, super_fig = plot_qtransform(specsgrams,
+                                                 plot_normalized_energy_range,
+                                                 plot_time_ranges,
+                                                 detector_name,
+                                                 start_time)
+        tmpdir = str(tmpdir)
+        for spec, ind_fig in zip(specsgrams, ind_fig_all):
+            filename = os.path.join(tmpdir, 'spectrogram.png')
+            ind_fig.save(filename)
+            png_data = read_image.read_grayscale(filename, resolution=0.3)
+            rendered_data = read_image.read_spectrogram_grayscale(
+                                               spec,
+                                               plot_normalized_energy_range,
+                                               frange=search_frequency_range,
+                                               resolution=0.3)
+            assert rendered_data.shape == png_data.shape
+            assert numpy.abs(rendered_data - png_data).mean() < 1e-2
@@ -0,0 +1,187 @@
+"""Unit test for GravitySpy
+"""
+
+__author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
+
+from gravityspy.ml.GS_utils import create_pairs3_gen
+from gravityspy.ml.product_quantizer import ProductQuantizer, PQIndex
+from gravityspy.ml.similarity_index import (SimilarityIndex, ExactIndex,
+                                            benchmark, find_duplicates)
+
+import numpy
+import pytest
+import tempfile
+
+
+class TestGravitySpySimilarity(object):
+    """`TestCase` for the GravitySpy similarity search
+    """
+    def test_similarity_index(self):
+
+        rng = numpy.random.RandomState(1986)
+        centres = numpy.abs(rng.randn(20, 200))
+        features = numpy.abs(centres[rng.randint(20, size=2000)] +
+                             0.3 * rng.randn(2000, 200))
+        ids = ['id{0}'.format(idx) for idx in range(2000)]
+
+        index = SimilarityIndex(nlist=16, nprobe=4)
+        # the cells are placed by an explicit training
+        with pytest.raises(ValueError):
+            index.add(features[:1500], ids[:1500])
+        index.train(features[:1500])
+        index.add(features[:1500], ids[:1500])
+        index.add(features[1500:], ids[1500:])
+        assert len(index) == 2000
+
+        found, similarity = index.query('id7', k=5)
+        assert found[0] == 'id7'
+        numpy.testing.assert_allclose(similarity[0], 1, rtol=1e-5)
+        assert (numpy.diff(similarity) <= 0).all()
+
+        # scanning every cell is an exact search
+        assert benchmark(index, features[:20], k=10, nprobe=16)['recall'] == 1
+        assert benchmark(index, features[:20], k=10)['recall'] > 0.9
+
+        # re-adding an event replaces its vector
+        index.add(features[8:9], ['id7'])
+        assert len(index) == 2000
+        assert set(index.query('id7', k=2)[0]) == set(['id7', 'id8'])
+
+        with tempfile.NamedTemporaryFile(suffix='.h5') as f:
+            index.save(f.name)
+            numpy.testing.assert_array_equal(
+                SimilarityIndex.read(f.name).query(features[3], k=10)[0],
+                index.query(features[3], k=10)[0])
+
+            # adding to the file appends to its cells in place
+            SimilarityIndex.add_to_file(f.name, features[8:9], ['id7'])
+            SimilarityIndex.add_to_file(f.name, features[9:10], ['new'])
+            index.add(features[9:10], ['new'])
+            saved = SimilarityIndex.read(f.name)
+            assert len(saved) == 2001
+            assert set(saved.query('new', k=2)[0]) == set(['new', 'id9'])
+            numpy.testing.assert_array_equal(
+                saved.query(features[3], k=10)[0],
+                index.query(features[3], k=10)[0])
+
+    def test_exact_index(self):
+
+        rng = numpy.random.RandomState(1986)
+        features = rng.randn(5000, 200)
+        ids = numpy.array(['id{0}'.format(idx) for idx in range(5000)])
+        queries = rng.randn(30, 200)
+
+        similarity = (queries / numpy.linalg.norm(queries, axis=1)[:, None]).dot(
+                      (features / numpy.linalg.norm(features, axis=1)[:, None]).T)
+        expected = numpy.argsort(-similarity, axis=1)[:, :10]
+
+        index = ExactIndex(features, ids)
+        for block_size, nthreads in ((None, 1), (64, 1), (333, 4)):
+            found, found_similarity = index.search(queries, k=10,
+                                                   block_size=block_size,
+                                                   nthreads=nthreads)
+            numpy.testing.assert_array_equal(found, ids[expected])
+            numpy.testing.assert_allclose(
+                found_similarity,
+                numpy.sort(similarity, axis=1)[:, ::-1][:, :10], atol=1e-5)
+
+        with tempfile.NamedTemporaryFile(suffix='.h5') as f:
+            index.save(f.name)
+            mapped = ExactIndex.read(f.name)
+            assert isinstance(mapped.vectors, numpy.memmap)
+            assert mapped.query('id7', k=1)[0][0] == 'id7'
+            numpy.testing.assert_array_equal(mapped.search(queries, k=10)[0],
+                                             ids[expected])
+
+    def test_product_quantizer(self):
+
+        rng = numpy.random.RandomState(1986)
+        centres = numpy.abs(rng.randn(20, 200))
+        features = numpy.abs(centres[rng.randint(20, size=2000)] +
+                             0.3 * rng.randn(2000, 200))
+        ids = numpy.array(['id{0}'.format(idx) for idx in range(2000)])
+
+        quantizer = ProductQuantizer(nsubspaces=50, ncentroids=64)
+        quantizer.train(features, niter=10)
+        codes = quantizer.encode(features)
+        assert codes.dtype == numpy.uint8 and codes.shape == (2000, 50)
+
+        normalised = features / numpy.linalg.norm(features, axis=1)[:, None]
+        decoded = quantizer.decode(codes)
+        assert (decoded * normalised).sum(1).mean() > 0.95
+
+        # the scores of the index are those of the decoded vectors
+        index = PQIndex(quantizer, codes, ids)
+        found, similarity = index.search(features[:10], k=5)
+        expected = numpy.argsort(-normalised[:10].dot(decoded.T),
+                                 axis=1)[:, :5]
+        numpy.testing.assert_array_equal(found, ids[expected])
+        numpy.testing.assert_allclose(
+            similarity, normalised[:10].dot(decoded.T)[
+                numpy.arange(10)[:, None], expected], atol=1e-5)
+
+        # a few queries are scored with lookup tables, to the same result
+        found, similarity = index.search(features[:2], k=5)
+        numpy.testing.assert_array_equal(found, ids[expected[:2]])
+        numpy.testing.assert_allclose(
+            similarity, normalised[:2].dot(decoded.T)[
+                numpy.arange(2)[:, None], expected[:2]], atol=1e-5)
+
+        with tempfile.NamedTemporaryFile(suffix='.h5') as f:
+            quantizer.save(f.name)
+            numpy.testing.assert_array_equal(
+                ProductQuantizer.read(f.name).encode(features), codes)
+
+    def test_find_duplicates(self):
+
+        event_time = numpy.array([10.0, 10.2, 10.6, 20.0, 10.1, 30.0, 30.3])
+        ifo = numpy.array(['H1', 'H1', 'H1', 'H1', 'L1', 'H1', 'H1'])
+        # chains of repeats all point to their first event
+        numpy.testing.assert_array_equal(
+            find_duplicates(event_time, ifo, block_size=2),
+            [-1, 0, 0, -1, -1, -1, 5])
+
+        rng = numpy.random.RandomState(1986)
+        features = rng.rand(7, 200)
+        features[1] = features[0] + 1e-3
+        features[2] = features[1]
+        numpy.testing.assert_array_equal(
+            find_duplicates(event_time, ifo, features),
+            [-1, 0, 0, -1, -1, -1, -1])
+
+    def test_create_pairs(self):
+
+        labels = numpy.random.RandomState(1986).randint(4, size=100)
+        data = numpy.repeat(labels[:, None], 3, axis=1).astype(float)
+        class_indices = [numpy.where(labels == idx)[0] for idx in range(4)]
+
+        generator = create_pairs3_gen(data, class_indices, 8, random_state=1)
+        prefetched = create_pairs3_gen(data, class_indices, 8,
+                                       random_state=1, prefetch=2)
+        for _ in range(3):
+            [pairs1, pairs2], same = next(generator)
+            assert pairs1.shape == (16, 3)
+            assert pairs1.dtype == numpy.float32
+            numpy.testing.assert_array_equal(pairs1[:, 0] == pairs2[:, 0],
+                                             same == 1)
+            # the same seed draws the same pairs in the background
+            [_, prefetched2], _ = next(prefetched)
+            numpy.testing.assert_array_equal(prefetched2, pairs2)
+
+        # every epoch draws the same pairs, however it is started
+        epochs = create_pairs3_gen(data, class_indices, 8, random_state=1,
+                                   prefetch=2, steps_per_epoch=3)
+        batches = [next(epochs)[0][1] for _ in range(6)]
+        resumed = create_pairs3_gen(data, class_indices, 8, random_state=1,
+                                    steps_per_epoch=3, initial_epoch=1)
+        for expected in batches[3:]:
+            numpy.testing.assert_array_equal(next(resumed)[0][1], expected)
+
+        # the anchors are spread evenly over the samples, so each class
+        # anchors pairs in proportion to its size
+        labels = numpy.repeat([0, 1], [95, 5])
+        data = labels[:, None].astype(float)
+        class_indices = [numpy.where(labels == idx)[0] for idx in range(2)]
+        [pairs1, _], _ = next(create_pairs3_gen(data, class_indices, 1000,
+                                                random_state=1))
+        assert abs(pairs1[:, 0].mean() - 0.05) < 0.02
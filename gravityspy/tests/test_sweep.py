@@ -0,0 +1,50 @@
+"""Unit test for GravitySpy
+"""
+
+__author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
+
+import os
+os.environ["KERAS_BACKEND"] = "theano"
+
+from gravityspy.ml.pixel_store import pixelize_trainingset
+from gravityspy.ml.sweep import grid, random_search, run_sweep
+
+import tempfile
+
+TRAINING_SET_PATH = os.path.join(os.path.split(__file__)[0], 'data',
+                                 'images', 'TrainingSet')
+
+
+class TestGravitySpySweep(object):
+    """`TestCase` for the GravitySpy sweeps over training options
+    """
+    def test_sweep_trials(self):
+
+        trials = grid({'batch_size': [22, 44], 'nb_epoch': [1, 2, 3]})
+        assert len(trials) == 6
+        assert {'batch_size': 44, 'nb_epoch': 3} in trials
+
+        trials = random_search({'batch_size': [22, 44],
+                                'fraction_validation': {'uniform': [.1, .2]}},
+                               5, random_state=1986)
+        assert len(trials) == 5
+        for trial in trials:
+            assert trial['batch_size'] in [22, 44]
+            assert .1 <= trial['fraction_validation'] <= .2
+
+    def test_run_sweep(self):
+
+        with tempfile.NamedTemporaryFile(suffix='.h5') as f:
+            grayscale_store, _ = pixelize_trainingset(TRAINING_SET_PATH,
+                                                      grayscale_file=f.name)
+            grayscale_store.close()
+            results = run_sweep(f.name, grid({'batch_size': [2, 4]}),
+                                nb_epoch=1, fraction_validation=.5)
+
+        assert len(results) == 2
+        assert sorted(results.batch_size) == [2, 4]
+        assert sorted(results.columns) == sorted(
+            ['batch_size', 'accuracy', 'recall_Blip', 'recall_Scratchy',
+             'wall_time', 'images_per_second'])
+        assert ((results.accuracy >= 0) & (results.accuracy <= 1)).all()
+        assert (results.images_per_second > 0).all()
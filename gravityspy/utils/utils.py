@@ -23,10 +23,10 @@ from ..ml import labelling_test_glitches as label_glitches
 
 from gwpy.timeseries import TimeSeries
 from gwpy.segments import Segment
+from gwpy.signal import qtransform
 from gwpy.table import GravitySpyTable
 
 import numpy
-import h5py
 import os
 import pandas
 import matplotlib.pyplot as plt
@@ -59,6 +59,7 @@ def make_q_scans(event_time, **kwargs):
     source = kwargs.pop('source', None)
     channel_name = kwargs.pop('channel_name', None)
     frametype = kwargs.pop('frametype', None)
+    share_q_transform = kwargs.pop('share_q_transform', False)
     verbose = kwargs.pop('verbose', False)
 
     if verbose:
@@ -93,16 +94,191 @@ def make_q_scans(event_time, **kwargs):
                                plot_time_ranges, plot_normalized_energy_range))
 
     # find closest sample time to event time
-    center_time = (
-                   numpy.floor(event_time) +
-                   numpy.round((event_time - numpy.floor(event_time)) *
-                   sample_frequency) / sample_frequency
-                  )
+    center_time = _nearest_sample_time(event_time, sample_frequency)
 
     # determine segment start and stop times
     start_time = round(center_time - block_time / 2)
     stop_time = start_time + block_time
 
+    data = _read_block(start_time, stop_time, sample_frequency,
+                       timeseries=timeseries, source=source,
+                       channel_name=channel_name, frametype=frametype,
+                       verbose=verbose)
+
+    # Cropping the results before interpolation to save on time and memory
+    # perform the q-transform
+    if verbose:
+        logger.info('Processing Q Scans...')
+
+    specsgrams, q_value = _q_scans_from_data(data, center_time,
+                                             search_q_range,
+                                             search_frequency_range,
+                                             plot_time_ranges,
+                                             share_q_transform=share_q_transform)
+
+    if verbose:
+        logger.info('The most significant q value is {0}'.format(q_value))
+
+    return specsgrams, q_value
+
+def make_block_q_scans(event_times, **kwargs):
+    """Make the q scans of several triggers from one shared block of data
+
+    The data covering all of the triggers is read, resampled and whitened a
+    single time and every trigger is then Q-transformed from the
+    `block_time` of that whitened block `make_q_scans` would have read
+    around it, so the tiling and the fallback to a wider output segment
+    are the same. The whitening uses the ASD of the whole shared block,
+    up to one and a half `block_time` long, and tapers only its outer
+    edges, so the normalised energies differ slightly from those of
+    `make_q_scans`, by a few percent for stationary noise. A trigger alone
+    in its block gets the same spectrograms. The triggers are expected to
+    have been grouped with `group_by_block` so that each of them still
+    has at least half a `block_time` of data on either side.
+
+    Parameters:
+
+        event_times (list):
+            The trigger times that share a block of data
+
+        **kwargs:
+            config, timeseries, source, channel_name, frametype,
+            share_q_transform, verbose
+
+    Returns:
+
+        list:
+            a (specsgrams, q_value) tuple for every event time
+    """
+    # Parse Keyword Arguments
+    config = kwargs.pop('config', GravitySpyConfigFile())
+    timeseries = kwargs.pop('timeseries', None)
+    source = kwargs.pop('source', None)
+    channel_name = kwargs.pop('channel_name', None)
+    frametype = kwargs.pop('frametype', None)
+    share_q_transform = kwargs.pop('share_q_transform', False)
+    verbose = kwargs.pop('verbose', False)
+
+    if verbose:
+        logger = log.Logger('Gravity Spy: Making Block Q Scans')
+
+    if (timeseries is None) and (channel_name is None):
+        raise ValueError("If not directly passing a timeseries, then "
+                         "the user must pass channel_name")
+
+    sample_frequency = config.sample_frequency
+    block_time = config.block_time
+
+    center_times = [_nearest_sample_time(event_time, sample_frequency)
+                    for event_time in event_times]
+
+    # the block spans from half a block before the first trigger
+    # to half a block after the last
+    start_time = round(min(center_times) - block_time / 2)
+    stop_time = round(max(center_times) - block_time / 2) + block_time
+
+    data = _read_block(start_time, stop_time, sample_frequency,
+                       timeseries=timeseries, source=source,
+                       channel_name=channel_name, frametype=frametype,
+                       verbose=verbose)
+
+    if verbose:
+        logger.info('Whitening {0} seconds of data for {1} '
+                    'triggers...'.format(stop_time - start_time,
+                                         len(center_times)))
+
+    whitened = _whiten(data)
+
+    results = []
+    for center_time in center_times:
+        # crop to the block make_q_scans would have read for this trigger,
+        # so the tiling of the transform matches
+        trigger_start = round(center_time - block_time / 2)
+        trigger_data = whitened.crop(trigger_start,
+                                     trigger_start + block_time)
+        results.append(_q_scans_from_data(trigger_data, center_time,
+                                          config.search_q_range,
+                                          config.search_frequency_range,
+                                          config.plot_time_ranges,
+                                          share_q_transform=share_q_transform,
+                                          whiten=False))
+
+    return results
+
+def group_by_block(event_times, block_time=64):
+    """Group trigger times so that each group can share one block of data
+
+    Triggers are taken in time order and a new group is started whenever a
+    trigger is more than half a `block_time` after the first trigger of the
+    current group, so no group needs more than one and a half blocks of data.
+
+    Parameters:
+
+        event_times (array):
+            The trigger times
+
+        block_time (float, optional):
+            Default 64
+
+    Returns:
+
+        list:
+            a `numpy.ndarray` of indices into `event_times` per group
+    """
+    event_times = numpy.asarray(event_times, dtype=float)
+    if not event_times.size:
+        return []
+
+    order = numpy.argsort(event_times, kind='mergesort')
+    sorted_times = event_times[order]
+
+    groups = []
+    first = 0
+    for idx in range(1, sorted_times.size):
+        if sorted_times[idx] - sorted_times[first] > block_time / 2.:
+            groups.append(order[first:idx])
+            first = idx
+    groups.append(order[first:])
+
+    return groups
+
+def _nearest_sample_time(event_time, sample_frequency):
+    """Find the closest sample time to the event time
+    """
+    return (numpy.floor(event_time) +
+            numpy.round((event_time - numpy.floor(event_time)) *
+                        sample_frequency) / sample_frequency)
+
+def _read_block(start_time, stop_time, sample_frequency, **kwargs):
+    """Read in and resample a block of data
+
+    Parameters:
+
+        start_time (float):
+            The start of the block
+
+        stop_time (float):
+            The end of the block
+
+        sample_frequency (int):
+            The sample rate the data should have
+
+        **kwargs:
+            timeseries, source, channel_name, frametype, verbose
+
+    Returns:
+
+        `gwpy.timeseries.TimeSeries`
+    """
+    timeseries = kwargs.pop('timeseries', None)
+    source = kwargs.pop('source', None)
+    channel_name = kwargs.pop('channel_name', None)
+    frametype = kwargs.pop('frametype', None)
+    verbose = kwargs.pop('verbose', False)
+
+    if verbose:
+        logger = log.Logger('Gravity Spy: Reading Data')
+
     # Read in the data
     if timeseries:
         data = timeseries.crop(start_time, stop_time, verbose=verbose)
@@ -123,10 +299,53 @@ def make_q_scans(event_time, **kwargs):
     if data.sample_rate.decompose().value != sample_frequency:
         data = data.resample(sample_frequency)
 
-    # Cropping the results before interpolation to save on time and memory
-    # perform the q-transform
-    if verbose:
-        logger.info('Processing Q Scans...')
+    return data
+
+def _q_scans_from_data(data, center_time, search_q_range,
+                       search_frequency_range, plot_time_ranges,
+                       share_q_transform=False, whiten=True):
+    """Make the spectrograms of every plot window from a block of data
+
+    Parameters:
+
+        data (`gwpy.timeseries.TimeSeries`):
+            The resampled block of data around the event
+
+        center_time (float):
+            The time the spectrograms are centered on
+
+        search_q_range (tuple):
+            The range of Q values to search
+
+        search_frequency_range (tuple):
+            The range of frequencies to search
+
+        plot_time_ranges (list):
+            The duration assosciated with each spectrogram to be made
+
+        share_q_transform (bool, optional):
+            Default False, if True compute one Q-transform over the widest
+            window and derive the other windows from it
+
+        whiten (bool, optional):
+            Default True, set to False if `data` has already been whitened
+
+    Returns:
+
+        specsgrams (list):
+            A list of `gwpy.spectrogram.Spectrogram` objects
+
+        q_value (float):
+            The Q of the most significant plane
+    """
+    if share_q_transform:
+        try:
+            return _make_shared_q_scans(data, center_time, search_q_range,
+                                        search_frequency_range,
+                                        plot_time_ranges, whiten=whiten)
+        except:
+            # fall back to a transform per window
+            pass
 
     specsgrams = []
     for time_window in plot_time_ranges:
@@ -138,7 +357,7 @@ def make_q_scans(event_time, **kwargs):
                                       frange=tuple(search_frequency_range),
                                       gps=center_time,
                                       search=0.5, tres=0.002,
-                                      fres=0.5, outseg=outseg, whiten=True)
+                                      fres=0.5, outseg=outseg, whiten=whiten)
             q_value = q_scan.q
             q_scan = q_scan.crop(center_time-time_window/2,
                                  center_time+time_window/2)
@@ -149,17 +368,101 @@ def make_q_scans(event_time, **kwargs):
                                       frange=tuple(search_frequency_range),
                                       gps=center_time, search=0.5,
                                       tres=0.002,
-                                      fres=0.5, outseg=outseg, whiten=True)
+                                      fres=0.5, outseg=outseg, whiten=whiten)
             q_value = q_scan.q
             q_scan = q_scan.crop(center_time-time_window/2,
                                  center_time+time_window/2)
         specsgrams.append(q_scan)
 
-    if verbose:
-        logger.info('The most significant q value is {0}'.format(q_value))
+    return specsgrams, q_value
+
+def _make_shared_q_scans(data, center_time, search_q_range,
+                         search_frequency_range, plot_time_ranges,
+                         tres=0.002, fres=0.5, whiten=True):
+    """Q-transform the data once and derive every plot window from it
+
+    The whitening, the tiling and the search for the loudest Q-plane do not
+    depend on the output segment, so they are done a single time, as
+    `TimeSeries.q_transform` does them. Each window is then interpolated
+    from the resulting `QGram` over its own time span, with the same
+    fallback to a wider output segment as the separate transforms.
+
+    Parameters:
+
+        data (`gwpy.timeseries.TimeSeries`):
+            The resampled block of data around the event
+
+        center_time (float):
+            The time the spectrograms are centered on
+
+        search_q_range (tuple):
+            The range of Q values to search
+
+        search_frequency_range (tuple):
+            The range of frequencies to search
+
+        plot_time_ranges (list):
+            The duration assosciated with each spectrogram to be made
+
+        tres (float, optional):
+            Default 0.002
+
+        fres (float, optional):
+            Default 0.5
+
+        whiten (bool, optional):
+            Default True, set to False if `data` has already been whitened
+
+    Returns:
+
+        specsgrams (list):
+            A list of `gwpy.spectrogram.Spectrogram` objects
+
+        q_value (float):
+            The Q of the most significant plane
+    """
+    if whiten:
+        data = _whiten(data)
+
+    # search half a second around the event, as q_transform does
+    search = Segment(center_time - 0.25, center_time + 0.25) & data.span
+    qgram, _ = qtransform.q_scan(data, qrange=tuple(search_q_range),
+                                 frange=tuple(search_frequency_range),
+                                 mismatch=0.2, norm='median', search=search)
+
+    specsgrams = []
+    for time_window in plot_time_ranges:
+        duration_for_plot = time_window/2
+        try:
+            outseg = Segment(center_time - duration_for_plot,
+                             center_time + duration_for_plot)
+            q_scan = qgram.interpolate(tres=tres, fres=fres, outseg=outseg)
+        except:
+            outseg = Segment(center_time - 2*duration_for_plot,
+                             center_time + 2*duration_for_plot)
+            q_scan = qgram.interpolate(tres=tres, fres=fres, outseg=outseg)
+        q_value = q_scan.q
+        specsgrams.append(q_scan.crop(center_time-time_window/2,
+                                      center_time+time_window/2))
 
     return specsgrams, q_value
 
+def _whiten(data):
+    """Whiten a block of data the way `TimeSeries.q_transform` does
+
+    Parameters:
+
+        data (`gwpy.timeseries.TimeSeries`):
+            The resampled block of data
+
+    Returns:
+
+        `gwpy.timeseries.TimeSeries`
+    """
+    # same FFT length and overlap q_transform would have used
+    fftlength = max(2, int(numpy.ceil(2048. * data.dt.decompose().value)))
+    return data.whiten(fftlength, fftlength / 2., window='hann')
+
 def save_q_scans(plot_directory, specsgrams,
                  plot_normalized_energy_range, plot_time_ranges,
                  detector_name, event_time, **kwargs):
@@ -211,6 +514,57 @@ def save_q_scans(plot_directory, specsgrams,
 
     return
 
+def _sort_views(list_of_images):
+    """Group image names into sorted per-duration lists
+
+    Parameters:
+
+        list_of_images (list):
+            names of the 0.5, 1.0, 2.0 and 4.0 second images of any
+            number of events
+
+    Returns:
+
+        four lists of image names, the n-th entry of each
+        belonging to the same event
+    """
+    return [sorted(image for image in list_of_images
+                   if image.endswith('_{0}.png'.format(dur)))
+            for dur in ('0.5', '1.0', '2.0', '4.0')]
+
+def _read_views(list_of_images, resolution=0.3, verbose=False):
+    """Read the views of many events into one contiguous array
+
+    Parameters:
+
+        list_of_images (list):
+            for each event, the paths to its 0.5, 1.0, 2.0 and 4.0
+            second images
+
+        resolution (float, optional):
+            Default 0.3
+
+    Returns:
+
+        views (`numpy.ndarray`):
+            float32 array of shape (N, 4, npixels)
+    """
+    if verbose:
+        logger = log.Logger('Gravity Spy: Reading Images')
+
+    views = None
+    for ievent, images in enumerate(list_of_images):
+        for iview, image in enumerate(images):
+            if verbose:
+                logger.info('Converting {0}'.format(image))
+            pixels = read_image.read_grayscale(image, resolution=resolution)
+            if views is None:
+                views = numpy.empty((len(list_of_images), len(images),
+                                     pixels.size), dtype=numpy.float32)
+            views[ievent, iview] = pixels
+
+    return views
+
 def label_q_scans(plot_directory, path_to_cnn, **kwargs):
     """Classify triggers in this table
 
@@ -223,11 +577,14 @@ def label_q_scans(plot_directory, path_to_cnn, **kwargs):
     verbose = kwargs.pop('verbose', False)
     order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
     original_order = kwargs.pop('original_order', False)
+    backend = kwargs.pop('backend', 'keras')
+    server = kwargs.pop('inference_server', None)
+    batch_size = kwargs.pop('batch_size', 64)
 
-    f = h5py.File(path_to_cnn, 'r')
-    # load the api gravityspy project cached class
-    classes = kwargs.pop('classes',
-                         numpy.array(f['/labels/labels']).astype(str).T[0])
+    # load the class names stored with the model
+    classes = kwargs.pop('classes', None)
+    if classes is None:
+        classes = label_glitches.get_labels(path_to_cnn)
 
     if verbose:
         logger = log.Logger('Gravity Spy: Labelling Images')
@@ -240,41 +597,344 @@ def label_q_scans(plot_directory, path_to_cnn, **kwargs):
     if verbose:
         logger.info('Converting image to ML readable...')
 
-    image_data_for_cnn = pandas.DataFrame()
-    for image in list_of_images:
-        if verbose:
-            logger.info('Converting {0}'.format(image))
-
-        image_data = read_image.read_grayscale(os.path.join(plot_directory, image),
-                                               resolution=0.3)
-        image_data_for_cnn[image] = [image_data]
+    filename1, filename2, filename3, filename4 = _sort_views(list_of_images)
+    views = _read_views([[os.path.join(plot_directory, image)
+                          for image in images]
+                         for images in zip(filename1, filename2,
+                                           filename3, filename4)],
+                        resolution=0.3, verbose=verbose)
+    ids = [uid.split('_')[1] for uid in filename1]
 
     # Now label the image
     if verbose:
         logger.info('Labelling image...')
 
-    scores, ml_label, ids, filename1, filename2, filename3, filename4 = \
-         label_glitches.label_glitches(image_data=image_data_for_cnn,
-                                       model_name='{0}'.format(path_to_cnn),
-                                       image_size=[140, 170],
-                                       order_of_channels=order_of_channels,
-                                       original_order=original_order,
-                                       verbose=verbose)
+    scores, ml_label = label_glitches.label_views(
+                           views=views,
+                           model_name='{0}'.format(path_to_cnn),
+                           image_size=[140, 170],
+                           order_of_channels=order_of_channels,
+                           original_order=original_order,
+                           backend=backend,
+                           server=server,
+                           batch_size=batch_size,
+                           verbose=verbose)
+
+    return _scores_table(scores, ml_label, classes, ids,
+                         [filename1, filename2, filename3, filename4])
+
+def label_and_get_features(plot_directory, path_to_cnn,
+                           path_to_semantic_model, **kwargs):
+    """Classify and extract the features of the q scans in a directory
+
+    Each image is decoded only once for both the classifier and
+    the similarity model.
+
+    Parameters:
+
+        plot_directory (str):
+            where the images made by `save_q_scans` live
+
+        path_to_cnn (str):
+            filename of the CNN you would like to use
+
+        path_to_semantic_model (str):
+            filename of the similarity model you would like to use
+
+        **kwargs:
+            nthreads : number of threads decoding the images
+            inference_server : address of a running
+            `gravityspy.ml.inference_server.InferenceServer`
+
+    Returns:
+
+        scores_table, features_table (`gwpy.table.GravitySpyTable`):
+            what `label_q_scans` and `get_features` return
+    """
+    return extract_all(plot_directory, path_to_cnn,
+                       path_to_semantic_model=path_to_semantic_model,
+                       **kwargs)
+
+def extract_all(plot_directory, path_to_cnn, path_to_semantic_model=None,
+                layers=[], **kwargs):
+    """Scores, deep layers and features of the q scans in a directory
+
+    Each image is decoded once and each event goes through the
+    classifier once, however many activations are asked for.
+
+    Parameters:
+
+        plot_directory (str):
+            where the images made by `save_q_scans` live
+
+        path_to_cnn (str):
+            filename of the CNN you would like to use
+
+        path_to_semantic_model (str, optional):
+            filename of the similarity model you would like to use,
+            if None no features are extracted
+
+        layers (list, optional):
+            Default [], index or name of each layer of the CNN whose
+            activations are added to the scores table as
+            ``deeplayer_<layer>`` columns, e.g. [20]
+
+        **kwargs:
+            original_order : Default False, as in `label_q_scans`
+            nthreads : number of threads decoding the images
+            inference_server : address of a running
+            `gravityspy.ml.inference_server.InferenceServer`
+
+    Returns:
+
+        scores_table, features_table (`gwpy.table.GravitySpyTable`):
+            what `label_q_scans` and `get_features` return,
+            features_table is None without a similarity model
+    """
+    list_of_images = [ifile for ifile in os.listdir(plot_directory)
+                      if 'spectrogram' in ifile]
+
+    filename1, filename2, filename3, filename4 = _sort_views(list_of_images)
+    ids = [uid.split('_')[1] for uid in filename1]
+
+    scores, ml_label, activations, features, classes = _extract_views(
+        [[os.path.join(plot_directory, image) for image in images]
+         for images in zip(filename1, filename2, filename3, filename4)],
+        path_to_cnn, path_to_semantic_model, layers, **kwargs)
+
+    scores_table = _scores_table(scores, ml_label, classes, ids,
+                                 [filename1, filename2, filename3, filename4])
+    for layer in layers:
+        scores_table['deeplayer_{0}'.format(layer)] = activations[layer]
+
+    return scores_table, _features_table(features, ids)
+
+def extract_all_select_images(filename1, filename2, filename3, filename4,
+                              path_to_cnn=None, path_to_semantic_model=None,
+                              layers=[], **kwargs):
+    """Scores, deep layers and features of the images of known events
+
+    What `label_select_images` and `get_features_select_images` do
+    between them, with each image decoded once and each event going
+    through each model once.
+
+    Parameters:
+
+        filename1, filename2, filename3, filename4 (list):
+            the 0.5, 1.0, 2.0 and 4.0 second images of each event
+
+        path_to_cnn (str, optional):
+            filename of the CNN you would like to use,
+            if None the events are not scored
+
+        path_to_semantic_model (str, optional):
+            filename of the similarity model you would like to use,
+            if None no features are extracted
+
+        layers (list, optional):
+            Default [], as in `extract_all`
+
+        **kwargs:
+            as in `extract_all`
+
+    Returns:
+
+        scores_table, features_table (`gwpy.table.GravitySpyTable`):
+            what `label_select_images` and `get_features_select_images`
+            return, each None without its model
+    """
+    if path_to_cnn is None and path_to_semantic_model is None:
+        raise ValueError("Either a CNN or a similarity model is needed")
+
+    list_of_images_all = list(zip(filename1, filename2,
+                                  filename3, filename4))
+    ids = [images[0].split('/')[-1].split('_')[1]
+           for images in list_of_images_all]
+
+    scores, ml_label, activations, features, classes = _extract_views(
+        list_of_images_all, path_to_cnn, path_to_semantic_model, layers,
+        **kwargs)
+
+    scores_table = None
+    if scores is not None:
+        scores_table = _scores_table(scores, ml_label, classes, ids)
+        for layer in layers:
+            scores_table['deeplayer_{0}'.format(layer)] = activations[layer]
+
+    return scores_table, _features_table(features, ids)
+
+def _extract_views(list_of_images_all, path_to_cnn, path_to_semantic_model,
+                   layers, **kwargs):
+    """Decode the views of many events once and run them through the models
+
+    Returns:
+
+        scores, ml_label, activations, features, classes:
+            the scores and labels are None without a CNN and
+            the features are None without a similarity model
+    """
+    verbose = kwargs.pop('verbose', False)
+    order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
+    original_order = kwargs.pop('original_order', False)
+    backend = kwargs.pop('backend', 'keras')
+    server = kwargs.pop('inference_server', None)
+    batch_size = kwargs.pop('batch_size', 64)
+    nthreads = kwargs.pop('nthreads', 1)
+
+    # load the class names stored with the model
+    classes = kwargs.pop('classes', None)
+    if classes is None and path_to_cnn is not None:
+        classes = label_glitches.get_labels(path_to_cnn)
 
+    if verbose:
+        logger = log.Logger('Gravity Spy: Labelling Images '
+                            'And Extracting Features')
+        logger.info('Converting image to ML and RGB readable...')
+
+    if path_to_semantic_model is None:
+        views = _read_views(list_of_images_all, resolution=0.3,
+                            verbose=verbose)
+        views_rgb = None
+    else:
+        views, views_rgb = read_image.read_grayscale_and_rgb_batch(
+                               [image for images in list_of_images_all
+                                for image in images],
+                               resolution=0.3, nthreads=nthreads)
+        views = views.reshape(len(list_of_images_all), 4, -1)
+        views_rgb = views_rgb.reshape(len(list_of_images_all), 4, 3, -1)
+
+    if verbose:
+        logger.info('Labelling image and extracting features...')
+
+    if path_to_cnn is None:
+        features = label_glitches.get_views_feature_space(
+                       views_rgb,
+                       '{0}'.format(path_to_semantic_model),
+                       order_of_channels=order_of_channels,
+                       image_size=[140, 170],
+                       batch_size=batch_size,
+                       server=server,
+                       verbose=verbose)
+        return None, None, {}, features, classes
+
+    scores, ml_label, activations, features = label_glitches.extract_all(
+        views=views,
+        model_name='{0}'.format(path_to_cnn),
+        rgb_views=views_rgb,
+        semantic_model_name=path_to_semantic_model,
+        layers=layers,
+        image_size=[140, 170],
+        order_of_channels=order_of_channels,
+        original_order=original_order,
+        backend=backend,
+        server=server,
+        batch_size=batch_size,
+        verbose=verbose)
+
+    return scores, ml_label, activations, features, classes
+
+def _features_table(features, ids):
+    if features is None:
+        return None
+
+    features_table = GravitySpyTable(features,
+                                     names=numpy.arange(
+                                         0, features.shape[1]).astype(str))
+    features_table['gravityspy_id'] = ids
+
+    return features_table
+
+def _scores_table(scores, ml_label, classes, ids, filenames=None):
     labels = numpy.array(classes)[ml_label]
 
     scores_table = GravitySpyTable(scores, names=classes)
 
-    scores_table['Filename1'] = filename1
-    scores_table['Filename2'] = filename2
-    scores_table['Filename3'] = filename3
-    scores_table['Filename4'] = filename4
+    # only the tables of freshly made q scans name their images
+    if filenames is not None:
+        for idx, filename in enumerate(filenames):
+            scores_table['Filename{0}'.format(idx + 1)] = filename
     scores_table['gravityspy_id'] = ids
     scores_table['ml_label'] = labels
     scores_table['ml_confidence'] = scores.max(1)
 
     return scores_table
 
+def label_spectrograms(specsgrams, plot_normalized_energy_range,
+                       plot_time_ranges, detector_name, event_time,
+                       path_to_cnn, **kwargs):
+    """Classify spectrograms without rendering them to PNG
+
+    The spectrograms are converted straight to the pixels that
+    `save_q_scans` followed by `label_q_scans` would have fed the CNN.
+
+    Parameters:
+
+        specsgrams (list):
+            A list of `gwpy.spectrogram.Spectrogram` objects
+
+        plot_normalized_energy_range (array):
+            The min and max of the colorbar for the plots
+
+        plot_time_ranges (array):
+            The duration assosciated with each spectrogram
+
+        detector_name (str):
+            What detetor where these spectrograms from
+
+        event_time (float):
+            The time of the event
+
+        path_to_cnn (str):
+            filename of the CNN you would like to use
+
+    Returns:
+
+        `gwpy.table.GravitySpyTable`
+            with the Filename1 to Filename4 columns left empty
+    """
+    id_string = kwargs.pop('id_string', '{0:.9f}'.format(event_time))
+    frange = kwargs.pop('frange', [10, 2048])
+    verbose = kwargs.pop('verbose', False)
+    order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
+    original_order = kwargs.pop('original_order', False)
+    backend = kwargs.pop('backend', 'keras')
+    server = kwargs.pop('inference_server', None)
+
+    # load the class names stored with the model
+    classes = kwargs.pop('classes', None)
+    if classes is None:
+        classes = label_glitches.get_labels(path_to_cnn)
+
+    if verbose:
+        logger = log.Logger('Gravity Spy: Labelling Spectrograms')
+        logger.info('Converting spectrograms to ML readable...')
+
+    views = numpy.stack([read_image.read_spectrogram_grayscale(
+                             specsgram, plot_normalized_energy_range,
+                             frange=frange, resolution=0.3)
+                         for specsgram in specsgrams])[numpy.newaxis]
+
+    # no images are written, so there are no files to name
+    filename1, filename2, filename3, filename4 = [['']] * 4
+    ids = [id_string]
+
+    # Now label the image
+    if verbose:
+        logger.info('Labelling image...')
+
+    scores, ml_label = label_glitches.label_views(
+                           views=views,
+                           model_name='{0}'.format(path_to_cnn),
+                           image_size=[140, 170],
+                           order_of_channels=order_of_channels,
+                           original_order=original_order,
+                           backend=backend,
+                           server=server,
+                           verbose=verbose)
+
+    return _scores_table(scores, ml_label, classes, ids,
+                         [filename1, filename2, filename3, filename4])
+
 def label_select_images(filename1, filename2, filename3, filename4,
                         path_to_cnn, **kwargs):
     """Classify triggers in this table
@@ -288,59 +948,44 @@ def label_select_images(filename1, filename2, filename3, filename4,
     verbose = kwargs.pop('verbose', False)
     order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
     original_order = kwargs.pop('original_order', False)
+    backend = kwargs.pop('backend', 'keras')
+    server = kwargs.pop('inference_server', None)
+    batch_size = kwargs.pop('batch_size', 64)
 
-    # determine class names
-    f = h5py.File(path_to_cnn, 'r')
-    classes = kwargs.pop('classes',
-                         numpy.array(f['/labels/labels']).astype(str).T[0])
+    # load the class names stored with the model
+    classes = kwargs.pop('classes', None)
+    if classes is None:
+        classes = label_glitches.get_labels(path_to_cnn)
 
     if verbose:
         logger = log.Logger('Gravity Spy: Labelling Select Images')
 
-    list_of_images_all = [filename1,
-                          filename2,
-                          filename3,
-                          filename4]
-
-    list_of_images_all = zip(list_of_images_all[0], list_of_images_all[1],
-                             list_of_images_all[2], list_of_images_all[3])
+    list_of_images_all = list(zip(filename1, filename2,
+                                  filename3, filename4))
 
     if verbose:
         logger.info('Converting image to ML readable...')
 
-    image_data_for_cnn = pandas.DataFrame()
-
-    for list_of_images in list_of_images_all:
-        for image in list_of_images:
-            image_name = image.split('/')[-1]
-            if verbose:
-                logger.info('Converting {0}'.format(image_name))
-
-            image_data = read_image.read_grayscale(image,
-                                                   resolution=0.3)
-            image_data_for_cnn[image_name] = [image_data]
+    views = _read_views(list_of_images_all, resolution=0.3, verbose=verbose)
+    ids = [images[0].split('/')[-1].split('_')[1]
+           for images in list_of_images_all]
 
     # Now label the image
     if verbose:
         logger.info('Labelling images...')
 
-    scores, ml_label, ids, _, _, _, _ = \
-         label_glitches.label_glitches(image_data=image_data_for_cnn,
-                                       model_name='{0}'.format(path_to_cnn),
-                                       image_size=[140, 170],
-                                       order_of_channels=order_of_channels,
-                                       original_order=original_order,
-                                       verbose=verbose)
+    scores, ml_label = label_glitches.label_views(
+                           views=views,
+                           model_name='{0}'.format(path_to_cnn),
+                           image_size=[140, 170],
+                           order_of_channels=order_of_channels,
+                           original_order=original_order,
+                           backend=backend,
+                           server=server,
+                           batch_size=batch_size,
+                           verbose=verbose)
 
-    labels = numpy.array(classes)[ml_label]
-
-    scores_table = GravitySpyTable(scores, names=classes)
-
-    scores_table['gravityspy_id'] = ids
-    scores_table['ml_label'] = labels
-    scores_table['ml_confidence'] = scores.max(1)
-
-    return scores_table
+    return _scores_table(scores, ml_label, classes, ids)
 
 def get_features_select_images(filename1, filename2, filename3, filename4,
                                path_to_semantic_model, **kwargs):
@@ -449,10 +1094,10 @@ def get_deeplayer(plot_directory, path_to_cnn, **kwargs):
     -------
     """
     verbose = kwargs.pop('verbose', False)
-    f = h5py.File(path_to_cnn, 'r')
-    # load the api gravityspy project cached class
-    classes = kwargs.pop('classes',
-                         numpy.array(f['/labels/labels']).astype(str).T[0])
+    # load the class names stored with the model
+    classes = kwargs.pop('classes', None)
+    if classes is None:
+        classes = label_glitches.get_labels(path_to_cnn)
 
     if verbose:
         logger = log.Logger('Gravity Spy: Labelling Images')
@@ -482,6 +1127,7 @@ def get_deeplayer(plot_directory, path_to_cnn, **kwargs):
          label_glitches.get_deeplayer(image_data=image_data_for_cnn,
                                        model_name='{0}'.format(path_to_cnn),
                                        image_size=[140, 170],
+                                       original_order=True,
                                        verbose=verbose)
 
     labels = numpy.array(classes)[ml_label]